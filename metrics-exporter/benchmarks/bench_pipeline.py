@@ -0,0 +1,194 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# End to end benchmark of run_pipeline against the offline clients of harness.py, on synthetic fleets of
+# clusters x workloads x points per series or on a recording. Run from the metrics-exporter directory once config.py
+# and recommendation.sql have been generated:
+#
+#   python benchmarks/bench_pipeline.py --fleets 5x100x288,20x200x288,50x400x288
+#   python benchmarks/bench_pipeline.py --fleets 5x100x288 --projects 20 --latency 0.2
+#   python benchmarks/bench_pipeline.py --replay recordings/
+#   python benchmarks/bench_pipeline.py --fleets 5x100x288 --record-format wide
+#   python benchmarks/bench_pipeline.py --fleets 5x100x288 --engine local
+#
+# Each fleet runs in its own process so peak RSS is measured per fleet. The pipeline runs twice: once untouched for
+# the wall time and rows/sec, then with timers around each stage. Stage times are summed over the worker threads and
+# can add up to more than the wall time:
+#
+#   fetch     - decoding Cloud Monitoring response pages
+#   transform - reducing time series to values (grouping, percentiles, sketches)
+#   serialize - encoding rows
+#   append    - Storage Write API appends and commit, on the writer thread
+#   recommend - build_recommenation_table, or the local engine and the UPDATE of the latest flag
+import argparse
+import contextlib
+import functools
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harness
+import main
+import storage_writer
+from row_encoding import MetricRowEncoder, WideRowEncoder
+
+STAGES = ["fetch", "transform", "serialize", "append", "recommend"]
+
+# Accumulates the time spent in wrapped methods per stage, from any thread
+class StageTimer:
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES + ["consume", "queue"], 0.0)
+        self._lock = threading.Lock()
+        self._patched = []
+
+    def wrap(self, owner, attribute, stage):
+        original = getattr(owner, attribute)
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.seconds[stage] += elapsed
+        setattr(owner, attribute, timed)
+        self._patched.append((owner, attribute, original))
+
+    def restore(self):
+        for owner, attribute, original in reversed(self._patched):
+            setattr(owner, attribute, original)
+        self._patched = []
+
+    # Consuming the fetchers includes fetching, serializing and waiting for room in the write queue, what is left
+    # is the transform
+    def stages(self):
+        seconds = dict(self.seconds)
+        seconds["transform"] = max(0.0, seconds.pop("consume") - seconds.pop("queue") - seconds["fetch"] - seconds["serialize"])
+        return {stage: seconds[stage] for stage in STAGES}
+
+def instrument(timer):
+    timer.wrap(harness.StoredPager, "load", "fetch")
+    timer.wrap(MetricRowEncoder, "labels", "serialize")
+    timer.wrap(MetricRowEncoder, "row", "serialize")
+    timer.wrap(WideRowEncoder, "row", "serialize")
+    timer.wrap(storage_writer.QueueWriter, "_put", "queue")
+    timer.wrap(storage_writer.StorageWriter, "append", "append")
+    timer.wrap(storage_writer.StorageWriter, "commit", "append")
+    timer.wrap(main, "append_rows_proto", "consume")
+    timer.wrap(main, "build_recommenation_table", "recommend")
+    timer.wrap(main, "recommend", "recommend")
+    timer.wrap(main, "retire_recommendations", "recommend")
+
+def run_once(monitoring_client, timer=None):
+    _, write_client, _ = harness.install(monitoring_client, harness.FakeWriteClient())
+    if timer:
+        instrument(timer)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            main.run_pipeline()
+            elapsed = time.perf_counter() - start
+    finally:
+        if timer:
+            timer.restore()
+    return elapsed, write_client
+
+def bench(args):
+    if args.vpa_mode:
+        main.config.VPA_FETCH_MODE = args.vpa_mode
+    if args.record_format:
+        main.config.RECORD_FORMAT = args.record_format
+    if args.engine:
+        main.config.RECOMMENDATION_ENGINE = args.engine
+    if args.projects > 1:
+        main.config.MONITORED_PROJECTS = [f"project-{i}" for i in range(args.projects)]
+    if args.replay:
+        monitoring_client = harness.ReplayMonitoringClient(args.replay)
+    else:
+        clusters, workloads, points = (int(part) for part in args.fleet.split("x"))
+        monitoring_client = harness.SyntheticMonitoringClient(clusters, workloads, points, latency=args.latency)
+        # Generate every response before timing
+        run_once(monitoring_client)
+
+    elapsed, write_client = run_once(monitoring_client)
+    timer = StageTimer()
+    run_once(monitoring_client, timer)
+    return {
+        "fleet": args.replay or args.fleet,
+        "projects": len(main.config.MONITORED_PROJECTS),
+        "vpa_mode": main.config.VPA_FETCH_MODE,
+        "record_format": main.config.RECORD_FORMAT,
+        "engine": main.config.RECOMMENDATION_ENGINE,
+        "wall_seconds": elapsed,
+        "rows": write_client.rows_appended,
+        "rows_per_second": write_client.rows_appended / elapsed,
+        "bytes_appended": write_client.bytes_appended,
+        "stage_seconds": timer.stages(),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def print_table(results):
+    print(f"{'fleet':>20} {'projects':>8} {'mode':>11} {'format':>6} {'engine':>8} {'wall s':>8} {'rows':>10} {'rows/s':>10} {'MiB out':>8} {'MiB RSS':>8} " + " ".join(f"{stage:>9}" for stage in STAGES))
+    for result in results:
+        stages = " ".join(f"{result['stage_seconds'][stage]:9.3f}" for stage in STAGES)
+        print(f"{result['fleet']:>20} {result['projects']:>8} {result['vpa_mode']:>11} {result['record_format']:>6} {result['engine']:>8} {result['wall_seconds']:8.3f} {result['rows']:>10,} {result['rows_per_second']:>10,.0f} {result['bytes_appended'] / 2 ** 20:8.1f} {result['peak_rss_mib']:8.0f} {stages}")
+
+def run():
+    parser = argparse.ArgumentParser(description="Time the stages of run_pipeline on synthetic fleets or a recording, without Google Cloud")
+    parser.add_argument("--fleets", default="5x100x288,20x200x288,50x400x288", help="comma separated clusters x workloads x points per series")
+    parser.add_argument("--fleet", help=argparse.SUPPRESS)
+    parser.add_argument("--replay", help="directory recorded with harness.py record")
+    parser.add_argument("--projects", type=int, default=1, help="number of synthetic projects in MONITORED_PROJECTS")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each synthetic Cloud Monitoring request takes")
+    parser.add_argument("--vpa-mode", choices=["raw", "aggregated", "incremental"], help="override VPA_FETCH_MODE")
+    parser.add_argument("--record-format", choices=["flat", "wide"], help="override RECORD_FORMAT")
+    parser.add_argument("--engine", choices=["bigquery", "local"], help="override RECOMMENDATION_ENGINE")
+    parser.add_argument("--json", action="store_true", help="print one JSON result per line")
+    args = parser.parse_args()
+
+    if args.fleet or args.replay:
+        result = bench(args)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_table([result])
+        return
+
+    results = []
+    for fleet in args.fleets.split(","):
+        command = [sys.executable, os.path.abspath(__file__), "--fleet", fleet, "--json"]
+        command += ["--projects", str(args.projects), "--latency", str(args.latency)]
+        if args.vpa_mode:
+            command += ["--vpa-mode", args.vpa_mode]
+        if args.record_format:
+            command += ["--record-format", args.record_format]
+        if args.engine:
+            command += ["--engine", args.engine]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+        if args.json:
+            print(json.dumps(results[-1]))
+    if not args.json:
+        print_table(results)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,97 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark of GKE row building: the per row protobuf message, timestamp and debug print the exporter used to do
+# against the precompiled per metric encoders of main.py. Run from the metrics-exporter directory once config.py has
+# been generated:
+#
+#   python benchmarks/bench_row_encoding.py --series 20000
+import argparse
+import contextlib
+import os
+import sys
+import time
+from google.cloud import monitoring_v3
+from google.protobuf.internal import api_implementation
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main
+import metric_record_flat_pb2
+
+def synthetic_time_series(series):
+    time_series = []
+    for i in range(series):
+        time_series.append(monitoring_v3.TimeSeries({
+            "resource": {"labels": {"location": "us-central1", "project_id": "my-project", "cluster_name": f"cluster-{i % 10}", "namespace_name": f"namespace-{i % 50}"}},
+            "metadata": {"system_labels": {"top_level_controller_name": f"workload-{i}", "top_level_controller_type": "Deployment"}},
+            "points": [{"value": {"double_value": 0.25 + i % 7}}],
+        }))
+    return time_series
+
+def per_row_message(metric_name, time_series):
+    rows = []
+    for result in time_series:
+        row = metric_record_flat_pb2.MetricFlatRecord ()
+        label = result.resource.labels
+        metadata = result.metadata.system_labels.fields
+        metricdata = result.metric.labels
+        row.metric_name = metric_name
+        row.location = label['location']
+        row.project_id = label['project_id']
+        row.cluster_name = label['cluster_name']
+        row.controller_name =  metricdata['targetref_name'] if "hpa" in metric_name else metadata['top_level_controller_name'].string_value
+        row.controller_type= metricdata['targetref_kind'] if "hpa" in metric_name else metadata['top_level_controller_type'].string_value
+        row.namespace_name = label['namespace_name']
+        row.tstamp = time.time()
+        print(row)
+        for point in result.points:
+            if "cpu" in metric_name:
+                row.points = (int(point.value.double_value * 1000)) if point.value.double_value is not None else 0
+            elif "memory" in metric_name:
+                row.points = (int(point.value.double_value/1024/1024)) if point.value.double_value is not None else 0
+            else:
+                row.points = (point.value.int64_value) if point.value.int64_value is not None else 0
+            break
+        rows.append(row.SerializeToString())
+    return rows
+
+def precompiled_encoder(metric_name, time_series):
+    encode_row = main.gke_row_encoder(metric_name, time.time())
+    rows = []
+    for result in time_series:
+        points = monitoring_v3.TimeSeries.pb(result).points
+        rows.append(encode_row(result, points[0].value.double_value if points else 0))
+    return rows
+
+def run():
+    parser = argparse.ArgumentParser(description="Compare per row protobuf messages with the precompiled row encoders")
+    parser.add_argument("--series", type=int, default=20000)
+    parser.add_argument("--metric", default="cpu_requested_cores")
+    args = parser.parse_args()
+
+    print(f"protobuf backend: {api_implementation.Type()}")
+    time_series = synthetic_time_series(args.series)
+    rates = {}
+    with open(os.devnull, "w") as devnull:
+        for name, build in (("per row message", per_row_message), ("precompiled", precompiled_encoder)):
+            with contextlib.redirect_stdout(devnull):
+                start = time.perf_counter()
+                build(args.metric, time_series)
+                elapsed = time.perf_counter() - start
+            rates[name] = args.series / elapsed
+            print(f"{name:>16}: {elapsed:8.3f}s  {rates[name]:12,.0f} rows/sec")
+    print(f"speedup: {rates['precompiled'] / rates['per row message']:.1f}x")
+
+if __name__ == "__main__":
+    run()
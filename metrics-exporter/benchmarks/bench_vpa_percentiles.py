@@ -0,0 +1,77 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Micro-benchmark of the VPA percentile computation: the per point Python loop the exporter used to run against the
+# batched engine in percentiles.py, on synthetic time series. Run from the metrics-exporter directory:
+#
+#   python benchmarks/bench_vpa_percentiles.py --series 5000 --points 1440
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from google.cloud import monitoring_v3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from percentiles import ragged_from_time_series, batch_percentiles, batch_max
+
+def synthetic_time_series(series, points, seed=0):
+    rng = np.random.default_rng(seed)
+    time_series = []
+    for _ in range(series):
+        values = rng.gamma(2.0, 0.25, size=points)
+        time_series.append(monitoring_v3.TimeSeries(points=[{"value": {"double_value": value}} for value in values]))
+    return time_series
+
+def per_point_loop(time_series):
+    results = []
+    for result in time_series:
+        points_array = []
+        for point in result.points:
+            if((point.value.double_value) != 0):
+                points_array.append(int(point.value.double_value * 1000))
+            else:
+                points_array.append(int(point.value.int64_value/1024/1024))
+        results.append((int(np.percentile(points_array, 95)), max(points_array)))
+    return results
+
+def batched(time_series):
+    values, offsets = ragged_from_time_series(time_series)
+    percentile_values = batch_percentiles(values, offsets, [95])
+    max_values = batch_max(values, offsets)
+    return [(int(percentile_values[0, i]), int(max_values[i])) for i in range(len(time_series))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the per point VPA percentile loop with the batched engine")
+    parser.add_argument("--series", type=int, default=2000)
+    parser.add_argument("--points", type=int, default=1440)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    time_series = synthetic_time_series(args.series, args.points)
+    timings = {}
+    outputs = {}
+    for name, engine in (("per point loop", per_point_loop), ("batched", batched)):
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            outputs[name] = engine(time_series)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        print(f"{name:>15}: {best:8.3f}s  {args.series * args.points / best:14,.0f} points/sec")
+    print(f"speedup: {timings['per point loop'] / timings['batched']:.1f}x, identical results: {outputs['per point loop'] == outputs['batched']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,536 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline stand-ins for the Google Cloud clients used by main.py, so the whole pipeline can run without a project:
+#
+#   SyntheticMonitoringClient  - generates the responses of a fleet of N clusters x M workloads x K points per series
+#   RecordingMonitoringClient  - forwards to the real Cloud Monitoring clients and saves every response page to disk
+#   ReplayMonitoringClient     - serves the pages saved by a recording
+#   FakeWriteClient            - accepts Storage Write API appends and counts the rows and bytes
+#   FakeBigQueryClient         - answers queries and loads without running them
+#
+# install() puts them in place of the real clients through main.set_client. Responses are kept serialized and only
+# parsed when the pipeline reads a page, so fetch timings include the same decoding work as a real response.
+#
+# To record the responses of a real project, run from the metrics-exporter directory once config.py and
+# recommendation.sql have been generated:
+#
+#   python benchmarks/harness.py record recordings/
+#
+# Nothing is written to BigQuery while recording. Replay with benchmarks/bench_pipeline.py --replay recordings/
+import argparse
+import copy
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+import numpy as np
+from google.cloud import bigquery
+from google.cloud import bigquery_storage_v1
+from google.cloud import monitoring_v3
+from google.cloud.bigquery_storage_v1 import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main
+
+# Key of a list_time_series or query_time_series request. Absolute times are left out so a recording made on one
+# day is replayed by runs on later days; only the length of the interval is kept.
+def request_key(method, request):
+    if method == "list_time_series":
+        request = monitoring_v3.ListTimeSeriesRequest(request)
+        aggregation = request.aggregation
+        fields = {
+            "name": request.name,
+            "filter": request.filter,
+            "seconds": request.interval.end_time.timestamp() - request.interval.start_time.timestamp(),
+            "alignment_period": aggregation.alignment_period.total_seconds(),
+            "per_series_aligner": int(aggregation.per_series_aligner),
+            "cross_series_reducer": int(aggregation.cross_series_reducer),
+            "group_by_fields": list(aggregation.group_by_fields),
+        }
+    else:
+        request = monitoring_v3.QueryTimeSeriesRequest(request)
+        fields = {"name": request.name, "query": request.query}
+    fields["method"] = method
+    summary = json.dumps(fields, sort_keys=True)
+    return hashlib.sha1(summary.encode()).hexdigest()[:16], summary
+
+RESPONSE_CLASSES = {
+    "list_time_series": (monitoring_v3.ListTimeSeriesResponse, "time_series"),
+    "query_time_series": (monitoring_v3.QueryTimeSeriesResponse, "time_series_data"),
+}
+
+# Pager over serialized response pages with the parts of the API pagers the exporter uses: iterating over the
+# items of every page, and .pages. page_tokens holds the next_page_token of every page, a request with a page_token
+# starts at the page following the one that returned it.
+class StoredPager:
+
+    def __init__(self, method, payloads, page_tokens, request):
+        self.response_class, self.items_field = RESPONSE_CLASSES[method]
+        page_token = request.get("page_token") if isinstance(request, dict) else request.page_token
+        self.payloads = payloads[page_tokens.index(page_token) + 1:] if page_token else payloads
+
+    @property
+    def pages(self):
+        for payload in self.payloads:
+            yield self.load(payload)
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from getattr(page, self.items_field)
+
+    def load(self, payload):
+        return self.response_class.deserialize(payload)
+
+# Saves the pages of every response of the wrapped clients under directory/<request key>/
+class RecordingMonitoringClient:
+
+    def __init__(self, metric_client, query_client, directory):
+        self.clients = {"list_time_series": metric_client, "query_time_series": query_client}
+        self.directory = directory
+        self._recorded = {}
+
+    def list_time_series(self, request):
+        return self._record("list_time_series", request)
+
+    def query_time_series(self, request):
+        return self._record("query_time_series", request)
+
+    # The whole response is recorded on the first request, requests for the following pages are served from it
+    def _record(self, method, request):
+        key, summary = request_key(method, request)
+        if key not in self._recorded:
+            response_class = RESPONSE_CLASSES[method][0]
+            pages = list(getattr(self.clients[method], method)(request=request).pages)
+            payloads = [response_class.serialize(page) for page in pages]
+            page_tokens = [page.next_page_token for page in pages]
+            path = os.path.join(self.directory, key)
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, "request.json"), "w") as file:
+                file.write(summary)
+            with open(os.path.join(path, "page_tokens.json"), "w") as file:
+                json.dump(page_tokens, file)
+            for i, payload in enumerate(payloads):
+                with open(os.path.join(path, f"page-{i:05d}.pb"), "wb") as file:
+                    file.write(payload)
+            print(f"Recorded {len(payloads)} pages of {method} to {path}")
+            self._recorded[key] = (payloads, page_tokens)
+        return StoredPager(method, *self._recorded[key], request)
+
+# Serves the pages saved by RecordingMonitoringClient
+class ReplayMonitoringClient:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def list_time_series(self, request):
+        return self._replay("list_time_series", request)
+
+    def query_time_series(self, request):
+        return self._replay("query_time_series", request)
+
+    def _replay(self, method, request):
+        key, summary = request_key(method, request)
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            raise KeyError(f"No recording of {summary} in {self.directory}")
+        payloads = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".pb"):
+                with open(os.path.join(path, name), "rb") as file:
+                    payloads.append(file.read())
+        with open(os.path.join(path, "page_tokens.json")) as file:
+            page_tokens = json.load(file)
+        return StoredPager(method, payloads, page_tokens, request)
+
+# Generates the responses of a fleet of clusters x workloads in every project queried. Every workload runs two
+# containers, one pod each, and every tenth workload has an HPA. Requests without aggregation return
+# points_per_series points per series over the request interval, aligned requests one point per series and reduced
+# requests one point per group of the group by fields. Every request, one per page, takes latency seconds.
+class SyntheticMonitoringClient:
+
+    CONTAINERS = ["app", "sidecar"]
+
+    def __init__(self, clusters, workloads, points_per_series, points_per_page=100000, seed=0, latency=0.0):
+        self.clusters = clusters
+        self.workloads = workloads
+        self.points_per_series = points_per_series
+        self.points_per_page = points_per_page
+        self.seed = seed
+        self.latency = latency
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def list_time_series(self, request):
+        return self._cached("list_time_series", request, self._list_pages)
+
+    def query_time_series(self, request):
+        return self._cached("query_time_series", request, self._query_pages)
+
+    def _cached(self, method, request, generate):
+        if self.latency:
+            time.sleep(self.latency)
+        key, _ = request_key(method, request)
+        with self._lock:
+            if key not in self._cache:
+                payloads = generate(request)
+                self._cache[key] = (payloads, [str(i + 1) for i in range(len(payloads) - 1)] + [""])
+        return StoredPager(method, *self._cache[key], request)
+
+    # clusters restricts the series to the clusters named, as the cluster filter of a shard does
+    def series_labels(self, project_id, metric_type, clusters=None):
+        for cluster in range(self.clusters):
+            if clusters and f"cluster-{cluster}" not in clusters:
+                continue
+            for workload in range(self.workloads):
+                if "podautoscaler/hpa" in metric_type and workload % 10:
+                    continue
+                for container in self.CONTAINERS:
+                    yield {
+                        "location": f"region-{cluster % 3}",
+                        "project_id": project_id,
+                        "cluster_name": f"cluster-{cluster}",
+                        "namespace_name": f"namespace-{workload % 20}",
+                        "controller_name": f"workload-{workload}",
+                        "controller_kind": "Deployment",
+                        "container_name": container,
+                        "pod_name": f"workload-{workload}-{cluster}",
+                    }
+
+    # The value pool entry of a series, the same whichever subset of the fleet a request reads
+    def pool_index(self, label):
+        return zlib.crc32("/".join(label.values()).encode()) % 64
+
+    # Distinct point value series, reused across series so large fleets are generated quickly
+    def value_pool(self, metric_type, points):
+        rng = np.random.default_rng(zlib.crc32(metric_type.encode()) + self.seed)
+        if "bytes" in metric_type:
+            return [np.trunc(rng.gamma(4, 64 * 1024 * 1024, points)).astype(np.int64) for _ in range(64)]
+        return [rng.gamma(2, 0.1, points) for _ in range(64)]
+
+    def _list_pages(self, request):
+        request = monitoring_v3.ListTimeSeriesRequest(request)
+        metric_type = re.search(r'metric.type = "([^"]+)"', request.filter).group(1)
+        project_id = request.name.split("/")[-1]
+        aggregation = request.aggregation
+        end = int(request.interval.end_time.timestamp())
+        start = int(request.interval.start_time.timestamp())
+        if aggregation.per_series_aligner:
+            points = 1
+            step = end - start
+        else:
+            points = self.points_per_series
+            step = max(1, (end - start) // points)
+        is_int = "bytes" in metric_type and not aggregation.per_series_aligner
+        clusters = re.search(r"cluster_name = one_of\(([^)]*)\)", request.filter)
+        clusters = re.findall(r'"([^"]+)"', clusters.group(1)) if clusters else None
+        labels = list(self.series_labels(project_id, metric_type, clusters))
+
+        # Template series holding only points, copied into every series that uses the same values
+        templates = []
+        for values in self.value_pool(metric_type, points):
+            template = monitoring_v3.TimeSeries.pb()()
+            for i, value in enumerate(values.tolist()):
+                point = template.points.add()
+                point.interval.end_time.seconds = end - i * step
+                point.interval.start_time.seconds = end - (i + 1) * step
+                if is_int:
+                    point.value.int64_value = int(value)
+                else:
+                    point.value.double_value = float(value)
+            templates.append(template)
+
+        series_list = [self.build_series(label, metric_type, templates[self.pool_index(label)]) for label in labels]
+        if aggregation.cross_series_reducer:
+            series_list = self.reduce_series(series_list, aggregation)
+
+        response_class = monitoring_v3.ListTimeSeriesResponse.pb()
+        series_per_page = max(1, self.points_per_page // points)
+        payloads = []
+        for page_start in range(0, len(series_list), series_per_page):
+            page = response_class()
+            for series in series_list[page_start:page_start + series_per_page]:
+                page.time_series.add().CopyFrom(series)
+            if page_start + series_per_page < len(series_list):
+                page.next_page_token = str(len(payloads) + 1)
+            payloads.append(page.SerializeToString())
+        return payloads
+
+    # Series of a container, with the labels Cloud Monitoring sets for its metric type and the points of template
+    def build_series(self, label, metric_type, template):
+        series = monitoring_v3.TimeSeries.pb()()
+        series.CopyFrom(template)
+        series.metric.type = metric_type
+        series.resource.type = "k8s_scale" if "autoscaler" in metric_type else "k8s_container"
+        for name in ("location", "project_id", "cluster_name", "namespace_name"):
+            series.resource.labels[name] = label[name]
+        if "podautoscaler/hpa" in metric_type:
+            series.metric.labels["targetref_name"] = label["controller_name"]
+            series.metric.labels["targetref_kind"] = label["controller_kind"]
+        elif "autoscaler" in metric_type:
+            for name in ("controller_name", "controller_kind", "container_name"):
+                series.resource.labels[name] = label[name]
+        else:
+            series.resource.labels["pod_name"] = label["pod_name"]
+            series.resource.labels["container_name"] = label["container_name"]
+            series.metadata.system_labels.fields["top_level_controller_name"].string_value = label["controller_name"]
+            series.metadata.system_labels.fields["top_level_controller_type"].string_value = label["controller_kind"]
+        return series
+
+    # Cross series reduction of aligned series as Cloud Monitoring does it: one series per distinct value of the
+    # group by fields, keeping only those labels, with the reducer applied to the latest point of the series of the
+    # group that have one. Groups whose series have no points are left out.
+    def reduce_series(self, series_list, aggregation):
+        groups = {}
+        for series in series_list:
+            if not series.points:
+                continue
+            labels = []
+            for field in aggregation.group_by_fields:
+                prefix, name = field.rsplit(".", 1)
+                name = name.strip('"')
+                if prefix == "resource.label":
+                    labels.append((prefix, name, series.resource.labels.get(name, "")))
+                elif prefix == "metric.label":
+                    labels.append((prefix, name, series.metric.labels.get(name, "")))
+                else:
+                    fields = series.metadata.system_labels.fields
+                    labels.append((prefix, name, fields[name].string_value if name in fields else ""))
+            value = series.points[0].value
+            groups.setdefault(tuple(labels), (series, []))[1].append(value.double_value or value.int64_value)
+
+        Reducer = monitoring_v3.Aggregation.Reducer
+        reduced = []
+        for labels, (first, values) in groups.items():
+            series = monitoring_v3.TimeSeries.pb()()
+            series.metric.type = first.metric.type
+            series.resource.type = first.resource.type
+            for prefix, name, value in labels:
+                if prefix == "resource.label":
+                    series.resource.labels[name] = value
+                elif prefix == "metric.label":
+                    series.metric.labels[name] = value
+                else:
+                    series.metadata.system_labels.fields[name].string_value = value
+            point = series.points.add()
+            point.CopyFrom(first.points[0])
+            if aggregation.cross_series_reducer == Reducer.REDUCE_COUNT:
+                point.value.int64_value = len(values)
+            elif aggregation.cross_series_reducer == Reducer.REDUCE_SUM:
+                point.value.double_value = sum(values)
+            elif aggregation.cross_series_reducer == Reducer.REDUCE_MAX:
+                point.value.double_value = max(values)
+            else:
+                point.value.double_value = sum(values) / len(values)
+            reduced.append(series)
+        return reduced
+
+    def _query_pages(self, request):
+        request = monitoring_v3.QueryTimeSeriesRequest(request)
+        metric_type = re.search(r"metric '([^']+)'", request.query).group(1)
+        percentiles = [int(p) for p in re.findall(r"percentile\(val\(\), (\d+)\)", request.query)]
+        project_id = request.name.split("/")[-1]
+        label_names = ["project_id", "location", "cluster_name", "namespace_name", "controller_name", "controller_kind", "container_name"]
+        pool = self.value_pool(metric_type, self.points_per_series)
+        reduced = [([float(np.percentile(values, p)) for p in percentiles], values.max().item()) for values in pool]
+        end = int(time.time())
+
+        response_class = monitoring_v3.QueryTimeSeriesResponse.pb()
+        clusters = re.search(r"cluster_name =~ '([^']+)'", request.query)
+        labels = list(self.series_labels(project_id, metric_type, clusters.group(1).split("|") if clusters else None))
+        series_per_page = self.points_per_page
+        payloads = []
+        for page_start in range(0, max(1, len(labels)), series_per_page):
+            page = response_class()
+            for name in label_names:
+                page.time_series_descriptor.label_descriptors.add().key = f"resource.{name}"
+            for p in percentiles:
+                page.time_series_descriptor.point_descriptors.add().key = f"percentile_{p}"
+            page.time_series_descriptor.point_descriptors.add().key = "max"
+            for label in labels[page_start:page_start + series_per_page]:
+                data = page.time_series_data.add()
+                for name in label_names:
+                    data.label_values.add().string_value = label[name]
+                point = data.point_data.add()
+                point.time_interval.end_time.seconds = end
+                percentile_values, max_value = reduced[self.pool_index(label)]
+                for value in percentile_values:
+                    point.values.add().double_value = value
+                if isinstance(max_value, int):
+                    point.values.add().int64_value = max_value
+                else:
+                    point.values.add().double_value = max_value
+            if page_start + series_per_page < len(labels):
+                page.next_page_token = str(len(payloads) + 1)
+            payloads.append(page.SerializeToString())
+        return payloads
+
+# Storage Write API stand-in. Appends are acknowledged in order after latency seconds; with keep_rows the
+# serialized rows are kept for comparing the output of two runs, in rows and by stream name in stream_rows.
+class FakeWriteClient:
+
+    def __init__(self, latency=0.0, keep_rows=False):
+        self.latency = latency
+        self.keep_rows = keep_rows
+        self.rows = []
+        self.stream_rows = {}
+        self.rows_appended = 0
+        self.bytes_appended = 0
+        self.requests = 0
+        self.committed = []
+        self._streams = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def table_path(project, dataset, table):
+        return bigquery_storage_v1.BigQueryWriteClient.table_path(project, dataset, table)
+
+    def create_write_stream(self, parent, write_stream):
+        with self._lock:
+            self._streams += 1
+            return types.WriteStream(name=f"{parent}/streams/offline-{self._streams}", type_=write_stream.type_)
+
+    def finalize_write_stream(self, name):
+        return types.FinalizeWriteStreamResponse(row_count=self.rows_appended)
+
+    def batch_commit_write_streams(self, request):
+        self.committed.extend(request.write_streams)
+        return types.BatchCommitWriteStreamsResponse()
+
+    def open_append_rows_stream(self, request_template):
+        return FakeAppendRowsStream(self, request_template.write_stream)
+
+    # Rows of the committed streams, in commit order
+    def committed_rows(self):
+        return [row for name in self.committed for row in self.stream_rows.get(name, [])]
+
+class FakeAppendRowsStream:
+
+    def __init__(self, client, stream_name=None):
+        self.client = client
+        self.stream_name = stream_name
+        self._last = None
+
+    def send(self, request):
+        serialized_rows = request.proto_rows.rows.serialized_rows
+        client = self.client
+        with client._lock:
+            client.requests += 1
+            client.rows_appended += len(serialized_rows)
+            client.bytes_appended += sum(len(row) for row in serialized_rows)
+            if client.keep_rows:
+                client.rows.extend(serialized_rows)
+                client.stream_rows.setdefault(self.stream_name, []).extend(serialized_rows)
+        future = Future()
+        if client.latency:
+            # Acknowledge in order, each request latency seconds after the previous one
+            previous = self._last
+            def acknowledge():
+                if previous is not None:
+                    previous.result()
+                time.sleep(client.latency)
+                future.set_result(types.AppendRowsResponse())
+            threading.Thread(target=acknowledge, daemon=True).start()
+        else:
+            future.set_result(types.AppendRowsResponse())
+        self._last = future
+        return future
+
+    def close(self):
+        if self._last is not None:
+            self._last.result()
+
+class FakeQueryJob:
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+        self.job_id = "offline"
+        self.total_bytes_billed = 0
+        self.slot_millis = 0
+        self.num_dml_affected_rows = 0
+
+    def result(self):
+        return self.rows
+
+# BigQuery stand-in. Queries are recorded and not run, except SELECTs from a table filled by load_table_from_json,
+# which return its rows filtered on the query parameters whose name is a column.
+class FakeBigQueryClient:
+
+    def __init__(self):
+        self.queries = []
+        self.tables = {}
+        # Table definitions created with create_table, by table ID
+        self.created = {}
+        self._lock = threading.Lock()
+
+    def query(self, sql, job_config=None):
+        with self._lock:
+            self.queries.append(sql)
+            match = re.match(r"\s*SELECT .* FROM `([^`]+)`", sql, re.S)
+            if not match or match.group(1) not in self.tables:
+                return FakeQueryJob()
+            # Scalar parameters named after a column filter on it, array parameters are ignored
+            parameters = {parameter.name: parameter.value for parameter in getattr(job_config, "query_parameters", []) if hasattr(parameter, "value")}
+            rows = [row for row in self.tables[match.group(1)] if all(row.get(name, value) == value for name, value in parameters.items())]
+            return FakeQueryJob(rows)
+
+    def create_table(self, table, exists_ok=False):
+        with self._lock:
+            return self.created.setdefault(f"{table.project}.{table.dataset_id}.{table.table_id}", table)
+
+    def delete_table(self, table, not_found_ok=False):
+        with self._lock:
+            self.created.pop(table if isinstance(table, str) else f"{table.project}.{table.dataset_id}.{table.table_id}", None)
+            self.tables.pop(table, None)
+
+    def load_table_from_json(self, rows, table_id, job_config=None, **kwargs):
+        with self._lock:
+            if getattr(job_config, "write_disposition", None) == bigquery.WriteDisposition.WRITE_TRUNCATE:
+                self.tables[table_id] = []
+            self.tables.setdefault(table_id, []).extend(rows)
+        return FakeQueryJob()
+
+    # Streaming inserts are visible to the next query, like load jobs here. Returns the row errors, none.
+    def insert_rows_json(self, table_id, rows, **kwargs):
+        with self._lock:
+            self.tables.setdefault(table_id, []).extend(copy.deepcopy(dict(row)) for row in rows)
+        return []
+
+# Replace the clients of main.py. Returns the stand-ins in place.
+def install(monitoring_client, write_client=None, bigquery_client=None):
+    write_client = write_client or FakeWriteClient()
+    bigquery_client = bigquery_client or FakeBigQueryClient()
+    main.set_client(monitoring_v3.MetricServiceClient, monitoring_client)
+    main.set_client(monitoring_v3.QueryServiceClient, monitoring_client)
+    main.set_client(bigquery_storage_v1.BigQueryWriteClient, write_client)
+    main.set_client(bigquery.Client, bigquery_client)
+    return monitoring_client, write_client, bigquery_client
+
+def record(directory):
+    recorder = RecordingMonitoringClient(main.get_client(monitoring_v3.MetricServiceClient), main.get_client(monitoring_v3.QueryServiceClient), directory)
+    install(recorder)
+    main.run_pipeline()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record the Cloud Monitoring responses of a pipeline run for offline replay")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="run the pipeline against Cloud Monitoring and save every response page")
+    record_parser.add_argument("directory")
+    args = parser.parse_args()
+    record(args.directory)
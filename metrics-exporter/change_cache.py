@@ -0,0 +1,102 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+from google.cloud import bigquery
+import instrumentation
+from tables import load_schema
+
+# Change detection between runs. The cache maps the key of every workload to a hash of the metrics it had in the run
+# that last saw it, so a run only writes the staging rows and recommendations of the workloads that are new or
+# changed; the others keep their latest recommendation. A workload missing from runs keeps its entry, and its latest
+# recommendation, until it has not been seen for ttl_seconds: it is then evicted and its recommendation retired.
+# Every snapshot_interval_seconds a run is a full snapshot that writes every workload and retires everything older.
+#
+# The cache is kept in a BigQuery table replaced by a load job at the end of every run. The time of the last
+# snapshot is stored under the key "".
+
+SNAPSHOT_KEY = ""
+
+# A run changing more workloads than this is turned into a snapshot, their keys would not fit in the query
+# parameters of the UPDATE retiring their recommendations
+MAX_RETIRED_KEYS = 10000
+
+# Key of a workload, the labels of WideRecordJoiner joined by "/" which no GCP or Kubernetes name contains. The
+# recommendation table stores empty labels as NULL, see retire_recommendations in main.py.
+def workload_key(labels):
+    return "/".join(labels)
+
+# Hash of the distinct values of every metric of a workload
+def workload_hash(metrics):
+    digest = hashlib.blake2b(digest_size=16)
+    for metric_name in sorted(metrics):
+        digest.update(f"{metric_name}={sorted(metrics[metric_name])};".encode())
+    return digest.hexdigest()
+
+class ChangeCache:
+
+    def __init__(self, client, table_id, ttl_seconds, snapshot_interval_seconds):
+        self.client = client
+        self.table_id = table_id
+        self.ttl_seconds = ttl_seconds
+        self.snapshot_interval_seconds = snapshot_interval_seconds
+        # workload key -> (value hash, time last seen)
+        self.entries = {}
+        self.snapshot_time = None
+        # Set by update for the current run
+        self.snapshot = True
+        self.changed = set()
+        self.retired_keys = []
+
+    def load(self):
+        query_job = self.client.query(f"SELECT workload_key, value_hash, last_seen FROM `{self.table_id}`")
+        rows = list(query_job.result())
+        instrumentation.record_query_job(query_job)
+        self.entries = {row["workload_key"]: (row["value_hash"], row["last_seen"]) for row in rows if row["workload_key"] != SNAPSHOT_KEY}
+        self.snapshot_time = next((row["last_seen"] for row in rows if row["workload_key"] == SNAPSHOT_KEY), None)
+        return self.entries
+
+    # Compare the joined workloads of the run of tstamp to the cache and update it. Sets changed, the labels of the
+    # workloads to write, and retired_keys, the keys of the workloads whose latest recommendation is replaced or
+    # evicted; in a snapshot every workload is written and every older recommendation retired.
+    def update(self, records, tstamp):
+        hashes = {labels: workload_hash(metrics) for labels, metrics in records.items()}
+        self.changed = {labels for labels, value_hash in hashes.items() if self.entries.get(workload_key(labels), (None,))[0] != value_hash}
+        seen = {workload_key(labels) for labels in hashes}
+        evicted = [key for key, (_, last_seen) in self.entries.items() if key not in seen and tstamp - last_seen >= self.ttl_seconds]
+        self.retired_keys = sorted({workload_key(labels) for labels in self.changed}.union(evicted))
+        self.snapshot = (
+            self.snapshot_time is None
+            or tstamp - self.snapshot_time >= self.snapshot_interval_seconds
+            or len(self.retired_keys) > MAX_RETIRED_KEYS
+        )
+        if self.snapshot:
+            # Everything older is retired, including the workloads missing from this run
+            self.changed = set(hashes)
+            self.retired_keys = []
+            self.entries = {}
+            self.snapshot_time = tstamp
+        for key in evicted:
+            self.entries.pop(key, None)
+        self.entries.update({workload_key(labels): (value_hash, tstamp) for labels, value_hash in hashes.items()})
+        instrumentation.current_run().add(workloads_changed=len(self.changed), workloads_unchanged=len(hashes) - len(self.changed), workloads_evicted=len(evicted))
+
+    # Replace the cache table with the entries
+    def save(self):
+        rows = [{"workload_key": key, "value_hash": value_hash, "last_seen": last_seen} for key, (value_hash, last_seen) in self.entries.items()]
+        rows.append({"workload_key": SNAPSHOT_KEY, "value_hash": "", "last_seen": self.snapshot_time})
+        job_config = bigquery.LoadJobConfig(
+            schema=load_schema("bigquery_change_cache_schema.json"),
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        self.client.load_table_from_json(rows, self.table_id, job_config=job_config).result()
@@ -0,0 +1,134 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+from google.cloud import bigquery
+import instrumentation
+
+# Checkpoints of resumable pipeline runs. A run is split into units, one per project and query plan, and every unit
+# writes its rows to its own PENDING streams: each time a checkpoint is saved the unit finalizes its current stream
+# and starts a new one, so a checkpoint lists finalized streams only, with the page token to resume from. Nothing is
+# committed until every unit has run, then the streams of all units are committed at once. A run restarted with the
+# same run ID skips the units that are done and resumes the others from their last checkpoint.
+#
+# Checkpoints are appended to a BigQuery table with streaming inserts, which queries see right away. The latest
+# entry of a unit is its state. The run itself has entries under the unit "": "started" with the run timestamp,
+# "committed" once the streams are committed and "finished" at the end.
+
+RUN_UNIT = ""
+
+class UnitCheckpoint:
+
+    def __init__(self, unit, status="pending", streams=None, page_token="", request_time=None):
+        self.unit = unit
+        self.status = status
+        self.streams = list(streams or [])
+        self.page_token = page_token
+        # Time the unit's Cloud Monitoring request ends at, repeated on resume so its page token stays valid
+        self.request_time = request_time
+
+class CheckpointLog:
+
+    def __init__(self, client, table_id, run_id):
+        self.client = client
+        self.table_id = table_id
+        self.run_id = run_id
+        self.checkpoints = {}
+
+    # Load the latest checkpoint of every unit of the run
+    def load(self):
+        job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("run_id", "STRING", self.run_id)])
+        query_job = self.client.query(f"SELECT * FROM `{self.table_id}` WHERE run_id = @run_id", job_config=job_config)
+        rows = sorted(query_job.result(), key=lambda row: row["updated"])
+        instrumentation.record_query_job(query_job)
+        self.checkpoints = {
+            row["unit"]: UnitCheckpoint(row["unit"], row["status"], row["streams"], row["page_token"], row["request_time"])
+            for row in rows
+        }
+        return self.checkpoints
+
+    def save(self, checkpoint):
+        row = {
+            "run_id": self.run_id,
+            "unit": checkpoint.unit,
+            "status": checkpoint.status,
+            "streams": checkpoint.streams,
+            "page_token": checkpoint.page_token,
+            "request_time": checkpoint.request_time,
+            "updated": time.time(),
+        }
+        errors = self.client.insert_rows_json(self.table_id, [row])
+        if errors:
+            raise RuntimeError(f"Failed to save checkpoint {checkpoint.unit} of run {self.run_id}: {errors}")
+        self.checkpoints[checkpoint.unit] = checkpoint
+
+# Writes the rows of one unit in batches of batch_rows and saves its checkpoints. Fetchers that can resume call
+# page_done after the rows of every page, which saves a checkpoint at most every interval_seconds.
+class UnitProgress:
+
+    def __init__(self, checkpoint, checkpoint_log, open_writer, batch_rows=5000, interval_seconds=60):
+        self.checkpoint = checkpoint
+        self.checkpoint_log = checkpoint_log
+        self.open_writer = open_writer
+        self.batch_rows = batch_rows
+        self.interval_seconds = interval_seconds
+        self.page_token = checkpoint.page_token
+        self.request_time = checkpoint.request_time
+        self._writer = None
+        self._batch = []
+        self._last_save = time.monotonic()
+
+    # Returns the number of rows written
+    def write(self, rows):
+        count = 0
+        for row in rows:
+            self._batch.append(row)
+            count += 1
+            if len(self._batch) >= self.batch_rows:
+                self._append()
+        self._append()
+        return count
+
+    # Every row of the pages before next_page_token has been written
+    def page_done(self, next_page_token):
+        if next_page_token and time.monotonic() - self._last_save >= self.interval_seconds:
+            self._save("partial", next_page_token)
+
+    def done(self):
+        self._save("done", "")
+
+    # Close the stream of the rows written since the last checkpoint without finalizing it, a no-op after done
+    def abort(self):
+        if self._writer is not None:
+            self._writer.abort()
+            self._writer = None
+
+    def _append(self):
+        if self._batch:
+            if self._writer is None:
+                self._writer = self.open_writer()
+            self._writer.append(self._batch)
+            self._batch = []
+
+    def _save(self, status, page_token):
+        self._append()
+        if self._writer is not None:
+            self._writer.finalize()
+            instrumentation.current_run().add(rows_appended=self._writer.rows_appended, bytes_appended=self._writer.bytes_appended)
+            self.checkpoint.streams.append(self._writer.stream_name)
+            self._writer = None
+        self.checkpoint.status = status
+        self.checkpoint.page_token = page_token
+        self.checkpoint.request_time = self.request_time
+        self.checkpoint_log.save(self.checkpoint)
+        self._last_save = time.monotonic()
@@ -16,11 +16,140 @@ PROJECT_ID = "${PROJECT_ID}"
 PUBSUB_TOPIC = "${PUBSUB_TOPIC}"
 BIGQUERY_DATASET = "${BIGQUERY_DATASET}"
 BIGQUERY_TABLE = "${BIGQUERY_MQL_TABLE}"
+WIDE_TABLE = "${BIGQUERY_MQL_WIDE_TABLE}"
 RECOMMENDATION_TABLE = "${BIGQUERY_VPA_RECOMMENDATION_TABLE}"
+SKETCH_TABLE = "${BIGQUERY_VPA_SKETCH_TABLE}"
+SHARD_TABLE = "${BIGQUERY_SHARD_TABLE}"
+CHECKPOINT_TABLE = "${BIGQUERY_CHECKPOINT_TABLE}"
+CHANGE_CACHE_TABLE = "${BIGQUERY_CHANGE_CACHE_TABLE}"
 RECOMMENDATION_WINDOW_SECONDS = 2592000
 LATEST_WINDOW_SECONDS = 60
 
+# Projects whose GKE metrics are exported. Rows of every project are written to the BigQuery dataset of PROJECT_ID
+# and the function's service account needs roles/monitoring.viewer on each of them. The scoping project of a metrics
+# scope returns the metrics of every project in the scope, so listing only that project reads the whole scope with
+# one query per metric.
+MONITORED_PROJECTS = [PROJECT_ID]
+
+# Coordinator/worker mode for fleets too large for one invocation. With SHARD_CLUSTERS set, the scheduled invocation
+# only lists the clusters of MONITORED_PROJECTS and publishes one message per group of at most SHARD_CLUSTERS
+# clusters of a project to PUBSUB_TOPIC. Each message triggers a worker invocation exporting those clusters, and the
+# last worker to finish, as recorded in SHARD_TABLE, builds the recommendation table. 0 exports everything in the
+# scheduled invocation.
+SHARD_CLUSTERS = 0
+
+# Number of (project, MQL_QUERY metric) pairs fetched and written to BigQuery in parallel, which also caps the
+# Cloud Monitoring requests in flight across all projects. Set to 1 to process metrics one at a time. Pairs are
+# started metric by metric so the running ones are spread over the projects, and the rows of every pair go to one
+# stream committed once every metric has been written. A failing metric does not stop the others, but the run then
+# fails without building recommendations.
+PIPELINE_WORKERS = 4
+
+# Checkpointed runs. Each (project, MQL_QUERY metric) pair records its progress in CHECKPOINT_TABLE, so a run
+# restarted after a timeout or crash, a retried Pub/Sub event or shard, skips the pairs already exported and resumes
+# raw VPA fetches from the page token saved at most every CHECKPOINT_INTERVAL_SECONDS. Rows are always written to
+# PENDING streams in this mode, committed together once every pair has run. With the "wide" RECORD_FORMAT a pair is
+# joined and written once fetched, without page checkpoints, and the recommendation query merges the rows of a
+# workload written by different pairs.
+CHECKPOINT_RUNS = False
+
+# With CHECKPOINT_RUNS, deploy_pipeline.sh deploys the function with --retry: a failed run is retried from the same
+# Pub/Sub event and resumes under the event ID. Pub/Sub keeps redelivering the event of a run that keeps failing, each
+# attempt a billed invocation of up to the function timeout, until it is older than this and dropped; the run then
+# waits for the next scheduled one. Without checkpoints every retry would fetch and write the whole run again, so
+# the function is deployed without --retry. Enable CHECKPOINT_RUNS with SHARD_CLUSTERS, a failed shard is otherwise
+# never retried and its run never built.
+EVENT_MAX_AGE_SECONDS = 6 * 3600
+CHECKPOINT_INTERVAL_SECONDS = 60
+
+# Cloud Monitoring requests in flight per project. Quota errors halve a project's limit, down to 1, and pause its
+# requests for an exponential backoff between MONITORING_QUOTA_BACKOFF_SECONDS and
+# MONITORING_QUOTA_MAX_BACKOFF_SECONDS; the limit grows back as requests succeed. A request is given up after
+# MONITORING_QUOTA_RETRIES quota errors in a row.
+MONITORING_PROJECT_CONCURRENCY = 4
+MONITORING_QUOTA_RETRIES = 5
+MONITORING_QUOTA_BACKOFF_SECONDS = 1
+MONITORING_QUOTA_MAX_BACKOFF_SECONDS = 32
+
+# The exporter creates the staging table partitioned by ingestion hour, with partitions deleted
+# STAGING_PARTITION_EXPIRATION_HOURS after their hour. Keep it longer than a run, including its retries.
+STAGING_PARTITION_EXPIRATION_HOURS = 6
+
+# Layout of the staging rows:
+#   "flat" - one MetricFlatRecord row per workload and metric in BIGQUERY_TABLE, pivoted by recommendation.sql
+#   "wide" - one MetricWideRecord row per workload with a column per metric in WIDE_TABLE, read by
+#            recommendation-wide.sql. The exporter holds one record per workload until every metric is fetched.
+RECORD_FORMAT = "flat"
+
+# Where the recommendations of a run are computed:
+#   "bigquery" - recommendation.sql (or recommendation-wide.sql) MERGEs them from the staging table
+#   "local"    - the exporter computes them in memory with NumPy (see recommender.py) and writes them to
+#                RECOMMENDATION_TABLE with the Storage Write API; a single UPDATE clears the latest flag of older
+#                ones. Metrics are still written to the staging table. Checkpointed runs always use "bigquery".
+RECOMMENDATION_ENGINE = "bigquery"
+
+# Change detection, for unsharded runs with RECOMMENDATION_ENGINE = "local". The exporter keeps a hash of the
+# metrics of every workload in CHANGE_CACHE_TABLE and only writes the staging rows and recommendations of the
+# workloads that are new or changed since the previous run; unchanged workloads keep their latest recommendation.
+# A workload missing from runs keeps its latest recommendation until it has been missing for CHANGE_CACHE_TTL_HOURS.
+# Every CHANGE_SNAPSHOT_INTERVAL_HOURS a run writes every workload and retires all older recommendations.
+CHANGE_DETECTION = False
+CHANGE_CACHE_TTL_HOURS = 6
+CHANGE_SNAPSHOT_INTERVAL_HOURS = 24
+
+# BigQuery Storage Write API. "pending" writes all rows of a run to one stream committed at the end of the run,
+# "committed" appends to the table's default stream where rows are visible as soon as they are acknowledged, even
+# the rows of a run that then fails.
+BIGQUERY_WRITE_STREAM_TYPE = "pending"
+# Append requests are split to stay under the 10MB AppendRows request limit
+APPEND_ROWS_MAX_BYTES = 9 * 1024 * 1024
+# Append requests sent before waiting for the oldest acknowledgement, and retries of a failed request
+APPEND_ROWS_MAX_INFLIGHT = 8
+APPEND_ROWS_MAX_RETRIES = 3
+# Rows are streamed from Cloud Monitoring to BigQuery in batches of WRITE_BATCH_ROWS, with at most
+# WRITE_QUEUE_BATCHES batches waiting to be appended. Together they bound the memory used by fetched rows.
+WRITE_BATCH_ROWS = 5000
+WRITE_QUEUE_BATCHES = 8
+
+# How VPA recommendations are reduced over RECOMMENDATION_WINDOW_SECONDS:
+#   "aggregated" - Cloud Monitoring computes the 95th percentile and max, one point per time series is downloaded
+#   "raw"        - every point in the window is downloaded and reduced by the exporter
+#   "incremental" - daily quantile sketches are kept in SKETCH_TABLE, only the days not stored yet are downloaded.
+#                   The window is widened to whole days, starting at the beginning of the day it starts in. Only
+#                   complete days are stored, today is fetched on every run, and days that leave the window expire
+#                   with their partition of SKETCH_TABLE.
+# "aggregated" rows can differ from "raw" ones by 1 millicore or MiB, the percentile being truncated after
+# interpolation instead of before; tests/test_fetch_modes.py checks both modes against the same recorded series.
+VPA_FETCH_MODE = "raw"
+
+# Relative error of the percentiles computed from the daily sketches in "incremental" mode
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+# Directory of a local cache of the raw VPA points, "" to disable. In "raw" mode the points of every series are kept
+# there as NumPy files and a run only downloads the points newer than the cache, re-fetching the last
+# TIMESERIES_CACHE_OVERLAP_SECONDS for points that arrived late. The files are memory-mapped when read, but a run
+# copies the cached points still in the window when it merges them with the new ones, so it needs memory for every
+# point of the window. The cache can be read again with other percentiles or windows with
+# `python timeseries_cache.py`. It needs a persistent disk: in Cloud Functions only /tmp is writable and it does not
+# outlive the instance.
+TIMESERIES_CACHE_DIR = ""
+TIMESERIES_CACHE_OVERLAP_SECONDS = 600
+
+# Integer percentiles exported for both cpu and memory VPA recommendations in addition to the cpu 95th percentile,
+# e.g. [50, 90, 99] adds rows named cpu_request_50th_percentile_recommendations, memory_request_50th_percentile_recommendations...
+VPA_EXTRA_PERCENTILES = []
+
+# Stage timings, fetch counts and BigQuery job statistics are always logged as structured JSON. Set
+# PIPELINE_METRICS_EXPORT to True to also write them as custom Cloud Monitoring metrics under PIPELINE_METRICS_PREFIX,
+# which needs the roles/monitoring.metricWriter role.
+PIPELINE_METRICS_EXPORT = False
+PIPELINE_METRICS_PREFIX = "custom.googleapis.com/metrics_exporter"
+
 # IMPORTANT: to guarantee successfully retriving data, please use a time window greater than 5 minutes
+#
+# Entries are [metric type, window, "gke_metric" | "vpa_metric", optional reducer]. The reducer of a gke_metric is
+# "count", "mean", "sum" or "max" and defaults to "count" for container_count and "mean" otherwise. gke_metric
+# entries with the same metric type and window are fetched from Cloud Monitoring once and reduced locally.
 
 MQL_QUERY = {
     "container_count" :["kubernetes.io/container/cpu/request_cores", LATEST_WINDOW_SECONDS, "gke_metric"]
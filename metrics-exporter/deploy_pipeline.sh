@@ -6,15 +6,23 @@ gcloud iam service-accounts create mql-export-metrics \
 
 echo "Assigning IAM roles to the service account..."
 gcloud projects add-iam-policy-binding  $PROJECT_ID --member="serviceAccount:$EXPORT_METRIC_SERVICE_ACCOUNT" --role="roles/monitoring.viewer"
+gcloud projects add-iam-policy-binding  $PROJECT_ID --member="serviceAccount:$EXPORT_METRIC_SERVICE_ACCOUNT" --role="roles/monitoring.metricWriter"
 gcloud projects add-iam-policy-binding  $PROJECT_ID --member="serviceAccount:$EXPORT_METRIC_SERVICE_ACCOUNT" --role="roles/bigquery.dataEditor"
 gcloud projects add-iam-policy-binding  $PROJECT_ID --member="serviceAccount:$EXPORT_METRIC_SERVICE_ACCOUNT" --role="roles/bigquery.dataOwner"
 gcloud projects add-iam-policy-binding  $PROJECT_ID --member="serviceAccount:$EXPORT_METRIC_SERVICE_ACCOUNT" --role="roles/bigquery.jobUser"
+gcloud projects add-iam-policy-binding  $PROJECT_ID --member="serviceAccount:$EXPORT_METRIC_SERVICE_ACCOUNT" --role="roles/pubsub.publisher"
 
 echo "Creating the Pub/Sub topic..."
 gcloud pubsub topics create $PUBSUB_TOPIC
 
 echo "Deploy the Cloud Function.."
 
+# Failed runs are only retried when they are checkpointed, a retry then resumes the run instead of exporting it again
+RETRY_FLAG=""
+if grep -q "^CHECKPOINT_RUNS = True" config.py; then
+RETRY_FLAG="--retry"
+fi
+
 gcloud functions deploy mql-export-metric \
 --region $REGION \
 --trigger-topic $PUBSUB_TOPIC \
@@ -23,7 +31,7 @@ gcloud functions deploy mql-export-metric \
 --memory 2048MB \
 --timeout 540s \
 --entry-point export_metric_data \
---set-env-vars PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python \
+$RETRY_FLAG \
 --service-account=$EXPORT_METRIC_SERVICE_ACCOUNT
 
 echo "Enable the Cloud Scheduler api.."
@@ -0,0 +1,237 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from google.cloud import monitoring_v3
+
+# Pipeline instrumentation. Functions decorated with @stage are timed, pagers wrapped with metered() count the pages,
+# series and points fetched per metric and record_query_job() keeps the bytes billed and slot time of BigQuery jobs.
+# Every stage and the run summary are printed as single line JSON, which Cloud Logging stores as structured
+# jsonPayload entries, and finish_run() can also write them as custom Cloud Monitoring metrics.
+
+class RunMetrics:
+
+    def __init__(self):
+        self.start = time.time()
+        # (stage, metric name) -> {"seconds", "calls", "errors"}
+        self.stages = {}
+        # metric name -> {"pages", "series", "points"}
+        self.fetches = {}
+        # One entry per BigQuery job: stage, job id, bytes billed, slot milliseconds
+        self.queries = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, metric_name, seconds, failed):
+        with self._lock:
+            entry = self.stages.setdefault((stage, metric_name), {"seconds": 0.0, "calls": 0, "errors": 0})
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+            entry["errors"] += int(failed)
+
+    def add_fetch(self, metric_name, pages, series, points):
+        with self._lock:
+            entry = self.fetches.setdefault(metric_name, {"pages": 0, "series": 0, "points": 0})
+            entry["pages"] += pages
+            entry["series"] += series
+            entry["points"] += points
+
+    def add_query(self, stage, job):
+        with self._lock:
+            self.queries.append({
+                "stage": stage,
+                "job_id": getattr(job, "job_id", None),
+                "bytes_billed": getattr(job, "total_bytes_billed", None) or 0,
+                "slot_millis": getattr(job, "slot_millis", None) or 0,
+            })
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self._lock:
+            return {
+                "run_seconds": time.time() - self.start,
+                "stages": [dict(stage=stage, metric_name=metric_name, **entry) for (stage, metric_name), entry in self.stages.items()],
+                "fetches": [dict(metric_name=metric_name, **entry) for metric_name, entry in self.fetches.items()],
+                "bigquery_bytes_billed": sum(query["bytes_billed"] for query in self.queries),
+                "bigquery_slot_millis": sum(query["slot_millis"] for query in self.queries),
+                "queries": list(self.queries),
+                **self.counters,
+            }
+
+_run = RunMetrics()
+_local = threading.local()
+
+def current_run():
+    return _run
+
+def start_run():
+    global _run
+    _run = RunMetrics()
+    return _run
+
+# Print a structured log entry
+def log(message, severity="INFO", **fields):
+    print(json.dumps(dict(severity=severity, message=message, **fields), default=str))
+
+def _metric_label(args, kwargs):
+    if "metric_name" in kwargs:
+        return kwargs["metric_name"]
+    if args and isinstance(args[0], str):
+        return args[0]
+    if args and isinstance(args[0], (list, tuple)):
+        return ", ".join(args[0])
+    return ""
+
+def _finish_stage(name, metric_name, seconds, failed):
+    _run.add_stage(name, metric_name, seconds, failed)
+    fields = {"stage": name, "metric_name": metric_name, "seconds": round(seconds, 6)}
+    fields.update(_run.fetches.get(metric_name, {}))
+    log(f"Stage {name} {'failed' if failed else 'finished'}", severity="ERROR" if failed else "INFO", **fields)
+
+# Time a pipeline stage. A metric_name keyword argument or else the first argument, a metric name or a list of
+# metric names, labels the measurement. For generators only the time spent producing items is counted, not the time
+# the consumer holds them.
+def stage(name):
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def timed_generator(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                seconds = 0.0
+                failed = False
+                try:
+                    while True:
+                        previous = getattr(_local, "stage", None)
+                        _local.stage = name
+                        start = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                        except Exception:
+                            failed = True
+                            raise
+                        finally:
+                            seconds += time.perf_counter() - start
+                            _local.stage = previous
+                        yield item
+                finally:
+                    generator.close()
+                    _finish_stage(name, _metric_label(args, kwargs), seconds, failed)
+            return timed_generator
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            previous = getattr(_local, "stage", None)
+            _local.stage = name
+            start = time.perf_counter()
+            failed = False
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                _local.stage = previous
+                _finish_stage(name, _metric_label(args, kwargs), time.perf_counter() - start, failed)
+        return timed
+    return decorator
+
+# Keep the bytes billed and slot time of a finished BigQuery job under the running stage
+def record_query_job(job):
+    _run.add_query(getattr(_local, "stage", None) or "", job)
+    return job
+
+# Wraps a list_time_series or query_time_series pager, counting every page, series and point read through it
+class MeteredPager:
+
+    def __init__(self, pager, metric_name):
+        self.pager = pager
+        self.metric_name = metric_name
+
+    @property
+    def pages(self):
+        for page in self.pager.pages:
+            if isinstance(page, monitoring_v3.ListTimeSeriesResponse):
+                time_series = monitoring_v3.ListTimeSeriesResponse.pb(page).time_series
+                points = sum(len(series.points) for series in time_series)
+            else:
+                time_series = monitoring_v3.QueryTimeSeriesResponse.pb(page).time_series_data
+                points = sum(len(data.point_data) for data in time_series)
+            _run.add_fetch(self.metric_name, 1, len(time_series), points)
+            yield page
+
+    def __iter__(self):
+        for page in self.pages:
+            if isinstance(page, monitoring_v3.ListTimeSeriesResponse):
+                yield from page.time_series
+            else:
+                yield from page.time_series_data
+
+def metered(pager, metric_name):
+    return MeteredPager(pager, metric_name if isinstance(metric_name, str) else ", ".join(metric_name))
+
+# Log the run summary and, given a MetricServiceClient, write it as custom metrics under metric_prefix
+def finish_run(project_id, metric_client=None, metric_prefix="custom.googleapis.com/metrics_exporter"):
+    summary = _run.summary()
+    log("Pipeline run finished", **summary)
+    if metric_client is None:
+        return summary
+    try:
+        write_run_metrics(metric_client, project_id, metric_prefix, summary)
+    except Exception:
+        logging.exception("Failed to write the pipeline metrics to Cloud Monitoring")
+    return summary
+
+def write_run_metrics(metric_client, project_id, metric_prefix, summary):
+    now = time.time()
+    seconds = int(now)
+    nanos = int((now - seconds) * 10 ** 9)
+
+    def series(name, value, **labels):
+        time_series = monitoring_v3.TimeSeries()
+        time_series.metric.type = f"{metric_prefix}/{name}"
+        time_series.metric.labels.update(labels)
+        time_series.resource.type = "global"
+        time_series.resource.labels["project_id"] = project_id
+        point = monitoring_v3.Point({"interval": {"end_time": {"seconds": seconds, "nanos": nanos}}, "value": {"double_value": float(value)}})
+        time_series.points = [point]
+        return time_series
+
+    time_series = [series("run_seconds", summary["run_seconds"])]
+    for entry in summary["stages"]:
+        time_series.append(series("stage_seconds", entry["seconds"], stage=entry["stage"], metric_name=entry["metric_name"]))
+    for entry in summary["fetches"]:
+        for name in ("pages", "series", "points"):
+            time_series.append(series(f"fetched_{name}", entry[name], metric_name=entry["metric_name"]))
+    stages = {query["stage"] for query in summary["queries"]}
+    for name in stages:
+        queries = [query for query in summary["queries"] if query["stage"] == name]
+        time_series.append(series("bigquery_bytes_billed", sum(query["bytes_billed"] for query in queries), stage=name))
+        time_series.append(series("bigquery_slot_millis", sum(query["slot_millis"] for query in queries), stage=name))
+    for name in ("rows_appended", "bytes_appended"):
+        if name in summary:
+            time_series.append(series(name, summary[name]))
+
+    # CreateTimeSeries accepts at most 200 time series per request
+    for start in range(0, len(time_series), 200):
+        metric_client.create_time_series(name=f"projects/{project_id}", time_series=time_series[start:start + 200])
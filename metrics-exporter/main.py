@@ -11,16 +11,32 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import datetime
 import time
+import uuid
 import config
 import logging
-import numpy as np
+import threading
+from concurrent import futures
+from google.api_core import exceptions
 from google.cloud import bigquery
 from google.cloud import bigquery_storage_v1
-from google.cloud.bigquery_storage_v1 import types
-from google.cloud.bigquery_storage_v1 import writer
-from google.protobuf import descriptor_pb2
+from google.cloud import pubsub_v1
 import metric_record_flat_pb2
+import metric_record_wide_pb2
+import recommendation_record_pb2
+import instrumentation
+from throttling import ThrottledMonitoringClient
+from sharding import Shard, plan_shards, run_started_query, shard_done_query, claim_run_query, run_built_query
+from checkpoints import RUN_UNIT, UnitCheckpoint, CheckpointLog, UnitProgress
+from storage_writer import StorageWriter, QueueWriter, commit_streams
+from row_encoding import MetricRowEncoder, WideCellEncoder, WideRecordJoiner, WideRowEncoder, stored_tstamp
+from tables import ensure_table, staging_table_spec, recommendation_table_spec, sketch_table_spec
+from recommender import recommend, recommendation_rows, select
+from change_cache import ChangeCache
+from sketch import QuantileSketch
+from percentiles import ragged_from_time_series, batch_percentiles, batch_max
+from timeseries_cache import SeriesStore, TimeSeriesCache, SERIES_LABELS
 from google.cloud import monitoring_v3
 import math
 
@@ -30,17 +46,82 @@ import math
 #
 # from the samples/snippets directory to generate the metric_record_pb2.py module.
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+# API clients are thread safe, so each kind is created once per process and shared by every fetch and write
+def get_client(client_class):
+    with _clients_lock:
+        if client_class not in _clients:
+            _clients[client_class] = client_class()
+        return _clients[client_class]
+
+# Replace the client get_client returns for client_class, e.g. with the offline stand-ins of benchmarks/harness.py
+def set_client(client_class, client):
+    with _clients_lock:
+        _clients[client_class] = client
+
+# Cloud Monitoring clients throttled per project, see throttling.py
+def get_monitoring_client(client_class):
+    client = get_client(client_class)
+    with _clients_lock:
+        key = (ThrottledMonitoringClient, client_class)
+        if key not in _clients or _clients[key].client is not client:
+            _clients[key] = ThrottledMonitoringClient(
+                client,
+                config.MONITORING_PROJECT_CONCURRENCY,
+                max_retries=config.MONITORING_QUOTA_RETRIES,
+                initial_backoff=config.MONITORING_QUOTA_BACKOFF_SECONDS,
+                max_backoff=config.MONITORING_QUOTA_MAX_BACKOFF_SECONDS,
+            )
+        return _clients[key]
+
+GKE_GROUP_BY_FIELDS = [ 'resource.label."location"','resource.label."project_id"','resource.label."cluster_name"','resource.label."controller_name"','resource.label."namespace_name"','metadata.system_labels."top_level_controller_name"','metadata.system_labels."top_level_controller_type"']
+HPA_GROUP_BY_FIELDS = ['resource.label."location"','resource.label."project_id"','resource.label."cluster_name"','resource.label."namespace_name"','metric.label."targetref_kind"','metric.label."targetref_name"']
+REDUCERS = {
+    "count": monitoring_v3.Aggregation.Reducer.REDUCE_COUNT,
+    "mean": monitoring_v3.Aggregation.Reducer.REDUCE_MEAN,
+    "sum": monitoring_v3.Aggregation.Reducer.REDUCE_SUM,
+    "max": monitoring_v3.Aggregation.Reducer.REDUCE_MAX,
+}
+
+# Cross series reducer of a gke_metric, set by the optional 4th element of its MQL_QUERY entry
+def get_reducer(metric_name, query):
+    if len(query) > 3:
+        return query[3]
+    return "count" if metric_name == "container_count" else "mean"
+
+def get_group_by_fields(metric_name):
+    return GKE_GROUP_BY_FIELDS if "hpa" not in metric_name else HPA_GROUP_BY_FIELDS
+
+# Cloud Monitoring filter of a metric type, restricted to some clusters when a shard exports them
+def get_metric_filter(metric, clusters=None):
+    metric_filter = f'metric.type = "{metric}" AND resource.label.namespace_name != "kube-system"'
+    if clusters:
+        cluster_names = ", ".join(f'"{cluster}"' for cluster in clusters)
+        metric_filter += f' AND resource.label.cluster_name = one_of({cluster_names})'
+    return metric_filter
+
+# Group the MQL_QUERY entries reading the same series into (metric names, query) fetch plans, in MQL_QUERY order
+def plan_queries(mql_query):
+    plans = {}
+    for metric_name, query in mql_query.items():
+        if query[2] == "gke_metric":
+            key = (query[0], query[1], query[2], tuple(get_group_by_fields(metric_name)))
+        else:
+            key = (metric_name,)
+        plans.setdefault(key, ([], query))[0].append(metric_name)
+    return list(plans.values())
+
 # Fetch GKE metrics - cpu requested cores, cpu limit cores, memory requested bytes, memory limit bytes, count and all workloads with hpa
-def get_gke_metrics(metric_name, metric, window):
+@instrumentation.stage("get_gke_metrics")
+def get_gke_metrics(metric_name, metric, window, reducer=None, tstamp=None, project_id=None, clusters=None):
     # [START get_gke_metrics]
-    output = []
-    client = monitoring_v3.MetricServiceClient()
-    project_name = f"projects/{config.PROJECT_ID}"
+    client = get_monitoring_client(monitoring_v3.MetricServiceClient)
+    project_name = f"projects/{project_id or config.PROJECT_ID}"
     now = time.time()
     seconds = int(now)
     nanos = int((now - seconds) * 10 ** 9)
-    gke_group_by_fields = [ 'resource.label."location"','resource.label."project_id"','resource.label."cluster_name"','resource.label."controller_name"','resource.label."namespace_name"','metadata.system_labels."top_level_controller_name"','metadata.system_labels."top_level_controller_type"']
-    hpa_group_by_fields = ['resource.label."location"','resource.label."project_id"','resource.label."cluster_name"','resource.label."namespace_name"','metric.label."targetref_kind"','metric.label."targetref_name"']
     
     interval = monitoring_v3.TimeInterval(
         {
@@ -53,65 +134,186 @@ def get_gke_metrics(metric_name, metric, window):
         {
             "alignment_period": {"seconds": window},  
             "per_series_aligner": monitoring_v3.Aggregation.Aligner.ALIGN_MEAN,
-            "cross_series_reducer": monitoring_v3.Aggregation.Reducer.REDUCE_COUNT if metric_name == "container_count" else monitoring_v3.Aggregation.Reducer.REDUCE_MEAN,
-            "group_by_fields": gke_group_by_fields if "hpa" not in metric_name else hpa_group_by_fields,
+            "cross_series_reducer": REDUCERS[reducer or get_reducer(metric_name, ())],
+            "group_by_fields": get_group_by_fields(metric_name),
         }
     )
     try:
-        results = client.list_time_series(
+        results = instrumentation.metered(client.list_time_series(
             request={
                 "name": project_name,
-                "filter": f'metric.type = "{metric}" AND resource.label.namespace_name != "kube-system"',
+                "filter": get_metric_filter(metric, clusters),
                 "interval": interval,
                 "view": monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
                 "aggregation": aggregation,
             }
-        )
+        ), metric_name)
         print("Building Row")
+        encode_row = gke_row_encoder(metric_name, tstamp or now)
+        value_field = "double_value" if "cpu" in metric_name or "memory" in metric_name else "int64_value"
         
         for result in results:
-            row = metric_record_flat_pb2.MetricFlatRecord ()
-            label = result.resource.labels
-            metadata = result.metadata.system_labels.fields
-            metricdata = result.metric.labels
-            row.metric_name = metric_name
-            row.location = label['location']
-            row.project_id = label['project_id']
-            row.cluster_name = label['cluster_name']
-            row.controller_name =  metricdata['targetref_name'] if "hpa" in metric_name else metadata['top_level_controller_name'].string_value 
-            row.controller_type= metricdata['targetref_kind'] if "hpa" in metric_name else metadata['top_level_controller_type'].string_value
-            row.namespace_name = label['namespace_name']
-            row.tstamp = time.time()
-            points = result.points
-            print(row)
-            for point in points:
-                if "cpu" in metric_name:
-                    row.points = (int(point.value.double_value * 1000)) if point.value.double_value is not None else 0
-                elif "memory" in metric_name:
-                    row.points = (int(point.value.double_value/1024/1024)) if point.value.double_value is not None else 0  
-                else:
-                    row.points = (point.value.int64_value) if point.value.int64_value is not None else 0
-                break
-            output.append(row.SerializeToString())
+            points = monitoring_v3.TimeSeries.pb(result).points
+            yield encode_row(result, getattr(points[0].value, value_field) if points else 0)
         
-    except:
-        print("No HPA workloads found")
-
-    return output
-    
+    except exceptions.NotFound:
+        # Custom metrics such as the HPA ones do not exist until something has written them
+        message = "No HPA workloads found" if "hpa" in metric_name else f"No time series found for {metric}"
+        instrumentation.log(message, severity="WARNING", metric_name=metric_name)
 
     # [END gke_get_metrics]
 
+# Fetch a metric type once for several gke_metric entries (see plan_queries) and reduce each metric locally
+@instrumentation.stage("get_gke_metrics")
+def get_gke_metrics_group(metric_names, metric, window, reducers, tstamp=None, project_id=None, clusters=None):
+    # [START get_gke_metrics_group]
+    client = get_monitoring_client(monitoring_v3.MetricServiceClient)
+    now = time.time()
+    seconds = int(now)
+    nanos = int((now - seconds) * 10 ** 9)
+    interval = monitoring_v3.TimeInterval(
+        {
+            "end_time": {"seconds": seconds, "nanos": nanos},
+            "start_time": {"seconds": (seconds - window), "nanos": nanos},
+        }
+    )
+    aggregation = monitoring_v3.Aggregation(
+        {
+            "alignment_period": {"seconds": window},
+            "per_series_aligner": monitoring_v3.Aggregation.Aligner.ALIGN_MEAN,
+        }
+    )
+    results = instrumentation.metered(client.list_time_series(
+        request={
+            "name": f"projects/{project_id or config.PROJECT_ID}",
+            "filter": get_metric_filter(metric, clusters),
+            "interval": interval,
+            "view": monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
+            "aggregation": aggregation,
+        }
+    ), metric_names)
+
+    group_by_fields = get_group_by_fields(metric_names[0])
+    groups = {}
+    for result in results:
+        if not result.points:
+            continue
+        value = result.points[0].value
+        key = tuple(get_label_value(result, field) for field in group_by_fields)
+        groups.setdefault(key, (result, []))[1].append(value.double_value or value.int64_value)
+
+    reduce_functions = {"count": len, "mean": lambda values: sum(values) / len(values), "sum": sum, "max": max}
+    encoders = [(gke_row_encoder(metric_name, tstamp or now), reduce_functions[reducer]) for metric_name, reducer in zip(metric_names, reducers)]
+    for result, values in groups.values():
+        for encode_row, reduce_function in encoders:
+            yield encode_row(result, reduce_function(values))
+    # [END get_gke_metrics_group]
+
+# Value of a group by field such as 'resource.label."location"' for a time series
+def get_label_value(result, field):
+    prefix, name = field.rsplit(".", 1)
+    name = name.strip('"')
+    if prefix == "resource.label":
+        return result.resource.labels.get(name, "")
+    if prefix == "metric.label":
+        return result.metric.labels.get(name, "")
+    fields = result.metadata.system_labels.fields
+    return fields[name].string_value if name in fields else ""
+
+# Row encoder of the fetchers, cells for the wide record format and the local recommendation engine
+def new_row_encoder(tstamp):
+    if config.RECORD_FORMAT == "wide" or use_local_engine():
+        return WideCellEncoder()
+    return MetricRowEncoder(tstamp)
+
+# Checkpointed runs always build recommendations with BigQuery, a resumed process lacks the earlier metrics
+def use_local_engine():
+    return config.RECOMMENDATION_ENGINE == "local" and not config.CHECKPOINT_RUNS
+
+# The change cache needs the local engine and the workloads of the whole run, see change_cache.py
+def use_change_cache(shard=None):
+    return config.CHANGE_DETECTION and use_local_engine() and shard is None
+
+# Build the row encoder of a GKE metric, picking the controller labels and unit conversion once per metric
+def gke_row_encoder(metric_name, tstamp):
+    encoder = new_row_encoder(tstamp)
+    if "hpa" in metric_name:
+        def controller(time_series):
+            return time_series.metric.labels['targetref_name'], time_series.metric.labels['targetref_kind']
+    else:
+        def controller(time_series):
+            metadata = time_series.metadata.system_labels.fields
+            return metadata['top_level_controller_name'].string_value, metadata['top_level_controller_type'].string_value
+    if "cpu" in metric_name:
+        convert = lambda value: int(value * 1000)
+    elif "memory" in metric_name:
+        convert = lambda value: int(value/1024/1024)
+    else:
+        convert = int
+
+    def encode_row(result, value):
+        # Read the underlying protobuf message, the proto-plus wrappers are slow to access
+        time_series = monitoring_v3.TimeSeries.pb(result)
+        label = time_series.resource.labels
+        controller_name, controller_type = controller(time_series)
+        labels = encoder.labels(label['location'], label['project_id'], label['cluster_name'], controller_name, controller_type, label['namespace_name'])
+        return encoder.row(metric_name, labels, convert(value))
+    return encode_row
+
 # Build VPA recommendations, memory: get max value over 30 days, cpu: get max and 95th percentile
-def get_vpa_recommenation_metrics(metric_name, metric, window):
+@instrumentation.stage("get_vpa_recommenation_metrics")
+def get_vpa_recommenation_metrics(metric_name, metric, window, tstamp=None, project_id=None, clusters=None, progress=None):
+    if progress is not None and progress.page_token:
+        # An earlier attempt of the run was interrupted in the middle of the raw fetch
+        yield from get_vpa_recommenation_metrics_raw(metric_name, metric, window, tstamp, project_id, clusters, progress)
+        return
+    fetchers = {
+        "aggregated": get_vpa_recommenation_metrics_aggregated,
+        "incremental": get_vpa_recommenation_metrics_incremental,
+    }
+    if config.VPA_FETCH_MODE in fetchers:
+        # Rows already handed to the writer cannot be taken back, so only fall back before the first one
+        rows_yielded = False
+        try:
+            for row in fetchers[config.VPA_FETCH_MODE](metric_name, metric, window, tstamp, project_id, clusters):
+                rows_yielded = True
+                yield row
+            return
+        except Exception:
+            if rows_yielded:
+                raise
+            logging.exception(f"{config.VPA_FETCH_MODE} fetch failed for {metric_name}, falling back to raw points")
+    if config.TIMESERIES_CACHE_DIR:
+        yield from get_vpa_recommenation_metrics_cached(metric_name, metric, window, tstamp, project_id, clusters)
+        return
+    yield from get_vpa_recommenation_metrics_raw(metric_name, metric, window, tstamp, project_id, clusters, progress)
+
+# Percentiles computed for a VPA metric: the 95th percentile for cpu plus VPA_EXTRA_PERCENTILES
+def vpa_percentiles(metric_name):
+    percentiles = [95] if "cpu" in metric_name else []
+    return percentiles + [p for p in config.VPA_EXTRA_PERCENTILES if p not in percentiles]
+
+# Serialize the VPA recommendation rows of one time series, values already scaled to millicores or MiB
+def build_vpa_rows(encoder, metric_name, label, max_value, percentile_values):
+    output = []
+    resource = "cpu" if "cpu" in metric_name else "memory"
+    labels = encoder.labels(label['location'], label['project_id'], label['cluster_name'], label['controller_name'], label['controller_kind'], label['namespace_name'])
+    for percentile, value in percentile_values.items():
+        output.append(encoder.row(f"{resource}_request_{percentile}th_percentile_recommendations", labels, value))
+    output.append(encoder.row("cpu_request_max_recommendations" if resource == "cpu" else metric_name, labels, max_value))
+    return output
+
+# Download every raw point over the window and reduce it locally, resuming from the page token of a progress
+def get_vpa_recommenation_metrics_raw(metric_name, metric, window, tstamp=None, project_id=None, clusters=None, progress=None):
 
-    # [START get_vpa_recommenation_metrics]
-    from google.cloud import monitoring_v3
-    client = monitoring_v3.MetricServiceClient()
-    project_name = f"projects/{config.PROJECT_ID}"
-    interval = monitoring_v3.TimeInterval()
+    # [START get_vpa_recommenation_metrics_raw]
+    client = get_monitoring_client(monitoring_v3.MetricServiceClient)
+    project_name = f"projects/{project_id or config.PROJECT_ID}"
 
     now = time.time()
+    if progress is not None:
+        now = progress.request_time or now
+        progress.request_time = now
     seconds = int(now)
     nanos = int((now - seconds) * 10 ** 9)
     
@@ -122,161 +324,581 @@ def get_vpa_recommenation_metrics(metric_name, metric, window):
         }
     )
     
-    results = client.list_time_series(
+    request = {
+        "name": project_name,
+        "filter": get_metric_filter(metric, clusters),
+        "interval": interval,
+        "view": monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
+    }
+    if progress is not None and progress.page_token:
+        print(f"Resuming {metric_name} of {project_name} from a checkpoint")
+        request["page_token"] = progress.page_token
+    results = instrumentation.metered(client.list_time_series(request=request), metric_name)
+    percentiles = vpa_percentiles(metric_name)
+    encoder = new_row_encoder(tstamp or now)
+
+    # Reduce every series of a page at once from a single flat buffer of points, only one page is held in memory
+    for page in results.pages:
+        time_series = page.time_series
+        values, offsets = ragged_from_time_series(time_series)
+        percentile_values = batch_percentiles(values, offsets, percentiles)
+        max_values = batch_max(values, offsets)
+        for i, result in enumerate(time_series):
+            if offsets[i] == offsets[i + 1]:
+                continue
+            percentile_value = {percentile: int(percentile_values[j, i]) for j, percentile in enumerate(percentiles)}
+            yield from build_vpa_rows(encoder, metric_name, monitoring_v3.TimeSeries.pb(result).resource.labels, int(max_values[i]), percentile_value)
+        if progress is not None:
+            progress.page_done(page.next_page_token)
+    # [END get_vpa_recommenation_metrics_raw]
+
+# Raw fetch through the local columnar cache of TIMESERIES_CACHE_DIR, see timeseries_cache.py
+def get_vpa_recommenation_metrics_cached(metric_name, metric, window, tstamp=None, project_id=None, clusters=None):
+
+    # [START get_vpa_recommenation_metrics_cached]
+    cache = TimeSeriesCache(config.TIMESERIES_CACHE_DIR)
+    scope = project_id or config.PROJECT_ID
+    now = int(time.time())
+    start = now - window
+    stored = cache.load(scope, metric_name, clusters)
+    fetch_from = start
+    if stored.end is not None and stored.start <= start < stored.end:
+        # Points reach Cloud Monitoring late, the last minutes of the cache are fetched again
+        fetch_from = max(start, stored.end - config.TIMESERIES_CACHE_OVERLAP_SECONDS)
+    print(f"{metric_name} ({scope}): {stored.values.size} points cached, fetching the last {now - fetch_from}s")
+
+    client = get_monitoring_client(monitoring_v3.MetricServiceClient)
+    interval = monitoring_v3.TimeInterval(
+        {
+            "end_time": {"seconds": now},
+            "start_time": {"seconds": fetch_from},
+        }
+    )
+    results = instrumentation.metered(client.list_time_series(
         request={
-            "name": project_name,
-            "filter": f'metric.type = "{metric}" AND resource.label.namespace_name != "kube-system"',
+            "name": f"projects/{scope}",
+            "filter": get_metric_filter(metric, clusters),
             "interval": interval,
             "view": monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
         }
+    ), metric_name)
+    pages = [SeriesStore.from_time_series(page.time_series, fetch_from, now) for page in results.pages]
+    store = SeriesStore.combine([stored] + pages, start)
+    store.end = now
+    cache.save(store, scope, metric_name, clusters)
+
+    percentiles = vpa_percentiles(metric_name)
+    percentile_values = batch_percentiles(store.values, store.offsets, percentiles)
+    max_values = batch_max(store.values, store.offsets)
+    encoder = new_row_encoder(tstamp or now)
+    for i, labels in enumerate(store.labels):
+        percentile_value = {percentile: int(percentile_values[j, i]) for j, percentile in enumerate(percentiles)}
+        yield from build_vpa_rows(encoder, metric_name, dict(zip(SERIES_LABELS, labels)), int(max_values[i]), percentile_value)
+    # [END get_vpa_recommenation_metrics_cached]
+
+# Let Cloud Monitoring reduce the window to percentiles and a max per time series with an MQL query
+def get_vpa_recommenation_metrics_aggregated(metric_name, metric, window, tstamp=None, project_id=None, clusters=None):
+
+    # [START get_vpa_recommenation_metrics_aggregated]
+    client = get_monitoring_client(monitoring_v3.QueryServiceClient)
+    project_name = f"projects/{project_id or config.PROJECT_ID}"
+    percentiles = vpa_percentiles(metric_name)
+    reducers = ", ".join([f"percentile_{p}: percentile(val(), {p})" for p in percentiles] + ["max: max(val())"])
+    cluster_filter = " && resource.cluster_name =~ '{}'".format("|".join(clusters)) if clusters else ""
+    query = f"""fetch k8s_scale
+        | metric '{metric}'
+        | filter resource.namespace_name != 'kube-system'{cluster_filter}
+        | group_by {window}s, [{reducers}]
+        | every {window}s
+        | within {window}s"""
+
+    results = instrumentation.metered(client.query_time_series(request={"name": project_name, "query": query}), metric_name)
+    encoder = new_row_encoder(tstamp or time.time())
+
+    for page in results.pages:
+        label_keys = [descriptor.key for descriptor in page.time_series_descriptor.label_descriptors]
+        value_keys = [descriptor.key for descriptor in page.time_series_descriptor.point_descriptors]
+        for data in page.time_series_data:
+            if not data.point_data:
+                continue
+            label = {key.split(".", 1)[-1]: value.string_value for key, value in zip(label_keys, data.label_values)}
+            # Points are returned newest first, the first point covers the whole window
+            values = {key: value.double_value or value.int64_value for key, value in zip(value_keys, data.point_data[0].values)}
+            scale = (lambda value: int(value * 1000)) if "cpu" in metric_name else (lambda value: int(value/1024/1024))
+            percentile_value = {p: scale(values[f"percentile_{p}"]) for p in percentiles}
+            yield from build_vpa_rows(encoder, metric_name, label, scale(values["max"]), percentile_value)
+    # [END get_vpa_recommenation_metrics_aggregated]
+
+
+SECONDS_PER_DAY = 86400
+SKETCH_LABELS = ['location', 'project_id', 'cluster_name', 'namespace_name', 'controller_name', 'controller_kind', 'container_name']
+
+# Reduce the window from daily quantile sketches kept in SKETCH_TABLE, only downloading the days not stored yet
+def get_vpa_recommenation_metrics_incremental(metric_name, metric, window, tstamp=None, project_id=None, clusters=None):
+
+    # [START get_vpa_recommenation_metrics_incremental]
+    bq_client = get_client(bigquery.Client)
+    table_id = f'{config.PROJECT_ID}.{config.BIGQUERY_DATASET}.{config.SKETCH_TABLE}'
+    scope = project_id or config.PROJECT_ID
+    now = time.time()
+    today = int(now // SECONDS_PER_DAY)
+    # The window is widened to whole days: it starts at the beginning of the day of now - window
+    first_day = int((now - window) // SECONDS_PER_DAY)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("metric_name", "STRING", metric_name),
+            bigquery.ScalarQueryParameter("scope", "STRING", scope),
+            bigquery.ScalarQueryParameter("first_day", "INT64", first_day),
+            bigquery.ArrayQueryParameter("clusters", "STRING", clusters or []),
+        ]
     )
-    output = []
-    
+    # A shard only reads the sketches of its own clusters
+    cluster_condition = " AND cluster_name IN UNNEST(@clusters)" if clusters else ""
+
+    stored = {}
+    select_job = bq_client.query(f"SELECT * FROM `{table_id}` WHERE metric_name = @metric_name AND scope = @scope AND day >= @first_day{cluster_condition}", job_config=job_config)
+    for row in select_job.result():
+        key = tuple(row[label] for label in SKETCH_LABELS)
+        stored.setdefault(key, {})[row['day']] = QuantileSketch.from_json(row['sketch'])
+    instrumentation.record_query_job(select_job)
+    stored_days = {day for days in stored.values() for day in days}
+    missing_days = [day for day in range(first_day, today) if day not in stored_days]
+    fetch_from_day = missing_days[0] if missing_days else today
+    print(f"{metric_name} ({scope}): {len(stored_days)} days stored, fetching from day {fetch_from_day}")
+
+    client = get_monitoring_client(monitoring_v3.MetricServiceClient)
+    interval = monitoring_v3.TimeInterval(
+        {
+            "end_time": {"seconds": int(now)},
+            "start_time": {"seconds": fetch_from_day * SECONDS_PER_DAY},
+        }
+    )
+    results = instrumentation.metered(client.list_time_series(
+        request={
+            "name": f"projects/{scope}",
+            "filter": get_metric_filter(metric, clusters),
+            "interval": interval,
+            "view": monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
+        }
+    ), metric_name)
+    fetched = {}
     for result in results:
-        points_array = []
-        row = metric_record_flat_pb2.MetricFlatRecord ()
-        label = result.resource.labels
-        row.location = label['location']
-        row.project_id = label['project_id']
-        row.cluster_name = label['cluster_name']
-        row.controller_name = label['controller_name']
-        row.controller_type= label['controller_kind']
-        row.namespace_name = label['namespace_name']
-        row.tstamp = time.time()
+        key = tuple(result.resource.labels[label] for label in SKETCH_LABELS)
+        points_by_day = {}
         for point in result.points:
+            day = int(point.interval.end_time.timestamp() // SECONDS_PER_DAY)
             if((point.value.double_value) != 0):
-                points_array.append(int(point.value.double_value * 1000))
+                points_by_day.setdefault(day, []).append(int(point.value.double_value * 1000))
             else:
-                points_array.append(int(point.value.int64_value/1024/1024)) 
-        if "cpu" in metric_name :
-            row.metric_name = "cpu_request_95th_percentile_recommendations"
-            row.points = int(np.percentile(points_array, 95))
-            output.append(row.SerializeToString())
-            row.metric_name = "cpu_request_max_recommendations"
-            row.points = (max(points_array))
-            output.append(row.SerializeToString())
-        else:
-            row.metric_name = metric_name
-            row.points = (max(points_array))
-            output.append(row.SerializeToString())
-        
-    return output
-    # [END get_vpa_recommenation_metrics]   
- 
+                points_by_day.setdefault(day, []).append(int(point.value.int64_value/1024/1024))
+        days = fetched.setdefault(key, {})
+        for day, points_array in points_by_day.items():
+            days.setdefault(day, QuantileSketch(config.SKETCH_RELATIVE_ACCURACY)).add(points_array)
 
-# Write rows to BigQuery    
-def append_rows_proto(rows):
+    new_rows = [
+        dict(zip(SKETCH_LABELS, key), metric_name=metric_name, scope=scope, day=day, sketch=sketch.to_json())
+        for key, days in fetched.items() for day, sketch in days.items() if day in missing_days
+    ]
+    if new_rows:
+        bq_client.load_table_from_json(new_rows, table_id).result()
 
-    """Create a write stream, write some sample data, and commit the stream."""
-    write_client = bigquery_storage_v1.BigQueryWriteClient()
-    parent = write_client.table_path(config.PROJECT_ID, config.BIGQUERY_DATASET, config.BIGQUERY_TABLE)
-    write_stream = types.WriteStream()
-    
-    # When creating the stream, choose the type. Use the PENDING type to wait
-    # until the stream is committed before it is visible. See:
-    # https://cloud.google.com/bigquery/docs/reference/storage/rpc/google.cloud.bigquery.storage.v1#google.cloud.bigquery.storage.v1.WriteStream.Type
-    write_stream.type_ = types.WriteStream.Type.PENDING
-    write_stream = write_client.create_write_stream(
-        parent=parent, write_stream=write_stream
-    )
-    stream_name = write_stream.name
-
-    # Create a template with fields needed for the first request.
-    request_template = types.AppendRowsRequest()
-
-    # The initial request must contain the stream name.
-    request_template.write_stream = stream_name
-
-    # So that BigQuery knows how to parse the serialized_rows, generate a
-    # protocol buffer representation of your message descriptor.
-    proto_schema = types.ProtoSchema()
-    proto_descriptor = descriptor_pb2.DescriptorProto()
-    metric_record_flat_pb2.MetricFlatRecord.DESCRIPTOR.CopyToProto(proto_descriptor)
-    proto_schema.proto_descriptor = proto_descriptor
-    proto_data = types.AppendRowsRequest.ProtoData()
-    proto_data.writer_schema = proto_schema
-    request_template.proto_rows = proto_data
-    
-    # Some stream types support an unbounded number of requests. Construct an
-    # AppendRowsStream to send an arbitrary number of requests to a stream.
-    append_rows_stream = writer.AppendRowsStream(write_client, request_template)
-
-    # Create a batch of row data by appending proto2 serialized bytes to the
-    # serialized_rows repeated field.
-    proto_rows = types.ProtoRows()
-    for row in rows:
-        proto_rows.serialized_rows.append(row)
-    request = types.AppendRowsRequest()
-    request.offset = 0
-    proto_data = types.AppendRowsRequest.ProtoData()
-    proto_data.rows = proto_rows
-    request.proto_rows = proto_data
-
-    append_rows_stream.send(request)
-
-    # Shutdown background threads and close the streaming connection.
-    append_rows_stream.close()
-
-    # A PENDING type stream must be "finalized" before being committed. No new
-    # records can be written to the stream after this method has been called.
-    write_client.finalize_write_stream(name=write_stream.name)
-
-    # Commit the stream you created earlier.
-    batch_commit_write_streams_request = types.BatchCommitWriteStreamsRequest()
-    batch_commit_write_streams_request.parent = parent
-    batch_commit_write_streams_request.write_streams = [write_stream.name]
-    write_client.batch_commit_write_streams(batch_commit_write_streams_request)
-
-    print(f"Writes to stream: '{write_stream.name}' have been committed.")
-
-# Purge all data from metrics table. mql_metrics table is used as a staging table and must be purged to avoid duplicate metrics                
-def purge_raw_metric_data():
-    t = time.time() - 5400
-    client = bigquery.Client()   
-    metric_table_id = f'{config.PROJECT_ID}.{config.BIGQUERY_DATASET}.{config.BIGQUERY_TABLE}'
-
-    purge_raw_metric_query_job=client.query(
-        f"""DELETE `{metric_table_id}` WHERE TRUE AND tstamp < {t}
-        """
+    encoder = new_row_encoder(tstamp or now)
+    for key in stored.keys() | fetched.keys():
+        merged = QuantileSketch(config.SKETCH_RELATIVE_ACCURACY)
+        for day, sketch in stored.get(key, {}).items():
+            if day < fetch_from_day:
+                merged.merge(sketch)
+        for sketch in fetched.get(key, {}).values():
+            merged.merge(sketch)
+        if merged.count == 0:
+            continue
+        percentile_value = {p: int(merged.quantile(p / 100)) for p in vpa_percentiles(metric_name)}
+        yield from build_vpa_rows(encoder, metric_name, dict(zip(SKETCH_LABELS, key)), int(merged.max), percentile_value)
+    # [END get_vpa_recommenation_metrics_incremental]
+
+
+# Staging table of the RECORD_FORMAT rows
+def staging_table():
+    return config.WIDE_TABLE if config.RECORD_FORMAT == "wide" else config.BIGQUERY_TABLE
+
+# Open the BigQuery writer shared by every metric of a pipeline run
+def open_stream_writer(stream_type=None):
+    write_client = get_client(bigquery_storage_v1.BigQueryWriteClient)
+    parent = write_client.table_path(config.PROJECT_ID, config.BIGQUERY_DATASET, staging_table())
+    message = metric_record_wide_pb2.MetricWideRecord if config.RECORD_FORMAT == "wide" else metric_record_flat_pb2.MetricFlatRecord
+    return StorageWriter(
+        write_client,
+        parent,
+        message.DESCRIPTOR,
+        stream_type=stream_type or config.BIGQUERY_WRITE_STREAM_TYPE,
+        max_request_bytes=config.APPEND_ROWS_MAX_BYTES,
+        max_inflight=config.APPEND_ROWS_MAX_INFLIGHT,
+        max_retries=config.APPEND_ROWS_MAX_RETRIES,
     )
-    print("Raw metric data purged from  {}".format(metric_table_id))
-    purge_raw_metric_query_job.result()
 
-# Use recommendation.sql to build vpa container recommendations    
-def build_recommenation_table():
+# Write rows to BigQuery, consuming them in batches handed to the queue writer or UnitProgress
+@instrumentation.stage("append_rows_proto")
+def append_rows_proto(rows, queue_writer, metric_name=""):
+    count = queue_writer.write(rows)
+    instrumentation.current_run().add(rows_queued=count)
+    print(f"Queued {count} rows for {metric_name}")
+
+_tables_ready = set()
+
+# Create the staging table of RECORD_FORMAT and the recommendation table if they do not exist, once per process
+@instrumentation.stage("ensure_tables")
+def ensure_tables():
+    tables = {
+        staging_table(): staging_table_spec("bigquery_wide_schema.json" if config.RECORD_FORMAT == "wide" else "bigquery_schema.json", config.STAGING_PARTITION_EXPIRATION_HOURS),
+        config.RECOMMENDATION_TABLE: recommendation_table_spec("bigquery_recommendation_schema.json"),
+    }
+    if use_change_cache():
+        tables[config.CHANGE_CACHE_TABLE] = {"schema_file": "bigquery_change_cache_schema.json"}
+    if config.VPA_FETCH_MODE == "incremental":
+        tables[config.SKETCH_TABLE] = sketch_table_spec("bigquery_sketch_schema.json", config.RECOMMENDATION_WINDOW_SECONDS)
+    client = get_client(bigquery.Client)
+    for table, spec in tables.items():
+        table_id = f'{config.PROJECT_ID}.{config.BIGQUERY_DATASET}.{table}'
+        if table_id not in _tables_ready:
+            ensure_table(client, table_id, **spec)
+            _tables_ready.add(table_id)
+
+# Build the recommendations of the run started at tstamp with one MERGE of recommendation.sql or recommendation-wide.sql
+@instrumentation.stage("build_recommenation_table")
+def build_recommenation_table(tstamp):
     """ Create recommenations table in BigQuery
     """
-    client = bigquery.Client()
+    client = get_client(bigquery.Client)
+    table_id = f'{config.PROJECT_ID}.{config.BIGQUERY_DATASET}.{config.RECOMMENDATION_TABLE}'
 
+    with open('./recommendation-wide.sql' if config.RECORD_FORMAT == "wide" else './recommendation.sql','r') as file:
+        sql = file.read()
+    # Rows store the run timestamp as a 32-bit float, the parameter is rounded the same way
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("tstamp", "FLOAT64", stored_tstamp(tstamp))])
 
+    # Start the query, passing in the recommendation query.
+    query_job = client.query(sql, job_config=job_config)  # Make an API request.
+    query_job.result()  # Wait for the job to complete.
+    instrumentation.record_query_job(query_job)
+    print("Query results loaded to the table {}".format(table_id))
+
+# Compute the recommendations of the joined workloads in process and write the changed ones to the recommendation table
+@instrumentation.stage("write_recommendations")
+def write_recommendations(records, tstamp, change_cache=None):
+    labels, result = recommend(records)
+    if change_cache is not None:
+        labels, result = select(labels, result, change_cache.changed)
+    if not labels:
+        print("No recommendations to write")
+        return
+    write_client = get_client(bigquery_storage_v1.BigQueryWriteClient)
+    parent = write_client.table_path(config.PROJECT_ID, config.BIGQUERY_DATASET, config.RECOMMENDATION_TABLE)
+    stream_writer = StorageWriter(
+        write_client,
+        parent,
+        recommendation_record_pb2.RecommendationRecord.DESCRIPTOR,
+        stream_type="pending",
+        max_request_bytes=config.APPEND_ROWS_MAX_BYTES,
+        max_inflight=config.APPEND_ROWS_MAX_INFLIGHT,
+        max_retries=config.APPEND_ROWS_MAX_RETRIES,
+    )
+    try:
+        stream_writer.append(list(recommendation_rows(labels, result, stored_tstamp(tstamp))))
+        stream_writer.commit()
+    finally:
+        stream_writer.abort()
+    instrumentation.current_run().add(recommendations_written=len(labels))
+
+# Clear the latest flag of the recommendations older than the run, or only of the workloads with workload_keys
+@instrumentation.stage("retire_recommendations")
+def retire_recommendations(tstamp, workload_keys=None):
+    client = get_client(bigquery.Client)
     table_id = f'{config.PROJECT_ID}.{config.BIGQUERY_DATASET}.{config.RECOMMENDATION_TABLE}'
-    
-    update_query = f"""UPDATE `{table_id}`
+    parameters = [bigquery.ScalarQueryParameter("tstamp", "FLOAT64", stored_tstamp(tstamp))]
+    workload_filter = ""
+    if workload_keys is not None:
+        parameters.append(bigquery.ArrayQueryParameter("workload_keys", "STRING", workload_keys))
+        workload_filter = """AND ARRAY_TO_STRING([IFNULL(location, ""), IFNULL(project_id, ""), IFNULL(cluster_name, ""),
+            IFNULL(controller_name, ""), IFNULL(controller_type, ""), IFNULL(namespace_name, "")], "/") IN UNNEST(@workload_keys)"""
+    query_job = client.query(f"""UPDATE `{table_id}`
         SET latest = FALSE
-        WHERE latest = TRUE"""
-    query_job = client.query(update_query)
+        WHERE latest AND recommendation_timestamp < TIMESTAMP_SECONDS(CAST(@tstamp AS INT64)) {workload_filter}""", job_config=bigquery.QueryJobConfig(query_parameters=parameters))
     query_job.result()
+    instrumentation.record_query_job(query_job)
 
-    with open('./recommendation.sql','r') as file:
-        sql = file.read()
-    print("Query results loaded to the table {}".format(table_id))
-        
-    # Start the query, passing in the recommendation query.
-    query_job = client.query(sql)  # Make an API request.
-    query_job.result()  # Wait for the job to complete.
-    purge_raw_metric_data()
+# Build the recommendations of the run with BigQuery, or retire the ones replaced by the local engine
+def finish_recommendations(tstamp, local, change_cache=None):
+    if not local:
+        build_recommenation_table(tstamp)
+    elif change_cache is None or change_cache.snapshot:
+        retire_recommendations(tstamp)
+    elif change_cache.retired_keys:
+        retire_recommendations(tstamp, change_cache.retired_keys)
 
-def run_pipeline():    
-    for metric, query in config.MQL_QUERY.items():
-        if query[2] == "gke_metric":
-            print(f"Processing GKE system metric {metric}")
-            append_rows_proto(get_gke_metrics(metric, query[0], query[1]))
+# Fetch the metrics of one query plan of a project from Cloud Monitoring and write them to BigQuery
+def process_query_plan(metric_names, query, queue_writer, tstamp=None, project_id=None, clusters=None, progress=None):
+    if len(metric_names) > 1:
+        print(f"Processing GKE system metrics {', '.join(metric_names)} of {project_id or config.PROJECT_ID} from a single fetch")
+        reducers = [get_reducer(metric, config.MQL_QUERY[metric]) for metric in metric_names]
+        append_rows_proto(get_gke_metrics_group(metric_names, query[0], query[1], reducers, tstamp, project_id, clusters), queue_writer, metric_name=", ".join(metric_names))
+    else:
+        process_metric(metric_names[0], query, queue_writer, tstamp, project_id, clusters, progress)
+
+# Fetch a single MQL_QUERY metric of a project from Cloud Monitoring and write it to BigQuery
+def process_metric(metric, query, queue_writer, tstamp=None, project_id=None, clusters=None, progress=None):
+    if query[2] == "gke_metric":
+        print(f"Processing GKE system metric {metric} of {project_id or config.PROJECT_ID}")
+        append_rows_proto(get_gke_metrics(metric, query[0], query[1], get_reducer(metric, query), tstamp, project_id, clusters), queue_writer, metric_name=metric)
+    else:
+        print(f"Processing VPA recommendation metric {metric} of {project_id or config.PROJECT_ID}")
+        append_rows_proto(get_vpa_recommenation_metrics(metric, query[0], query[1], tstamp, project_id, clusters, progress), queue_writer, metric_name=metric)
+
+# Export every monitored project, or the clusters of a shard, and build the recommendation table
+def run_pipeline(shard=None, run_id=None):
+    # Stages are timed while the run goes and summarized once it ends, even when it fails, see instrumentation.py
+    instrumentation.start_run()
+    try:
+        ensure_tables()
+        if shard is None:
+            project_ids, tstamp, clusters = config.MONITORED_PROJECTS, time.time(), None
         else:
-            print(f"Processing VPA recommendation metric {metric}")
-            append_rows_proto(get_vpa_recommenation_metrics(metric, query[0], query[1]))
-    build_recommenation_table()
-   
-    
+            print(f"Exporting {shard}")
+            project_ids, tstamp, clusters = [shard.project_id], shard.tstamp, shard.clusters
+            run_id = f"{shard.run_id}-{shard.shard}"
+        checkpoint_log = None
+        run_checkpoint = UnitCheckpoint(RUN_UNIT, "started", request_time=tstamp)
+        if config.CHECKPOINT_RUNS:
+            checkpoint_log = open_checkpoint_log(run_id or uuid.uuid4().hex)
+            if RUN_UNIT in checkpoint_log.checkpoints:
+                run_checkpoint = checkpoint_log.checkpoints[RUN_UNIT]
+                print(f"Resuming run {checkpoint_log.run_id}, {run_checkpoint.status}")
+            else:
+                checkpoint_log.save(run_checkpoint)
+            # Rows written by every attempt of the run carry the timestamp of the first one
+            tstamp = run_checkpoint.request_time
+        if run_checkpoint.status == "finished":
+            return
+        change_cache = open_change_cache() if use_change_cache(shard) else None
+        records, failed = None, []
+        if run_checkpoint.status != "committed":
+            records, failed = export_run(project_ids, tstamp, clusters, checkpoint_log, change_cache)
+        if failed:
+            # Recommendations built without a metric would retire the latest ones of every workload it misses
+            instrumentation.log("Run failed, recommendations not built", severity="ERROR", metrics_failed=sorted(failed))
+            raise RuntimeError(f"Metrics not exported in this run: {', '.join(sorted(failed))}")
+        local = use_local_engine()
+        if local:
+            # A shard writes the recommendations of its own clusters
+            write_recommendations(records, tstamp, change_cache)
+        if shard is None:
+            finish_recommendations(tstamp, local, change_cache)
+        elif finish_shard(shard):
+            print(f"All shards of run {shard.run_id} are done, building the recommendation table")
+            finish_recommendations(tstamp, local)
+            mark_run_built(shard)
+        if change_cache is not None:
+            # Saved last, a failed run is compared to the cache of the run before it and rewrites what it changed
+            save_change_cache(change_cache)
+        if checkpoint_log is not None:
+            checkpoint_log.save(UnitCheckpoint(RUN_UNIT, "finished", request_time=tstamp))
+    finally:
+        metric_client = get_client(monitoring_v3.MetricServiceClient) if config.PIPELINE_METRICS_EXPORT else None
+        instrumentation.finish_run(config.PROJECT_ID, metric_client, config.PIPELINE_METRICS_PREFIX)
+
+# Open the change cache and load its entries
+@instrumentation.stage("load_change_cache")
+def open_change_cache():
+    table_id = f'{config.PROJECT_ID}.{config.BIGQUERY_DATASET}.{config.CHANGE_CACHE_TABLE}'
+    change_cache = ChangeCache(get_client(bigquery.Client), table_id, config.CHANGE_CACHE_TTL_HOURS * 3600, config.CHANGE_SNAPSHOT_INTERVAL_HOURS * 3600)
+    change_cache.load()
+    return change_cache
+
+@instrumentation.stage("save_change_cache")
+def save_change_cache(change_cache):
+    change_cache.save()
+
+# Open the checkpoint log of a run and load its checkpoints
+@instrumentation.stage("load_checkpoints")
+def open_checkpoint_log(run_id):
+    table_id = f'{config.PROJECT_ID}.{config.BIGQUERY_DATASET}.{config.CHECKPOINT_TABLE}'
+    checkpoint_log = CheckpointLog(get_client(bigquery.Client), table_id, run_id)
+    checkpoint_log.load()
+    return checkpoint_log
+
+# Fetch the metrics of project_ids, or of some of their clusters, and write them to BigQuery. Returns the joined workloads and the failed metrics.
+def export_run(project_ids, tstamp, clusters=None, checkpoint_log=None, change_cache=None):
+    failed = []
+    if checkpoint_log is None:
+        stream_writer = open_stream_writer()
+        queue_writer = QueueWriter(stream_writer, batch_rows=config.WRITE_BATCH_ROWS, max_batches=config.WRITE_QUEUE_BATCHES)
+        writer = WideRecordJoiner() if config.RECORD_FORMAT == "wide" or use_local_engine() else queue_writer
+        def process_unit(metric_names, query, project_id):
+            process_query_plan(metric_names, query, writer, tstamp, project_id, clusters)
+    else:
+        def process_unit(metric_names, query, project_id):
+            process_checkpointed_unit(checkpoint_log, metric_names, query, tstamp, project_id, clusters)
+    try:
+        with futures.ThreadPoolExecutor(max_workers=config.PIPELINE_WORKERS) as executor:
+            pending = {
+                executor.submit(process_unit, metric_names, query, project_id): (metric_names, project_id)
+                for metric_names, query in plan_queries(config.MQL_QUERY) for project_id in project_ids
+            }
+            for future in futures.as_completed(pending):
+                metric_names, project_id = pending[future]
+                try:
+                    future.result()
+                except Exception:
+                    logging.exception(f"Failed to process metrics {', '.join(metric_names)} of {project_id}")
+                    failed.extend(f"{metric_name} ({project_id})" for metric_name in metric_names)
+        instrumentation.current_run().add(metrics_failed=len(failed))
+        if checkpoint_log is None and failed:
+            # The stream is aborted uncommitted, a retry of the run writes every row again
+            return None, failed
+        if checkpoint_log is None:
+            only = None
+            if change_cache is not None:
+                change_cache.update(writer.records, tstamp)
+                only = change_cache.changed
+            if config.RECORD_FORMAT == "wide":
+                queue_writer.write(writer.rows(WideRowEncoder(tstamp), only))
+            elif writer is not queue_writer:
+                queue_writer.write(writer.flat_rows(MetricRowEncoder(tstamp), only))
+            queue_writer.close()
+            stream_writer.commit()
+            instrumentation.current_run().add(rows_appended=stream_writer.rows_appended, bytes_appended=stream_writer.bytes_appended)
+            return (writer.records if use_local_engine() else None), failed
+    finally:
+        if checkpoint_log is None:
+            # No-ops once the rows are committed, a failed run stops the writer thread and closes its connection
+            queue_writer.abort()
+            stream_writer.abort()
+    if failed:
+        # The streams of the units that are done stay uncommitted, a retry of the run skips them
+        return None, failed
+    streams = [name for checkpoint in checkpoint_log.checkpoints.values() if checkpoint.status == "done" for name in checkpoint.streams]
+    if streams:
+        write_client = get_client(bigquery_storage_v1.BigQueryWriteClient)
+        parent = write_client.table_path(config.PROJECT_ID, config.BIGQUERY_DATASET, staging_table())
+        commit_streams(write_client, parent, streams)
+    print(f"Committed {len(streams)} streams of run {checkpoint_log.run_id}")
+    checkpoint_log.save(UnitCheckpoint(RUN_UNIT, "committed", request_time=tstamp))
+    return None, failed
+
+# Export one (project, query plan) unit of a checkpointed run, unless an earlier attempt of the run did
+def process_checkpointed_unit(checkpoint_log, metric_names, query, tstamp, project_id, clusters):
+    unit = f"{project_id}|{','.join(metric_names)}"
+    checkpoint = checkpoint_log.checkpoints.get(unit) or UnitCheckpoint(unit)
+    if checkpoint.status == "done":
+        print(f"Skipping {', '.join(metric_names)} of {project_id}, done by an earlier attempt of the run")
+        return
+    progress = UnitProgress(checkpoint, checkpoint_log, lambda: open_stream_writer("pending"), batch_rows=config.WRITE_BATCH_ROWS, interval_seconds=config.CHECKPOINT_INTERVAL_SECONDS)
+    try:
+        if config.RECORD_FORMAT == "wide":
+            joiner = WideRecordJoiner()
+            process_query_plan(metric_names, query, joiner, tstamp, project_id, clusters)
+            progress.write(joiner.rows(WideRowEncoder(tstamp)))
+        else:
+            process_query_plan(metric_names, query, progress, tstamp, project_id, clusters, progress)
+        progress.done()
+    finally:
+        progress.abort()
+
+# Clusters of a project with data for any MQL_QUERY metric over its window, one series per cluster
+def list_clusters(project_id):
+    client = get_monitoring_client(monitoring_v3.MetricServiceClient)
+    clusters = set()
+    now = int(time.time())
+    for metric, window in {(query[0], query[1]) for query in config.MQL_QUERY.values()}:
+        results = client.list_time_series(
+            request={
+                "name": f"projects/{project_id}",
+                "filter": get_metric_filter(metric),
+                "interval": monitoring_v3.TimeInterval({"end_time": {"seconds": now}, "start_time": {"seconds": now - window}}),
+                "view": monitoring_v3.ListTimeSeriesRequest.TimeSeriesView.FULL,
+                "aggregation": monitoring_v3.Aggregation(
+                    {
+                        "alignment_period": {"seconds": window},
+                        "per_series_aligner": monitoring_v3.Aggregation.Aligner.ALIGN_MEAN,
+                        "cross_series_reducer": monitoring_v3.Aggregation.Reducer.REDUCE_COUNT,
+                        "group_by_fields": ['resource.label."cluster_name"'],
+                    }
+                ),
+            }
+        )
+        try:
+            clusters.update(result.resource.labels["cluster_name"] for result in results)
+        except exceptions.NotFound:
+            continue
+    return clusters
+
+# Coordinator of a sharded run: publish one message per shard of at most SHARD_CLUSTERS clusters
+def coordinate_run():
+    tstamp = time.time()
+    run_id = f"{int(tstamp)}-{uuid.uuid4().hex[:8]}"
+    clusters_by_project = {project_id: list_clusters(project_id) for project_id in config.MONITORED_PROJECTS}
+    shards = plan_shards(run_id, clusters_by_project, config.SHARD_CLUSTERS, tstamp)
+    if not shards:
+        print("No clusters found, nothing to export")
+        return shards
+    client = get_client(bigquery.Client)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("run_id", "STRING", run_id),
+            bigquery.ScalarQueryParameter("shard_count", "INT64", len(shards)),
+        ]
+    )
+    started_job = client.query(run_started_query(shard_table()), job_config=job_config)
+    started_job.result()
+    instrumentation.record_query_job(started_job)
+    publisher = get_client(pubsub_v1.PublisherClient)
+    topic_path = publisher.topic_path(config.PROJECT_ID, config.PUBSUB_TOPIC)
+    for publish_future in [publisher.publish(topic_path, shard.data(), **shard.attributes()) for shard in shards]:
+        publish_future.result()
+    print(f"Published {len(shards)} shards of run {run_id} to {topic_path}")
+    return shards
+
+SHARD_CLAIM_RETRIES = 5
+
+def shard_table():
+    return f'{config.PROJECT_ID}.{config.BIGQUERY_DATASET}.{config.SHARD_TABLE}'
+
+# Run a statement on the shard table, again when it conflicts with another worker updating the run row
+def run_shard_query(sql, shard):
+    client = get_client(bigquery.Client)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("run_id", "STRING", shard.run_id),
+            bigquery.ScalarQueryParameter("shard", "INT64", shard.shard),
+            bigquery.ScalarQueryParameter("shard_count", "INT64", shard.shard_count),
+        ]
+    )
+    for attempt in range(SHARD_CLAIM_RETRIES + 1):
+        try:
+            query_job = client.query(sql, job_config=job_config)
+            query_job.result()
+            break
+        except exceptions.BadRequest as error:
+            # BigQuery aborts one of two UPDATEs racing on the run row, the retry then finds it claimed
+            if "concurrent update" not in str(error) or attempt == SHARD_CLAIM_RETRIES:
+                raise
+            logging.warning(f"Updating run {shard.run_id} conflicted with another shard, retrying")
+            time.sleep(2 ** attempt)
+    instrumentation.record_query_job(query_job)
+    return query_job
+
+# Record a shard as done and return True for the one worker that claims its run
+def finish_shard(shard):
+    run_shard_query(shard_done_query(shard_table()), shard)
+    return run_shard_query(claim_run_query(shard_table()), shard).num_dml_affected_rows == 1
+
+# Mark the run of a shard built, until then a retry of the shard claims the run and builds it again
+def mark_run_built(shard):
+    run_shard_query(run_built_query(shard_table()), shard)
+
+# Seconds since the epoch of an RFC 3339 event timestamp such as 2022-06-01T23:00:00.123Z
+def event_time(timestamp):
+    return datetime.datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc).timestamp()
+
 def export_metric_data(event, context):
     """Background Cloud Function to be triggered by Pub/Sub.
     Args:
@@ -289,7 +911,18 @@ def export_metric_data(event, context):
     """
     print("""This Function was triggered by messageId {} published at {}
     """.format(context.event_id, context.timestamp))
-    run_pipeline()
+    event_age = time.time() - event_time(context.timestamp)
+    if event_age > config.EVENT_MAX_AGE_SECONDS:
+        instrumentation.log(f"Dropping event {context.event_id} published {int(event_age)}s ago, not retrying it", severity="ERROR", event_id=context.event_id)
+        return
+    shard = Shard.from_event(event)
+    if shard is not None:
+        run_pipeline(shard)
+    elif config.SHARD_CLUSTERS:
+        coordinate_run()
+    else:
+        # A retried event keeps its event_id, so the retry resumes the checkpointed run
+        run_pipeline(run_id=context.event_id)
          
 
 if __name__ == "__main__":
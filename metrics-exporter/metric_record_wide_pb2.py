@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: metric_record_wide.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x18metric_record_wide.proto\"\xa6\x04\n\x10MetricWideRecord\x12\x10\n\x08location\x18\x01 \x01(\t\x12\x12\n\nproject_id\x18\x02 \x01(\t\x12\x14\n\x0c\x63luster_name\x18\x03 \x01(\t\x12\x17\n\x0f\x63ontroller_name\x18\x04 \x01(\t\x12\x17\n\x0f\x63ontroller_type\x18\x05 \x01(\t\x12\x16\n\x0enamespace_name\x18\x06 \x01(\t\x12\x0e\n\x06tstamp\x18\x07 \x01(\x02\x12\x0b\n\x03hpa\x18\x08 \x01(\x08\x12\x17\n\x0f\x63ontainer_count\x18\t \x01(\x01\x12\x1b\n\x13\x63pu_requested_cores\x18\n \x01(\x01\x12\x17\n\x0f\x63pu_limit_cores\x18\x0b \x01(\x01\x12\x1e\n\x16memory_requested_bytes\x18\x0c \x01(\x01\x12\x1a\n\x12memory_limit_bytes\x18\r \x01(\x01\x12&\n\x1ememory_request_recommendations\x18\x0e \x01(\x01\x12\x33\n+cpu_request_95th_percentile_recommendations\x18\x0f \x01(\x01\x12\'\n\x1f\x63pu_request_max_recommendations\x18\x10 \x01(\x01\x12/\n\rother_metrics\x18\x11 \x03(\x0b\x32\x18.MetricWideRecord.Metric\x1a-\n\x06Metric\x12\x13\n\x0bmetric_name\x18\x01 \x01(\t\x12\x0e\n\x06points\x18\x02 \x01(\x01')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'metric_record_wide_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _METRICWIDERECORD._serialized_start=29
+  _METRICWIDERECORD._serialized_end=579
+  _METRICWIDERECORD_METRIC._serialized_start=534
+  _METRICWIDERECORD_METRIC._serialized_end=579
+# @@protoc_insertion_point(module_scope)
@@ -0,0 +1,82 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+from google.cloud import monitoring_v3
+
+# Batched percentile and max over many time series at once. The points of all series are kept in one flat buffer,
+# series i being values[offsets[i]:offsets[i + 1]], so every statistic is computed with a few vectorized passes
+# instead of a Python loop per series.
+
+# Load the points of a list of monitoring_v3.TimeSeries into a flat buffer. Values are scaled the same way the
+# exporter always did: double values to millicores, int64 values (bytes) to MiB, truncated to integers.
+def ragged_from_time_series(time_series):
+    counts = np.zeros(len(time_series) + 1, dtype=np.int64)
+    doubles = []
+    int64s = []
+    for i, result in enumerate(time_series):
+        # Read the underlying protobuf message, the proto-plus wrappers are slow to access point by point
+        points = monitoring_v3.TimeSeries.pb(result).points
+        counts[i + 1] = len(points)
+        doubles.extend(point.value.double_value for point in points)
+        int64s.extend(point.value.int64_value for point in points)
+    doubles = np.array(doubles, dtype=np.float64)
+    int64s = np.array(int64s, dtype=np.float64)
+    values = np.where(doubles != 0, np.trunc(doubles * 1000), np.trunc(int64s / 1024 / 1024)).astype(np.int64)
+    return values, np.cumsum(counts)
+
+# Sort the points of every series in place of their position in the buffer
+def _sort_segments(values, offsets):
+    lengths = np.diff(offsets)
+    segment_ids = np.repeat(np.arange(lengths.size), lengths)
+    return values[np.lexsort((values, segment_ids))]
+
+# Percentiles (0-100) of every series with numpy's default linear interpolation, returned as an array of shape
+# (len(percentiles), number of series). Empty series get NaN.
+def batch_percentiles(values, offsets, percentiles):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    result = np.full((len(percentiles), lengths.size), np.nan)
+    non_empty = lengths > 0
+    if not non_empty.any():
+        return result
+    sorted_values = _sort_segments(np.asarray(values), offsets).astype(np.float64)
+    starts = offsets[:-1][non_empty]
+    n = lengths[non_empty]
+    for row, percentile in enumerate(percentiles):
+        q = np.true_divide(percentile, 100)
+        # Same virtual index, neighbours and lerp as np.percentile so results match bit for bit
+        virtual_index = (n - 1) * q
+        previous_index = np.floor(virtual_index)
+        gamma = virtual_index - previous_index
+        previous_index = np.clip(previous_index, 0, n - 1).astype(np.int64)
+        next_index = np.clip(previous_index + 1, 0, n - 1)
+        below = sorted_values[starts + previous_index]
+        above = sorted_values[starts + next_index]
+        diff = above - below
+        interpolated = below + diff * gamma
+        high = gamma >= 0.5
+        interpolated[high] = above[high] - diff[high] * (1 - gamma[high])
+        result[row, non_empty] = interpolated
+    return result
+
+# Max of every series. Empty series get the minimum int64.
+def batch_max(values, offsets):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.diff(offsets)
+    result = np.full(lengths.size, np.iinfo(np.int64).min, dtype=np.int64)
+    non_empty = lengths > 0
+    if non_empty.any():
+        result[non_empty] = np.maximum.reduceat(values, offsets[:-1][non_empty])
+    return result
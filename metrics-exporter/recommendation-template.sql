@@ -13,37 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 */
-INSERT 
-INTO
-  `${PROJECT_ID}.${BIGQUERY_DATASET}.${BIGQUERY_VPA_RECOMMENDATION_TABLE}`
-    (
-recommendation_timestamp,			
-location,
-project_id,
-cluster_name,
-controller_name,							
-controller_type,						
-namespace_name,			
-container_count,
-cpu_limit_cores,
-cpu_requested_cores,	
-memory_limit_bytes,					
-memory_requested_bytes,			
-memory_request_max_recommendations,								
-mem_qos,
-cpu_qos,
-memory_limit_recommendations,
-cpu_request_recommendations,
-cpu_limit_recommendations,
-cpu_delta,
-mem_delta,
-priority,	
-mem_provision_status,
-mem_provision_risk,
-cpu_provision_status,
-cpu_provision_risk,
-latest
-)
+MERGE
+  `${PROJECT_ID}.${BIGQUERY_DATASET}.${BIGQUERY_VPA_RECOMMENDATION_TABLE}` AS t
+USING (
 ###############################
 # Gather all HPA workloads
 ##############################
@@ -60,7 +32,9 @@ WITH
   FROM
     `${PROJECT_ID}.${BIGQUERY_DATASET}.${BIGQUERY_MQL_TABLE}`
   WHERE
-    metric_name LIKE '%hpa%' ),
+    metric_name LIKE '%hpa%'
+    AND tstamp = @tstamp
+    AND (_PARTITIONTIME IS NULL OR _PARTITIONTIME >= TIMESTAMP_SECONDS(CAST(@tstamp AS INT64) - 7200)) ),
 ###################################################
 # Filter out HPA workloads, convert rows to columns
 ###################################################
@@ -90,6 +64,8 @@ WITH
       AND c.cluster_name = hpa_workloads.cluster_name
     WHERE
       hpa_workloads.flag IS NULL
+      AND c.tstamp = @tstamp
+      AND (c._PARTITIONTIME IS NULL OR c._PARTITIONTIME >= TIMESTAMP_SECONDS(CAST(@tstamp AS INT64) - 7200))
     ORDER BY
       metric_name) PIVOT(AVG(points) FOR metric_name IN ( 'container_count',
         'memory_requested_bytes',
@@ -195,23 +171,91 @@ cluster_name,
 controller_name,							
 controller_type,						
 namespace_name,			
-CAST(container_count AS INT64),
-CAST(cpu_limit_cores AS INT64),
-CAST(cpu_requested_cores AS INT64),	
-CAST(memory_limit_bytes AS INT64),					
-CAST(memory_requested_bytes AS INT64),			
+CAST(container_count AS INT64) AS container_count,
+CAST(cpu_limit_cores AS INT64) AS cpu_limit_cores,
+CAST(cpu_requested_cores AS INT64) AS cpu_requested_cores,	
+CAST(memory_limit_bytes AS INT64) AS memory_limit_bytes,					
+CAST(memory_requested_bytes AS INT64) AS memory_requested_bytes,			
 CAST(memory_request_recommendations AS INT64) as memory_request_max_recommendations,								
 mem_qos,
 cpu_qos,
-CAST(memory_limit_recommendation AS INT64),
-CAST(cpu_request_recommendations AS INT64),
-CAST(cpu_limit_recommendation AS INT64),
-CAST(cpu_delta AS INT64),
-CAST(mem_delta AS INT64),
-CAST(priority AS INT64),	
+CAST(memory_limit_recommendation AS INT64) AS memory_limit_recommendations,
+CAST(cpu_request_recommendations AS INT64) AS cpu_request_recommendations,
+CAST(cpu_limit_recommendation AS INT64) AS cpu_limit_recommendations,
+CAST(cpu_delta AS INT64) AS cpu_delta,
+CAST(mem_delta AS INT64) AS mem_delta,
+CAST(priority AS INT64) AS priority,	
 mem_provision_status,
 mem_provision_risk,
 cpu_provision_status,
 cpu_provision_risk,
 latest FROM final_recommendation WHERE priority IS NOT NULL
-ORDER BY priority DESC
\ No newline at end of file
+# A retried run whose MERGE already ran inserts nothing again
+AND NOT EXISTS (
+  SELECT 1 FROM `${PROJECT_ID}.${BIGQUERY_DATASET}.${BIGQUERY_VPA_RECOMMENDATION_TABLE}`
+  WHERE recommendation_timestamp = TIMESTAMP_SECONDS(CAST(@tstamp AS INT64)))
+) AS s
+ON FALSE
+###############################################################
+# Insert the new recommendations, the previous ones are no longer
+# the latest
+###############################################################
+WHEN NOT MATCHED BY SOURCE AND t.latest AND t.recommendation_timestamp < TIMESTAMP_SECONDS(CAST(@tstamp AS INT64)) THEN
+  UPDATE SET latest = FALSE
+WHEN NOT MATCHED THEN
+  INSERT (
+    recommendation_timestamp,
+    location,
+    project_id,
+    cluster_name,
+    controller_name,
+    controller_type,
+    namespace_name,
+    container_count,
+    cpu_limit_cores,
+    cpu_requested_cores,
+    memory_limit_bytes,
+    memory_requested_bytes,
+    memory_request_max_recommendations,
+    mem_qos,
+    cpu_qos,
+    memory_limit_recommendations,
+    cpu_request_recommendations,
+    cpu_limit_recommendations,
+    cpu_delta,
+    mem_delta,
+    priority,
+    mem_provision_status,
+    mem_provision_risk,
+    cpu_provision_status,
+    cpu_provision_risk,
+    latest
+  )
+  VALUES (
+    recommendation_timestamp,
+    location,
+    project_id,
+    cluster_name,
+    controller_name,
+    controller_type,
+    namespace_name,
+    container_count,
+    cpu_limit_cores,
+    cpu_requested_cores,
+    memory_limit_bytes,
+    memory_requested_bytes,
+    memory_request_max_recommendations,
+    mem_qos,
+    cpu_qos,
+    memory_limit_recommendations,
+    cpu_request_recommendations,
+    cpu_limit_recommendations,
+    cpu_delta,
+    mem_delta,
+    priority,
+    mem_provision_status,
+    mem_provision_risk,
+    cpu_provision_status,
+    cpu_provision_risk,
+    latest
+  )
\ No newline at end of file
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: recommendation_record.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x1brecommendation_record.proto\"\xc1\x05\n\x14RecommendationRecord\x12 \n\x18recommendation_timestamp\x18\x01 \x01(\x03\x12\x10\n\x08location\x18\x02 \x01(\t\x12\x12\n\nproject_id\x18\x03 \x01(\t\x12\x14\n\x0c\x63luster_name\x18\x04 \x01(\t\x12\x17\n\x0f\x63ontroller_name\x18\x05 \x01(\t\x12\x17\n\x0f\x63ontroller_type\x18\x06 \x01(\t\x12\x16\n\x0enamespace_name\x18\x07 \x01(\t\x12\x17\n\x0f\x63ontainer_count\x18\x08 \x01(\x03\x12\x17\n\x0f\x63pu_limit_cores\x18\t \x01(\x03\x12\x1b\n\x13\x63pu_requested_cores\x18\n \x01(\x03\x12\x1a\n\x12memory_limit_bytes\x18\x0b \x01(\x03\x12\x1e\n\x16memory_requested_bytes\x18\x0c \x01(\x03\x12*\n\"memory_request_max_recommendations\x18\r \x01(\x03\x12\x0f\n\x07mem_qos\x18\x0e \x01(\t\x12\x0f\n\x07\x63pu_qos\x18\x0f \x01(\t\x12$\n\x1cmemory_limit_recommendations\x18\x10 \x01(\x03\x12#\n\x1b\x63pu_request_recommendations\x18\x11 \x01(\x03\x12!\n\x19\x63pu_limit_recommendations\x18\x12 \x01(\x03\x12\x11\n\tcpu_delta\x18\x13 \x01(\x03\x12\x11\n\tmem_delta\x18\x14 \x01(\x03\x12\x10\n\x08priority\x18\x15 \x01(\x03\x12\x1c\n\x14mem_provision_status\x18\x16 \x01(\t\x12\x1a\n\x12mem_provision_risk\x18\x17 \x01(\t\x12\x1c\n\x14\x63pu_provision_status\x18\x18 \x01(\t\x12\x1a\n\x12\x63pu_provision_risk\x18\x19 \x01(\t\x12\x0e\n\x06latest\x18\x1a \x01(\x08')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'recommendation_record_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _RECOMMENDATIONRECORD._serialized_start=32
+  _RECOMMENDATIONRECORD._serialized_end=737
+# @@protoc_insertion_point(module_scope)
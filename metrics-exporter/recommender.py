@@ -0,0 +1,133 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+import recommendation_record_pb2
+
+# In-process version of recommendation-template.sql, run over the workloads joined by WideRecordJoiner. The workloads
+# become a columnar table, one float64 array per metric with NaN for NULL, and every step of the query is computed
+# for all workloads at once. NaN compares false and propagates through arithmetic like NULL does in the query, so
+# the CASE expressions map to np.select with the same branch order. If you change recommendation-template.sql,
+# change this module the same way.
+
+METRICS = [
+    "container_count",
+    "cpu_requested_cores",
+    "cpu_limit_cores",
+    "memory_requested_bytes",
+    "memory_limit_bytes",
+    "memory_request_recommendations",
+    "cpu_request_95th_percentile_recommendations",
+    "cpu_request_max_recommendations",
+]
+
+LABELS = ["location", "project_id", "cluster_name", "controller_name", "controller_type", "namespace_name"]
+
+# Columns of the recommendation table cast to INT64 by the query, and the value they are cast from
+INTEGER_COLUMNS = {
+    "container_count": "container_count",
+    "cpu_limit_cores": "cpu_limit_cores",
+    "cpu_requested_cores": "cpu_requested_cores",
+    "memory_limit_bytes": "memory_limit_bytes",
+    "memory_requested_bytes": "memory_requested_bytes",
+    "memory_request_max_recommendations": "memory_request_recommendations",
+    "memory_limit_recommendations": "memory_request_recommendations",
+    "cpu_request_recommendations": "cpu_request_recommendations",
+    "cpu_limit_recommendations": "cpu_limit_recommendations",
+    "cpu_delta": "cpu_delta",
+    "mem_delta": "mem_delta",
+    "priority": "priority",
+}
+STRING_COLUMNS = ["mem_qos", "cpu_qos", "mem_provision_status", "mem_provision_risk", "cpu_provision_status", "cpu_provision_risk"]
+
+# CAST(x AS INT64) of a FLOAT64 rounds halfway cases away from zero
+def cast_int64(values):
+    return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+# Workloads of WideRecordJoiner records (labels -> metric name -> distinct values) as a list of labels and a column
+# per metric, each workload getting the mean of its distinct values like the DISTINCT and AVG of the query
+def workload_table(records):
+    labels = list(records)
+    columns = {}
+    for metric in METRICS:
+        values = (records[key].get(metric) for key in labels)
+        columns[metric] = np.fromiter((sum(v) / len(v) if v else np.nan for v in values), dtype=np.float64, count=len(labels))
+    return labels, columns
+
+# Hash index of the HPA workloads, keyed like the join of the query on location, project, cluster and controller
+def hpa_index(records):
+    # Empty labels are NULL in BigQuery and never join
+    return {labels[:4] for labels, metrics in records.items() if all(labels[:4]) and any("hpa" in metric_name for metric_name in metrics)}
+
+def _qos(requested, limit):
+    return np.select([(requested == 0) & (limit == 0), (requested == limit) & (requested > 0)], ["BestEffort", "Guaranteed"], "Burstable")
+
+def _provision(requested, recommended, under_risk):
+    status = np.select([requested > recommended, requested < recommended, requested == 0], ["over", "under", "not set"], "ok")
+    risk = np.select([requested > recommended, requested < recommended, requested == 0], ["cost", under_risk, "reliability"], "ok")
+    return status, risk
+
+# Recommendations of the workloads of records. Returns the labels of the recommended workloads and their columns:
+# float64 arrays with NaN for NULL for the integer columns, string arrays for the others.
+def recommend(records):
+    labels, columns = workload_table(records)
+    hpa = hpa_index(records)
+    keep = np.fromiter((key[:4] not in hpa for key in labels), dtype=bool, count=len(labels))
+    keep &= ~np.isnan(columns["memory_request_recommendations"])
+    keep &= ~np.isnan(columns["cpu_request_max_recommendations"]) | ~np.isnan(columns["cpu_request_95th_percentile_recommendations"])
+    labels = [key for key, kept in zip(labels, keep) if kept]
+    c = {metric: values[keep] for metric, values in columns.items()}
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        c["mem_qos"] = _qos(c["memory_requested_bytes"], c["memory_limit_bytes"])
+        c["cpu_qos"] = _qos(c["cpu_requested_cores"], c["cpu_limit_cores"])
+        guaranteed = c["cpu_qos"] == "Guaranteed"
+        cpu_max = c["cpu_request_max_recommendations"]
+        cpu_95th = c["cpu_request_95th_percentile_recommendations"]
+        c["cpu_request_recommendations"] = np.where(guaranteed, cpu_max, cpu_95th)
+        c["cpu_limit_recommendations"] = np.select(
+            [(c["cpu_limit_cores"] == 0) | (c["cpu_requested_cores"] == 0), guaranteed],
+            [cpu_max, cpu_max],
+            cast_int64(cpu_95th * (c["cpu_limit_cores"] / c["cpu_requested_cores"])),
+        )
+        cpu_requested = np.where(np.isnan(c["cpu_requested_cores"]), 0, c["cpu_requested_cores"])
+        c["cpu_delta"] = cpu_requested - c["cpu_request_recommendations"]
+        c["mem_delta"] = c["memory_requested_bytes"] - c["memory_request_recommendations"]
+        c["priority"] = cast_int64(c["container_count"] * ((c["cpu_requested_cores"] - c["cpu_request_recommendations"]) + c["mem_delta"] / 13.4))
+        c["mem_provision_status"], c["mem_provision_risk"] = _provision(c["memory_requested_bytes"], c["memory_request_recommendations"], "reliability")
+        c["cpu_provision_status"], c["cpu_provision_risk"] = _provision(c["cpu_requested_cores"], c["cpu_request_recommendations"], "performance")
+
+    keep = ~np.isnan(c["priority"])
+    labels = [key for key, kept in zip(labels, keep) if kept]
+    result = {name: cast_int64(c[source][keep]) for name, source in INTEGER_COLUMNS.items()}
+    result.update({name: c[name][keep] for name in STRING_COLUMNS})
+    return labels, result
+
+# Labels and columns of the recommend() output restricted to the workloads with labels in only
+def select(labels, result, only):
+    keep = np.fromiter((key in only for key in labels), dtype=bool, count=len(labels))
+    return [key for key, kept in zip(labels, keep) if kept], {name: values[keep] for name, values in result.items()}
+
+# Serialized RecommendationRecord rows of the recommend() output, all with the recommendation_timestamp of tstamp
+def recommendation_rows(labels, result, tstamp):
+    timestamp = int(cast_int64(np.float64(tstamp))) * 1000000
+    integers = {name: [None if np.isnan(value) else int(value) for value in result[name]] for name in INTEGER_COLUMNS}
+    strings = {name: result[name].tolist() for name in STRING_COLUMNS}
+    for i, key in enumerate(labels):
+        record = recommendation_record_pb2.RecommendationRecord(recommendation_timestamp=timestamp, latest=True, **{name: value for name, value in zip(LABELS, key) if value})
+        for name in INTEGER_COLUMNS:
+            if integers[name][i] is not None:
+                setattr(record, name, integers[name][i])
+        for name in STRING_COLUMNS:
+            setattr(record, name, strings[name][i])
+        yield record.SerializeToString()
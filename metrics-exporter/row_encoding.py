@@ -0,0 +1,157 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import struct
+import threading
+import metric_record_wide_pb2
+
+# Hand-rolled encoder for the flat MetricFlatRecord message of metric_record_flat.proto. It produces the same bytes
+# as MetricFlatRecord.SerializeToString() without building a message per row: fields are written in field number
+# order and proto3 default values are skipped. The label fields (2 to 7) are encoded once per time series and
+# reused by every row of that series, the metric name and timestamp once per encoder.
+#
+# If you change metric_record_flat.proto, update the field numbers below.
+
+def _varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _string_field(field_number, value):
+    if not value:
+        return b""
+    data = value.encode("utf-8")
+    return _varint(field_number << 3 | 2) + _varint(len(data)) + data
+
+# The tstamp field as BigQuery stores it: a 32-bit float widened to a FLOAT64
+def stored_tstamp(tstamp):
+    return struct.unpack("<f", struct.pack("<f", tstamp))[0]
+
+class MetricRowEncoder:
+
+    def __init__(self, tstamp):
+        # tstamp is a proto3 float, field 9 with the 32-bit wire type
+        self._tstamp = b"\x4d" + struct.pack("<f", tstamp) if tstamp else b""
+        self._metric_names = {}
+
+    # Encoded label fields of a time series, pass the result to row()
+    def labels(self, location, project_id, cluster_name, controller_name, controller_type, namespace_name):
+        return b"".join((
+            _string_field(2, location),
+            _string_field(3, project_id),
+            _string_field(4, cluster_name),
+            _string_field(5, controller_name),
+            _string_field(6, controller_type),
+            _string_field(7, namespace_name),
+        ))
+
+    def row(self, metric_name, labels, points):
+        name = self._metric_names.get(metric_name)
+        if name is None:
+            name = self._metric_names[metric_name] = _string_field(1, metric_name)
+        # points is an int64, field 8 with the varint wire type
+        return name + labels + (b"\x40" + _varint(points) if points else b"") + self._tstamp
+
+# Wide record format, one MetricWideRecord of metric_record_wide.proto per workload. Fetchers use a WideCellEncoder
+# in place of the MetricRowEncoder, so their rows are (labels, metric name, value) cells instead of serialized rows,
+# and a WideRecordJoiner joins the cells of every fetcher on their labels before WideRowEncoder serializes them.
+# Field numbers are read from the generated module.
+
+WIDE_LABELS = ["location", "project_id", "cluster_name", "controller_name", "controller_type", "namespace_name"]
+
+class WideCellEncoder:
+
+    def labels(self, location, project_id, cluster_name, controller_name, controller_type, namespace_name):
+        return (location, project_id, cluster_name, controller_name, controller_type, namespace_name)
+
+    def row(self, metric_name, labels, points):
+        return (labels, metric_name, points)
+
+# Collects cells from several threads. Like the DISTINCT and AVG of the flat recommendation query, a workload with
+# several containers gets the mean of the distinct values of a metric.
+class WideRecordJoiner:
+
+    def __init__(self):
+        # labels -> metric name -> set of values
+        self.records = {}
+        self._lock = threading.Lock()
+
+    # Returns the number of cells written
+    def write(self, cells):
+        records = {}
+        count = 0
+        for labels, metric_name, points in cells:
+            records.setdefault(labels, {}).setdefault(metric_name, set()).add(points)
+            count += 1
+        with self._lock:
+            for labels, metrics in records.items():
+                joined = self.records.setdefault(labels, {})
+                for metric_name, values in metrics.items():
+                    joined.setdefault(metric_name, set()).update(values)
+        return count
+
+    # Serialized MetricWideRecord rows, one per workload, or only of the workloads with labels in only
+    def rows(self, encoder, only=None):
+        for labels, metrics in self._select(only).items():
+            yield encoder.row(labels, {metric_name: sum(values) / len(values) for metric_name, values in metrics.items()})
+
+    # Serialized MetricFlatRecord rows, one per distinct value of a workload's metric, given a MetricRowEncoder
+    def flat_rows(self, encoder, only=None):
+        for labels, metrics in self._select(only).items():
+            encoded_labels = encoder.labels(*labels)
+            for metric_name, values in metrics.items():
+                for points in values:
+                    yield encoder.row(metric_name, encoded_labels, points)
+
+    def _select(self, only):
+        with self._lock:
+            if only is None:
+                return dict(self.records)
+            return {labels: self.records[labels] for labels in only}
+
+class WideRowEncoder:
+
+    def __init__(self, tstamp):
+        descriptor = metric_record_wide_pb2.MetricWideRecord.DESCRIPTOR
+        fields = descriptor.fields_by_name
+        self._label_numbers = [fields[label].number for label in WIDE_LABELS]
+        # float, 32-bit wire type
+        self._tstamp = _varint(fields["tstamp"].number << 3 | 5) + struct.pack("<f", tstamp) if tstamp else b""
+        # bool, varint wire type
+        self._hpa = _varint(fields["hpa"].number << 3) + b"\x01"
+        # double columns, 64-bit wire type, in field number order
+        self._columns = {
+            field.name: _varint(field.number << 3 | 1)
+            for field in sorted(descriptor.fields, key=lambda field: field.number) if field.type == field.TYPE_DOUBLE
+        }
+        self._other_metrics = _varint(fields["other_metrics"].number << 3 | 2)
+
+    # values maps metric names to their value for the workload with these labels
+    def row(self, labels, values):
+        out = [_string_field(number, label) for number, label in zip(self._label_numbers, labels)]
+        out.append(self._tstamp)
+        if any("hpa" in metric_name for metric_name in values):
+            out.append(self._hpa)
+        for name, tag in self._columns.items():
+            if name in values:
+                out.append(tag + struct.pack("<d", values[name]))
+        for metric_name, points in values.items():
+            if metric_name not in self._columns and "hpa" not in metric_name:
+                metric = _string_field(1, metric_name) + b"\x11" + struct.pack("<d", points)
+                out.append(self._other_metrics + _varint(len(metric)) + metric)
+        return b"".join(out)
@@ -0,0 +1,90 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import json
+
+# Coordinator/worker mode. The coordinator splits the clusters of every monitored project into shards and publishes
+# one Pub/Sub message per shard. The attributes of a message name the shard (run_id, shard, shard_count, project_id,
+# tstamp) and its data lists the clusters. The coordinator records the run in the shard table as shard -1. Each
+# worker exports its clusters, then records the shard as done; the worker that finds every shard of the run done
+# claims the run row, builds the recommendation table and marks the run built.
+
+class Shard:
+
+    def __init__(self, run_id, shard, shard_count, project_id, clusters, tstamp):
+        self.run_id = run_id
+        self.shard = shard
+        self.shard_count = shard_count
+        self.project_id = project_id
+        self.clusters = clusters
+        self.tstamp = tstamp
+
+    def attributes(self):
+        return {
+            "run_id": self.run_id,
+            "shard": str(self.shard),
+            "shard_count": str(self.shard_count),
+            "project_id": self.project_id,
+            "tstamp": repr(self.tstamp),
+        }
+
+    def data(self):
+        return json.dumps({"clusters": self.clusters}).encode()
+
+    # The shard of a Pub/Sub event, None for a message that is not a shard
+    @classmethod
+    def from_event(cls, event):
+        attributes = event.get("attributes") or {}
+        if "run_id" not in attributes:
+            return None
+        data = json.loads(base64.b64decode(event["data"]))
+        return cls(attributes["run_id"], int(attributes["shard"]), int(attributes["shard_count"]), attributes["project_id"], data["clusters"], float(attributes["tstamp"]))
+
+    def __str__(self):
+        return f"shard {self.shard + 1}/{self.shard_count} of run {self.run_id} ({self.project_id}: {len(self.clusters)} clusters)"
+
+# Split the clusters of every project into shards of at most clusters_per_shard clusters
+def plan_shards(run_id, clusters_by_project, clusters_per_shard, tstamp):
+    groups = []
+    for project_id, clusters in clusters_by_project.items():
+        clusters = sorted(clusters)
+        for start in range(0, len(clusters), clusters_per_shard):
+            groups.append((project_id, clusters[start:start + clusters_per_shard]))
+    return [Shard(run_id, i, len(groups), project_id, clusters, tstamp) for i, (project_id, clusters) in enumerate(groups)]
+
+# Record a shard as done. Shards are recorded with a DML INSERT so the barrier query below sees them right away.
+def shard_done_query(table_id):
+    return f"""INSERT `{table_id}` (run_id, shard, shard_count, finished)
+        VALUES (@run_id, @shard, @shard_count, CURRENT_TIMESTAMP())"""
+
+# Record a run, shard -1, before any of its shards is published. The worker claiming the run sets claimed and
+# claimed_by, and built once the recommendation table is built.
+def run_started_query(table_id):
+    return f"""INSERT `{table_id}` (run_id, shard, shard_count, claimed, built)
+        VALUES (@run_id, -1, @shard_count, FALSE, FALSE)"""
+
+# Claim a run once every shard is done. Workers claiming the same run update the same row, so BigQuery serializes
+# their UPDATEs or aborts all but one of them, and only the first finds the run unclaimed. A retry of the shard
+# that claimed the run claims it again until it is built.
+def claim_run_query(table_id):
+    return f"""UPDATE `{table_id}`
+        SET claimed = TRUE, claimed_by = @shard
+        WHERE run_id = @run_id AND shard = -1 AND NOT built AND (NOT claimed OR claimed_by = @shard)
+          AND (SELECT COUNT(DISTINCT shard) FROM `{table_id}` WHERE run_id = @run_id AND shard >= 0) = @shard_count"""
+
+# Record that the shard that claimed a run built its recommendation table
+def run_built_query(table_id):
+    return f"""UPDATE `{table_id}`
+        SET built = TRUE, finished = CURRENT_TIMESTAMP()
+        WHERE run_id = @run_id AND shard = -1 AND claimed_by = @shard"""
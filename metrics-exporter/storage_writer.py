@@ -0,0 +1,258 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import logging
+import queue
+import threading
+import time
+from google.api_core import exceptions
+from google.cloud.bigquery_storage_v1 import exceptions as bqstorage_exceptions
+from google.cloud.bigquery_storage_v1 import types
+from google.cloud.bigquery_storage_v1 import writer
+from google.protobuf import descriptor_pb2
+
+# Bytes added to a request for every serialized row (field tag and length prefix)
+ROW_OVERHEAD_BYTES = 6
+
+# Writes the serialized rows of a whole pipeline run through one BigQuery Storage Write API connection.
+#
+# With stream_type "pending" every row goes to a single PENDING stream that is finalized and committed once by
+# commit(), so a run becomes visible atomically. Requests carry explicit offsets, which makes resending a request
+# after a failure idempotent. With stream_type "committed" rows are appended to the table's default stream and are
+# visible as soon as they are acknowledged; retries may then write a request twice.
+#
+# append() can be called from several threads. Rows are split into requests of at most max_request_bytes and up to
+# max_inflight requests are sent before waiting for the oldest acknowledgement.
+class StorageWriter:
+
+    def __init__(self, write_client, parent, message_descriptor, stream_type="pending", max_request_bytes=9 * 1024 * 1024, max_inflight=8, max_retries=3):
+        self.write_client = write_client
+        self.parent = parent
+        self.pending = stream_type == "pending"
+        self.max_request_bytes = max_request_bytes
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self.rows_appended = 0
+        self.bytes_appended = 0
+        self._offset = 0
+        self._inflight = collections.deque()
+        self._lock = threading.Lock()
+        self._failed = None
+        self._closed = False
+
+        if self.pending:
+            # When creating the stream, choose the type. Use the PENDING type to wait
+            # until the stream is committed before it is visible. See:
+            # https://cloud.google.com/bigquery/docs/reference/storage/rpc/google.cloud.bigquery.storage.v1#google.cloud.bigquery.storage.v1.WriteStream.Type
+            write_stream = types.WriteStream()
+            write_stream.type_ = types.WriteStream.Type.PENDING
+            self.stream_name = write_client.create_write_stream(parent=parent, write_stream=write_stream).name
+        else:
+            self.stream_name = f"{parent}/streams/_default"
+
+        # The initial request must contain the stream name and, so that BigQuery knows how to parse the
+        # serialized_rows, a protocol buffer representation of the message descriptor.
+        self._request_template = types.AppendRowsRequest()
+        self._request_template.write_stream = self.stream_name
+        proto_schema = types.ProtoSchema()
+        proto_descriptor = descriptor_pb2.DescriptorProto()
+        message_descriptor.CopyToProto(proto_descriptor)
+        proto_schema.proto_descriptor = proto_descriptor
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.writer_schema = proto_schema
+        self._request_template.proto_rows = proto_data
+        self._append_rows_stream = self._open_append_rows_stream()
+
+    def append(self, rows):
+        with self._lock:
+            if self._failed:
+                raise RuntimeError(f"Stream {self.stream_name} failed earlier in this run") from self._failed
+            for chunk, size in self._split(rows):
+                proto_rows = types.ProtoRows()
+                proto_rows.serialized_rows.extend(chunk)
+                request = types.AppendRowsRequest()
+                proto_data = types.AppendRowsRequest.ProtoData()
+                proto_data.rows = proto_rows
+                request.proto_rows = proto_data
+                if self.pending:
+                    request.offset = self._offset
+                self._offset += len(chunk)
+                while len(self._inflight) >= self.max_inflight:
+                    self._wait_oldest()
+                if self._failed:
+                    raise RuntimeError(f"Failed to append to stream {self.stream_name}") from self._failed
+                self._inflight.append((self._send(request), request))
+                self.rows_appended += len(chunk)
+                self.bytes_appended += size
+
+    # Wait for every request, then make the rows visible. Returns the number of rows written.
+    def commit(self):
+        self.finalize()
+        if self.pending:
+            commit_streams(self.write_client, self.parent, [self.stream_name])
+        print(f"Writes to stream: '{self.stream_name}' have been committed, {self.rows_appended} rows.")
+        return self.rows_appended
+
+    # Wait for every request and close the stream without committing it, so it can be committed later together with
+    # other streams by commit_streams. Returns the number of rows written.
+    def finalize(self):
+        with self._lock:
+            while self._inflight:
+                self._wait_oldest()
+            if self._failed:
+                raise RuntimeError(f"Stream {self.stream_name} failed, nothing was committed") from self._failed
+            # Shutdown background threads and close the streaming connection.
+            self._append_rows_stream.close()
+            self._closed = True
+            if self.pending:
+                # A PENDING type stream must be "finalized" before being committed. No new
+                # records can be written to the stream after this method has been called.
+                self.write_client.finalize_write_stream(name=self.stream_name)
+            return self.rows_appended
+
+    # Close the connection without waiting for the requests in flight or committing anything, a no-op once finalized
+    def abort(self):
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._append_rows_stream.close()
+
+    # Group rows into requests that stay under the AppendRows request size limit
+    def _split(self, rows):
+        chunk = []
+        size = 0
+        for row in rows:
+            row_size = len(row) + ROW_OVERHEAD_BYTES
+            if chunk and size + row_size > self.max_request_bytes:
+                yield chunk, size
+                chunk = []
+                size = 0
+            chunk.append(row)
+            size += row_size
+        if chunk:
+            yield chunk, size
+
+    def _send(self, request):
+        try:
+            return self._append_rows_stream.send(request)
+        except bqstorage_exceptions.StreamClosedError:
+            # The connection was shut down after an error, resend what was in flight on it on a new one first
+            self._resend_inflight()
+            return self._append_rows_stream.send(request)
+
+    def _open_append_rows_stream(self):
+        # Offline stand-ins of the write client (benchmarks/harness.py) provide their own stream
+        if hasattr(self.write_client, "open_append_rows_stream"):
+            return self.write_client.open_append_rows_stream(self._request_template)
+        return writer.AppendRowsStream(self.write_client, self._request_template)
+
+    # Requests are acknowledged in order and a failure shuts the connection down, failing every later request on it,
+    # so the requests in flight are all resent in offset order on a new connection before anything new is sent.
+    def _wait_oldest(self):
+        for attempt in range(self.max_retries + 1):
+            future, request = self._inflight[0]
+            try:
+                future.result()
+                break
+            except exceptions.AlreadyExists:
+                # The rows at this offset were written by an earlier attempt
+                break
+            except Exception as error:
+                if attempt == self.max_retries or self._failed:
+                    self._failed = self._failed or error
+                    break
+                logging.warning(f"Append to {self.stream_name} failed ({error}), resending {len(self._inflight)} requests")
+                time.sleep(2 ** attempt)
+                self._resend_inflight()
+        self._inflight.popleft()
+
+    # Reopen the connection and resend every request in flight that was not acknowledged, oldest first
+    def _resend_inflight(self):
+        self._append_rows_stream.close()
+        self._append_rows_stream = self._open_append_rows_stream()
+        self._inflight = collections.deque(
+            (future, request) if future.done() and not future.exception() else (self._append_rows_stream.send(request), request)
+            for future, request in self._inflight
+        )
+
+# Make the rows of finalized PENDING streams of the table parent visible, all of them at once
+def commit_streams(write_client, parent, stream_names):
+    batch_commit_write_streams_request = types.BatchCommitWriteStreamsRequest()
+    batch_commit_write_streams_request.parent = parent
+    batch_commit_write_streams_request.write_streams = stream_names
+    response = write_client.batch_commit_write_streams(batch_commit_write_streams_request)
+    if response.stream_errors:
+        raise RuntimeError(f"Failed to commit streams {', '.join(stream_names)}: {response.stream_errors}")
+    return response
+
+# Streams rows from the fetchers to a StorageWriter. write() cuts rows into batches of batch_rows and puts them on a
+# bounded queue that a background thread appends from, so Cloud Monitoring reads and BigQuery appends overlap and
+# at most max_batches batches wait in memory. write() can be called from several threads.
+class QueueWriter:
+
+    def __init__(self, stream_writer, batch_rows=5000, max_batches=8):
+        self.stream_writer = stream_writer
+        self.batch_rows = batch_rows
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._error = None
+        self._aborted = False
+        self._thread = threading.Thread(target=self._run, name="queue-writer", daemon=True)
+        self._thread.start()
+
+    # Returns the number of rows queued
+    def write(self, rows):
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_rows:
+                self._put(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self._put(batch)
+            count += len(batch)
+        return count
+
+    # Wait until every queued batch has been appended
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error:
+            raise self._error
+
+    # Stop the background thread, dropping the queued batches, a no-op once closed
+    def abort(self):
+        if self._thread.is_alive():
+            self._aborted = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def _put(self, batch):
+        if self._error:
+            raise RuntimeError("Appending queued rows failed") from self._error
+        self._queue.put(batch)
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            # After a failure keep draining the queue so producers are not blocked
+            if self._error or self._aborted:
+                continue
+            try:
+                self.stream_writer.append(batch)
+            except Exception as error:
+                self._error = error
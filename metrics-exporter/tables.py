@@ -0,0 +1,73 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+from google.cloud import bigquery
+import instrumentation
+
+# BigQuery tables created by the exporter itself. The staging table is partitioned by ingestion hour and its
+# partitions expire, which replaces purging it after every run; the recommendation queries only read the partitions
+# written since their run started. The recommendation table is partitioned by day on recommendation_timestamp and
+# clustered by the columns recommendations are looked up by. Tables created with `bq mk` by earlier versions are not
+# partitioned: the staging table only holds the rows of the current run and is recreated, the recommendation table
+# keeps working as it is (see "Upgrading" in README.md).
+
+SCHEMA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def load_schema(schema_file):
+    with open(os.path.join(SCHEMA_DIR, schema_file)) as file:
+        return [bigquery.SchemaField.from_api_repr(field) for field in json.load(file)]
+
+def staging_table_spec(schema_file, expiration_hours):
+    return {
+        "schema_file": schema_file,
+        "time_partitioning": bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.HOUR, expiration_ms=expiration_hours * 3600 * 1000),
+        # The recommendation queries filter on _PARTITIONTIME, which an unpartitioned table does not have
+        "recreate_unpartitioned": True,
+    }
+
+def recommendation_table_spec(schema_file):
+    return {
+        "schema_file": schema_file,
+        "time_partitioning": bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="recommendation_timestamp"),
+        "clustering_fields": ["project_id", "cluster_name", "namespace_name", "controller_name"],
+    }
+
+# The sketches of a day are written once the day is over and partitioned by the day they are written, so they expire
+# after the window plus a day, once the day they cover has left it. Days stored late expire later and are skipped
+# by the day filter of the incremental fetch until then. The table only caches what Cloud Monitoring holds and an
+# unpartitioned one is recreated.
+def sketch_table_spec(schema_file, window_seconds):
+    days = -(-window_seconds // 86400) + 1
+    return {
+        "schema_file": schema_file,
+        "time_partitioning": bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, expiration_ms=days * 86400 * 1000),
+        "recreate_unpartitioned": True,
+    }
+
+# Create a table unless it exists. An existing table without partitioning is dropped and created again with
+# recreate_unpartitioned, for tables whose rows can be lost, and otherwise kept as it is and reported.
+def ensure_table(client, table_id, schema_file, time_partitioning=None, clustering_fields=None, recreate_unpartitioned=False):
+    table = bigquery.Table(table_id, schema=load_schema(schema_file))
+    table.time_partitioning = time_partitioning
+    table.clustering_fields = clustering_fields
+    existing = client.create_table(table, exists_ok=True)
+    if time_partitioning is None or existing.time_partitioning is not None:
+        return existing
+    if not recreate_unpartitioned:
+        instrumentation.log(f"Table {table_id} is not partitioned, see Upgrading in README.md to partition it", severity="WARNING", table=table_id)
+        return existing
+    instrumentation.log(f"Recreating the unpartitioned table {table_id} with partitioning", severity="WARNING", table=table_id)
+    client.delete_table(table_id)
+    return client.create_table(table)
@@ -0,0 +1,35 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import re
+import sys
+import types
+
+# Run from the metrics-exporter directory with `python -m pytest tests`. The exporter modules import each other by
+# name, like in the Cloud Function, and config.py is generated at deploy time, so the tests load config-template.py
+# with every ${VARIABLE} replaced by its lowercase name.
+EXPORTER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, EXPORTER_DIR)
+sys.path.insert(0, os.path.join(EXPORTER_DIR, "benchmarks"))
+
+def _load_config():
+    path = os.path.join(EXPORTER_DIR, "config-template.py")
+    with open(path) as file:
+        source = re.sub(r"\$\{(\w+)\}", lambda match: match.group(1).lower(), file.read())
+    config = types.ModuleType("config")
+    config.__file__ = path
+    exec(compile(source, path, "exec"), config.__dict__)
+    return config
+
+sys.modules["config"] = _load_config()
@@ -0,0 +1,114 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+import harness
+import instrumentation
+from change_cache import ChangeCache, workload_key, MAX_RETIRED_KEYS
+from row_encoding import WideCellEncoder, WideRecordJoiner
+
+TABLE_ID = "project.dataset.change_cache"
+DAY = 86400
+# Workload labels as the fetchers key the WideRecordJoiner records passed to update
+ENCODER = WideCellEncoder()
+A = ENCODER.labels("us-central1", "proj", "cluster", "web", "Deployment", "default")
+B = ENCODER.labels("us-central1", "proj", "cluster", "api", "Deployment", "default")
+
+@pytest.fixture(autouse=True)
+def run():
+    instrumentation.start_run()
+
+def new_cache(client=None, ttl=3 * DAY, snapshot_interval=7 * DAY):
+    return ChangeCache(client or harness.FakeBigQueryClient(), TABLE_ID, ttl, snapshot_interval)
+
+# Cache after a first, snapshot, run at time 0
+def warm_cache(records, **kwargs):
+    cache = new_cache(**kwargs)
+    cache.update(records, 0)
+    return cache
+
+def test_first_run_is_a_snapshot():
+    cache = new_cache()
+    cache.update({A: {"cpu": [1]}, B: {"cpu": [2]}}, 0)
+    assert cache.snapshot
+    assert cache.changed == {A, B}
+    assert cache.retired_keys == []
+    assert cache.snapshot_time == 0
+
+# retire_recommendations matches the keys to the label columns of the recommendation table in this order
+def test_workload_key_follows_the_recommendation_columns():
+    assert workload_key(A) == "us-central1/proj/cluster/web/Deployment/default"
+    assert workload_key(ENCODER.labels("", "proj", "cluster", "web", "", "default")) == "/proj/cluster/web//default"
+
+def test_unchanged_workloads_are_not_written():
+    records = {A: {"cpu": [1], "memory": [3, 2]}, B: {"cpu": [2]}}
+    cache = warm_cache(records)
+    # The hash does not depend on the order of the metrics or of their values
+    cache.update({A: {"memory": [2, 3], "cpu": [1]}, B: {"cpu": [2]}}, DAY)
+    assert not cache.snapshot
+    assert cache.changed == set()
+    assert cache.retired_keys == []
+    assert cache.entries[workload_key(A)][1] == DAY
+    assert instrumentation.current_run().counters["workloads_unchanged"] == 2
+
+def test_changed_workload_is_written_and_retired():
+    cache = warm_cache({A: {"cpu": [1]}, B: {"cpu": [2]}})
+    cache.update({A: {"cpu": [5]}, B: {"cpu": [2]}}, DAY)
+    assert cache.changed == {A}
+    assert cache.retired_keys == [workload_key(A)]
+
+def test_missing_workload_is_kept_until_ttl():
+    cache = warm_cache({A: {"cpu": [1]}, B: {"cpu": [2]}})
+    cache.update({A: {"cpu": [1]}}, DAY)
+    assert cache.retired_keys == []
+    assert workload_key(B) in cache.entries
+    cache.update({A: {"cpu": [1]}}, 3 * DAY)
+    assert cache.retired_keys == [workload_key(B)]
+    assert workload_key(B) not in cache.entries
+    assert instrumentation.current_run().counters["workloads_evicted"] == 1
+
+def test_snapshot_interval():
+    cache = warm_cache({A: {"cpu": [1]}}, snapshot_interval=2 * DAY)
+    cache.update({A: {"cpu": [1]}}, DAY)
+    assert not cache.snapshot
+    cache.update({A: {"cpu": [1]}}, 2 * DAY)
+    assert cache.snapshot
+    assert cache.changed == {A}
+    assert cache.snapshot_time == 2 * DAY
+
+def test_too_many_changes_turn_into_a_snapshot():
+    workloads = [ENCODER.labels("loc", "proj", "cluster", f"w{i}", "Deployment", "ns") for i in range(MAX_RETIRED_KEYS + 1)]
+    cache = warm_cache({labels: {"cpu": [1]} for labels in workloads})
+    cache.update({labels: {"cpu": [2]} for labels in workloads}, DAY)
+    assert cache.snapshot
+    assert cache.retired_keys == []
+
+def test_save_and_load():
+    client = harness.FakeBigQueryClient()
+    cache = warm_cache({A: {"cpu": [1]}, B: {"cpu": [2]}}, client=client)
+    cache.save()
+    cache.save()
+    loaded = new_cache(client)
+    assert loaded.load() == cache.entries
+    assert loaded.snapshot_time == 0
+    loaded.update({A: {"cpu": [1]}, B: {"cpu": [2]}}, DAY)
+    assert loaded.changed == set()
+
+def test_joined_records_of_several_containers_hash_per_workload():
+    joiner = WideRecordJoiner()
+    joiner.write([ENCODER.row("cpu", A, 1), ENCODER.row("cpu", A, 2), ENCODER.row("cpu", B, 2)])
+    cache = warm_cache(joiner.records)
+    assert set(cache.entries) == {workload_key(A), workload_key(B)}
+    joiner.write([ENCODER.row("cpu", A, 3)])
+    cache.update(joiner.records, DAY)
+    assert cache.changed == {A}
@@ -0,0 +1,114 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import io
+import pytest
+from google.api_core import exceptions
+import harness
+import main
+from checkpoints import RUN_UNIT
+
+VPA_MEMORY = "memory/per_replica_recommended_request_bytes"
+
+# Synthetic fleet recording the requests it serves. With fail_page_token, the page of the VPA memory
+# recommendations requested with that token fails once.
+class InterruptedMonitoringClient(harness.SyntheticMonitoringClient):
+
+    def __init__(self, fail_page_token=None):
+        # 8 VPA series of 10 points, 2 series per page
+        super().__init__(1, 4, 10, points_per_page=20)
+        self.fail_page_token = fail_page_token
+        self.requests = []
+
+    def list_time_series(self, request):
+        self.requests.append(dict(request))
+        if self.fail_page_token is not None and VPA_MEMORY in request["filter"] and request.get("page_token") == self.fail_page_token:
+            self.fail_page_token = None
+            raise exceptions.ServiceUnavailable("Cloud Monitoring unavailable")
+        return super().list_time_series(request)
+
+@pytest.fixture(autouse=True)
+def checkpointed(monkeypatch):
+    monkeypatch.setattr(main.config, "CHECKPOINT_RUNS", True)
+    monkeypatch.setattr(main.config, "CHECKPOINT_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(main.config, "VPA_FETCH_MODE", "raw")
+    # Every attempt of a run and the runs compared to it write rows with the same timestamp
+    monkeypatch.setattr(main.time, "time", lambda: 1790000000.0)
+    builds = []
+    monkeypatch.setattr(main, "build_recommenation_table", builds.append)
+    return builds
+
+def run(run_id="run"):
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.run_pipeline(run_id=run_id)
+
+def checkpoint_log(run_id="run"):
+    return main.open_checkpoint_log(run_id).checkpoints
+
+# Streams of the units that are done, as saved in their latest checkpoint
+def done_streams(checkpoints):
+    return sorted(name for checkpoint in checkpoints.values() if checkpoint.status == "done" for name in checkpoint.streams)
+
+# Committed rows of an uninterrupted checkpointed run
+def uninterrupted_rows():
+    _, write_client, _ = harness.install(InterruptedMonitoringClient(), harness.FakeWriteClient(keep_rows=True))
+    run("uninterrupted")
+    return sorted(write_client.committed_rows())
+
+def test_resumed_run_writes_the_rows_of_an_uninterrupted_run(checkpointed):
+    expected = uninterrupted_rows()
+    checkpointed.clear()
+    monitoring_client, write_client, _ = harness.install(InterruptedMonitoringClient(fail_page_token="2"), harness.FakeWriteClient(keep_rows=True))
+    with pytest.raises(RuntimeError):
+        run()
+    checkpoints = checkpoint_log()
+    interrupted = [checkpoint for unit, checkpoint in checkpoints.items() if VPA_MEMORY.split("/")[0] in unit and checkpoint.status != "done"]
+    assert [(checkpoint.status, checkpoint.page_token) for checkpoint in interrupted] == [("partial", "2")]
+    assert write_client.committed == []
+
+    monitoring_client.requests.clear()
+    run()
+    # Units done by the first attempt are skipped, the interrupted one resumes from its page token
+    assert [request.get("page_token") for request in monitoring_client.requests] == ["2", "3"]
+    assert all(VPA_MEMORY in request["filter"] for request in monitoring_client.requests)
+    assert sorted(write_client.committed_rows()) == expected
+    assert len(checkpointed) == 1
+
+def test_every_stream_is_committed_once(checkpointed):
+    _, write_client, _ = harness.install(InterruptedMonitoringClient(fail_page_token="1"), harness.FakeWriteClient(keep_rows=True))
+    with pytest.raises(RuntimeError):
+        run()
+    run()
+    run()
+    assert sorted(write_client.committed) == done_streams(checkpoint_log())
+    assert len(set(write_client.committed)) == len(write_client.committed)
+    assert checkpoint_log()[RUN_UNIT].status == "finished"
+    assert len(checkpointed) == 1
+
+def test_committed_run_is_not_exported_again(monkeypatch, checkpointed):
+    monitoring_client, write_client, _ = harness.install(InterruptedMonitoringClient(), harness.FakeWriteClient(keep_rows=True))
+    def fail(tstamp):
+        raise exceptions.InternalServerError("recommendation query failed")
+    monkeypatch.setattr(main, "build_recommenation_table", fail)
+    with pytest.raises(exceptions.InternalServerError):
+        run()
+    assert checkpoint_log()[RUN_UNIT].status == "committed"
+    committed = list(write_client.committed)
+    monitoring_client.requests.clear()
+    monkeypatch.setattr(main, "build_recommenation_table", checkpointed.append)
+    run()
+    assert monitoring_client.requests == []
+    assert write_client.committed == committed
+    assert checkpointed == [1790000000.0]
+    assert checkpoint_log()[RUN_UNIT].status == "finished"
@@ -0,0 +1,85 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+import harness
+import main
+import metric_record_flat_pb2
+
+# Documented in config-template.py: "aggregated" rows can differ from "raw" ones by one millicore or MiB, the
+# percentile being truncated after interpolation instead of before
+TOLERANCE = 1
+
+# Synthetic fleet recording the MQL queries it answers
+class QueryRecordingClient(harness.SyntheticMonitoringClient):
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.queries = []
+
+    def query_time_series(self, request):
+        self.queries.append(request["query"])
+        return super().query_time_series(request)
+
+# (metric name, labels) and value of every serialized MetricFlatRecord row, sorted. Containers of a workload share
+# their labels, so keys repeat.
+def parse(rows):
+    parsed = []
+    for row in rows:
+        record = metric_record_flat_pb2.MetricFlatRecord()
+        record.ParseFromString(row)
+        key = (record.metric_name, record.location, record.project_id, record.cluster_name, record.controller_name, record.controller_type, record.namespace_name)
+        parsed.append((key, record.points))
+    return sorted(parsed)
+
+# Rows of a VPA metric fetched in mode, replayed from pages recorded in directory
+def replay_rows(monkeypatch, directory, mode, metric_name):
+    monkeypatch.setattr(main.config, "VPA_FETCH_MODE", mode)
+    metric, window, _ = main.config.MQL_QUERY[metric_name]
+    synthetic = harness.SyntheticMonitoringClient(2, 5, 500)
+    harness.install(harness.RecordingMonitoringClient(synthetic, synthetic, str(directory)))
+    list(main.get_vpa_recommenation_metrics(metric_name, metric, window, 0, "project"))
+    # Each mode replays its own recording, a fallback to raw points in aggregated mode finds nothing to replay
+    harness.install(harness.ReplayMonitoringClient(str(directory)))
+    return parse(main.get_vpa_recommenation_metrics(metric_name, metric, window, 0, "project"))
+
+@pytest.mark.parametrize("metric_name, reducers", [
+    ("memory_request_recommendations", "[percentile_50: percentile(val(), 50), percentile_95: percentile(val(), 95), max: max(val())]"),
+    ("cpu_request_recommendations", "[percentile_95: percentile(val(), 95), percentile_50: percentile(val(), 50), max: max(val())]"),
+])
+def test_aggregated_query_reduces_the_window(monkeypatch, metric_name, reducers):
+    monkeypatch.setattr(main.config, "VPA_EXTRA_PERCENTILES", [50, 95])
+    metric, window, _ = main.config.MQL_QUERY[metric_name]
+    client = QueryRecordingClient(2, 5, 10)
+    harness.install(client)
+    assert list(main.get_vpa_recommenation_metrics_aggregated(metric_name, metric, window, 0, "project", ["cluster-0", "cluster-1"]))
+    # One point per series covering the whole window, within the window ending now
+    assert [[line.strip() for line in query.splitlines()] for query in client.queries] == [[
+        "fetch k8s_scale",
+        f"| metric '{metric}'",
+        "| filter resource.namespace_name != 'kube-system' && resource.cluster_name =~ 'cluster-0|cluster-1'",
+        f"| group_by {window}s, {reducers}",
+        f"| every {window}s",
+        f"| within {window}s",
+    ]]
+
+# The synthetic fleet computes the percentiles of an aggregated query with NumPy from the points it serves in raw
+# mode, so this only checks that both modes read the same series and scale their values alike
+@pytest.mark.parametrize("metric_name", ["memory_request_recommendations", "cpu_request_recommendations"])
+def test_aggregated_rows_match_raw_rows(tmp_path, monkeypatch, metric_name):
+    raw = replay_rows(monkeypatch, tmp_path / "raw", "raw", metric_name)
+    aggregated = replay_rows(monkeypatch, tmp_path / "aggregated", "aggregated", metric_name)
+    assert raw
+    assert [key for key, _ in aggregated] == [key for key, _ in raw]
+    for (key, raw_value), (_, aggregated_value) in zip(raw, aggregated):
+        assert abs(raw_value - aggregated_value) <= TOLERANCE, key
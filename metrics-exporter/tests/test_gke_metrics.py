@@ -0,0 +1,66 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import harness
+import main
+import metric_record_flat_pb2
+
+# gke_metric entries of MQL_QUERY, and entries for the reducers it does not use on the same metric types
+MQL_QUERY = {
+    **{metric_name: query for metric_name, query in main.config.MQL_QUERY.items() if query[2] == "gke_metric"},
+    "cpu_requested_cores_sum": ["kubernetes.io/container/cpu/request_cores", main.config.LATEST_WINDOW_SECONDS, "gke_metric", "sum"],
+    "memory_limit_bytes_max": ["kubernetes.io/container/memory/limit_bytes", main.config.LATEST_WINDOW_SECONDS, "gke_metric", "max"],
+}
+
+# Synthetic fleet where the sidecar of every third workload, and both containers of workload 1, have no points
+class SparseMonitoringClient(harness.SyntheticMonitoringClient):
+
+    def build_series(self, label, metric_type, template):
+        series = super().build_series(label, metric_type, template)
+        if label["controller_name"] == "workload-1" or (label["container_name"] == "sidecar" and int(label["controller_name"].split("-")[1]) % 3 == 0):
+            del series.points[:]
+        return series
+
+# (metric name, labels, value) of every serialized MetricFlatRecord row, sorted
+def parse(rows):
+    parsed = []
+    for row in rows:
+        record = metric_record_flat_pb2.MetricFlatRecord()
+        record.ParseFromString(row)
+        parsed.append((record.metric_name, record.location, record.project_id, record.cluster_name, record.controller_name, record.controller_type, record.namespace_name, record.points))
+    return sorted(parsed)
+
+# Rows of every gke_metric plan, fetched with the server side reducer of each metric or once per plan
+def fetch_rows(grouped):
+    harness.install(SparseMonitoringClient(2, 30, 1))
+    rows = []
+    for metric_names, query in main.plan_queries(MQL_QUERY):
+        reducers = [main.get_reducer(metric_name, MQL_QUERY[metric_name]) for metric_name in metric_names]
+        if grouped:
+            rows.extend(main.get_gke_metrics_group(metric_names, query[0], query[1], reducers, 1790000000, "project"))
+        else:
+            for metric_name, reducer in zip(metric_names, reducers):
+                rows.extend(main.get_gke_metrics(metric_name, query[0], query[1], reducer, 1790000000, "project"))
+    return parse(rows)
+
+def test_grouped_fetch_matches_server_side_reducers():
+    per_metric = fetch_rows(grouped=False)
+    grouped = fetch_rows(grouped=True)
+    assert grouped == per_metric
+    metric_names = {row[0] for row in grouped}
+    assert metric_names == set(MQL_QUERY)
+    # Both containers of a workload are reduced into its row, workloads without points have none
+    counts = {row[4]: row[-1] for row in grouped if row[0] == "container_count" and row[3] == "cluster-0"}
+    assert counts["workload-2"] == 2 and counts["workload-3"] == 1 and "workload-1" not in counts
+    # HPA rows are grouped on the HPA target
+    assert {row[4] for row in grouped if row[0] == "hpa_cpu"} == {"workload-0", "workload-10", "workload-20"}
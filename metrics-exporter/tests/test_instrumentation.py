@@ -0,0 +1,127 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import io
+import pytest
+import harness
+import instrumentation
+import main
+
+# Monotonic clock moved forward by the code under test
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(instrumentation.time, "perf_counter", clock)
+    instrumentation.start_run()
+    return clock
+
+def stage_entries():
+    return {(entry["stage"], entry["metric_name"]): entry for entry in instrumentation.current_run().summary()["stages"]}
+
+def test_generator_stage_times_every_item_and_not_the_consumer(clock):
+    @instrumentation.stage("produce")
+    def produce(metric_name):
+        for _ in range(3):
+            clock.sleep(2)
+            yield metric_name
+        clock.sleep(1)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in produce("cpu"):
+            clock.sleep(10)
+    assert stage_entries()[("produce", "cpu")] == {"stage": "produce", "metric_name": "cpu", "seconds": 7.0, "calls": 1, "errors": 0}
+
+def test_generator_stage_closed_early_or_failing_is_recorded(clock):
+    @instrumentation.stage("produce")
+    def produce(metric_name, fail=False):
+        clock.sleep(1)
+        yield 1
+        clock.sleep(1)
+        if fail:
+            raise ValueError(metric_name)
+        yield 2
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        next(iter(produce("cpu")))
+        with pytest.raises(ValueError):
+            list(produce("memory", fail=True))
+    entries = stage_entries()
+    assert (entries[("produce", "cpu")]["seconds"], entries[("produce", "cpu")]["errors"]) == (1.0, 0)
+    assert (entries[("produce", "memory")]["seconds"], entries[("produce", "memory")]["errors"]) == (2.0, 1)
+
+def test_metered_pager_counts_pages_series_and_points(clock):
+    harness.install(harness.SyntheticMonitoringClient(1, 4, 10, points_per_page=20))
+    client = main.get_monitoring_client(main.monitoring_v3.MetricServiceClient)
+    metric = main.config.MQL_QUERY["memory_request_recommendations"][0]
+    request = {
+        "name": "projects/project",
+        "filter": main.get_metric_filter(metric),
+        "interval": {"end_time": {"seconds": 1790000000}, "start_time": {"seconds": 1790000000 - 3600}},
+    }
+    series = list(instrumentation.metered(client.list_time_series(request=request), ["memory", "cpu"]))
+    assert len(series) == 8
+    assert instrumentation.current_run().summary()["fetches"] == [{"metric_name": "memory, cpu", "pages": 4, "series": 8, "points": 80}]
+
+# Metric client keeping the time series it is asked to create
+class RecordingMetricClient:
+
+    def __init__(self):
+        self.requests = []
+
+    def create_time_series(self, name, time_series):
+        self.requests.append((name, time_series))
+
+def test_write_run_metrics_writes_every_summary_entry():
+    summary = {
+        "run_seconds": 12.5,
+        "stages": [{"stage": "get_gke_metrics", "metric_name": "cpu", "seconds": 1.5, "calls": 1, "errors": 0}],
+        "fetches": [{"metric_name": "cpu", "pages": 2, "series": 3, "points": 4}],
+        "queries": [{"stage": "build", "bytes_billed": 10, "slot_millis": 20}, {"stage": "build", "bytes_billed": 1, "slot_millis": 2}],
+        "rows_appended": 7,
+    }
+    client = RecordingMetricClient()
+    instrumentation.write_run_metrics(client, "project", "custom.googleapis.com/exporter", summary)
+    assert [name for name, _ in client.requests] == ["projects/project"]
+    points = {
+        (series.metric.type.rsplit("/", 1)[-1], tuple(sorted(series.metric.labels.items()))): series.points[0].value.double_value
+        for series in client.requests[0][1]
+    }
+    assert points == {
+        ("run_seconds", ()): 12.5,
+        ("stage_seconds", (("metric_name", "cpu"), ("stage", "get_gke_metrics"))): 1.5,
+        ("fetched_pages", (("metric_name", "cpu"),)): 2,
+        ("fetched_series", (("metric_name", "cpu"),)): 3,
+        ("fetched_points", (("metric_name", "cpu"),)): 4,
+        ("bigquery_bytes_billed", (("stage", "build"),)): 11,
+        ("bigquery_slot_millis", (("stage", "build"),)): 22,
+        ("rows_appended", ()): 7,
+    }
+    assert all(series.resource.type == "global" and series.resource.labels["project_id"] == "project" for series in client.requests[0][1])
+
+def test_write_run_metrics_splits_requests_of_more_than_200_series():
+    summary = {"run_seconds": 1, "stages": [], "fetches": [{"metric_name": str(i), "pages": 1, "series": 1, "points": 1} for i in range(100)], "queries": []}
+    client = RecordingMetricClient()
+    instrumentation.write_run_metrics(client, "project", "custom.googleapis.com/exporter", summary)
+    assert [len(time_series) for _, time_series in client.requests] == [200, 101]
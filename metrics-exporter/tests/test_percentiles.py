@@ -0,0 +1,53 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+from google.cloud import monitoring_v3
+from percentiles import ragged_from_time_series, batch_percentiles, batch_max
+
+def ragged(series):
+    offsets = np.cumsum([0] + [len(values) for values in series])
+    values = np.concatenate([np.asarray(values, dtype=np.int64) for values in series]) if series else np.zeros(0, dtype=np.int64)
+    return values, offsets
+
+def test_batch_percentiles_match_numpy():
+    rng = np.random.default_rng(0)
+    series = [rng.integers(0, 5000, size) for size in (1, 2, 3, 10, 287, 288, 1000)]
+    values, offsets = ragged(series)
+    percentiles = [0, 50, 90, 95, 99, 100]
+    result = batch_percentiles(values, offsets, percentiles)
+    for i, points in enumerate(series):
+        for j, percentile in enumerate(percentiles):
+            assert result[j, i] == np.percentile(points, percentile)
+
+def test_batch_percentiles_empty_series_are_nan():
+    values, offsets = ragged([[3, 1, 2], [], [7]])
+    result = batch_percentiles(values, offsets, [50])
+    assert result[0, 0] == 2
+    assert np.isnan(result[0, 1])
+    assert result[0, 2] == 7
+    assert np.isnan(batch_percentiles(*ragged([[], []]), [95])).all()
+
+def test_batch_max_matches_max():
+    values, offsets = ragged([[5, 9, 2], [], [-4, -1], [0]])
+    assert batch_max(values, offsets).tolist() == [9, np.iinfo(np.int64).min, -1, 0]
+
+def test_ragged_from_time_series_scales_like_the_raw_fetch():
+    cpu = monitoring_v3.TimeSeries()
+    for value in (0.25, 1.0009):
+        cpu.points.append(monitoring_v3.Point(value={"double_value": value}))
+    memory = monitoring_v3.TimeSeries()
+    memory.points.append(monitoring_v3.Point(value={"int64_value": 3 * 1024 * 1024 + 5}))
+    values, offsets = ragged_from_time_series([cpu, monitoring_v3.TimeSeries(), memory])
+    assert values.tolist() == [250, 1000, 3]
+    assert offsets.tolist() == [0, 2, 2, 3]
@@ -0,0 +1,93 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import datetime
+import io
+import threading
+import types
+import pytest
+from google.api_core import exceptions
+import harness
+import main
+
+# Synthetic fleet whose VPA memory recommendations cannot be read
+class FailingMonitoringClient(harness.SyntheticMonitoringClient):
+
+    def list_time_series(self, request):
+        if "memory/per_replica_recommended_request_bytes" in request["filter"]:
+            raise exceptions.ServiceUnavailable("Cloud Monitoring unavailable")
+        return super().list_time_series(request)
+
+@pytest.fixture(autouse=True)
+def local_engine(monkeypatch):
+    monkeypatch.setattr(main.config, "RECOMMENDATION_ENGINE", "local")
+    monkeypatch.setattr(main.config, "CHANGE_DETECTION", True)
+
+def change_cache_table():
+    return f"{main.config.PROJECT_ID}.{main.config.BIGQUERY_DATASET}.{main.config.CHANGE_CACHE_TABLE}"
+
+# Queries of the recommendation build: the local engine only retires older recommendations with an UPDATE
+def updates(bigquery_client):
+    return [sql for sql in bigquery_client.queries if sql.lstrip().startswith("UPDATE")]
+
+def test_run_builds_recommendations_and_saves_the_cache():
+    _, _, bigquery_client = harness.install(harness.SyntheticMonitoringClient(1, 4, 10))
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.run_pipeline()
+    assert updates(bigquery_client)
+    assert change_cache_table() in bigquery_client.tables
+
+@pytest.mark.parametrize("engine", ["local", "bigquery"])
+def test_failed_metric_fails_the_run_without_recommendations(monkeypatch, engine):
+    monkeypatch.setattr(main.config, "RECOMMENDATION_ENGINE", engine)
+    updated = []
+    monkeypatch.setattr(main.ChangeCache, "update", lambda *args: updated.append(args))
+    _, write_client, bigquery_client = harness.install(FailingMonitoringClient(1, 4, 10))
+    with pytest.raises(RuntimeError, match="memory_request_recommendations"), contextlib.redirect_stdout(io.StringIO()):
+        main.run_pipeline()
+    assert write_client.rows_appended or engine == "local"
+    assert write_client.committed == []
+    assert updated == []
+    assert not updates(bigquery_client)
+    assert change_cache_table() not in bigquery_client.tables
+
+def test_failed_run_stops_the_writer(monkeypatch):
+    streams = []
+    write_client = harness.FakeWriteClient()
+    open_append_rows_stream = write_client.open_append_rows_stream
+    def tracked(request_template):
+        streams.append(open_append_rows_stream(request_template))
+        return streams[-1]
+    monkeypatch.setattr(write_client, "open_append_rows_stream", tracked)
+    closed = []
+    monkeypatch.setattr(harness.FakeAppendRowsStream, "close", lambda stream: closed.append(stream))
+    def fail(change_cache, records, tstamp):
+        raise ValueError("change detection failed")
+    monkeypatch.setattr(main.ChangeCache, "update", fail)
+    harness.install(harness.SyntheticMonitoringClient(1, 4, 10), write_client)
+    with pytest.raises(ValueError), contextlib.redirect_stdout(io.StringIO()):
+        main.run_pipeline()
+    assert not [thread for thread in threading.enumerate() if thread.name == "queue-writer"]
+    assert streams and closed == streams
+
+@pytest.mark.parametrize("age, runs", [(60, ["event"]), (main.config.EVENT_MAX_AGE_SECONDS + 60, [])])
+def test_retried_events_are_dropped_once_too_old(monkeypatch, age, runs):
+    now = 1790000000.0
+    monkeypatch.setattr(main.time, "time", lambda: now)
+    calls = []
+    monkeypatch.setattr(main, "run_pipeline", lambda shard=None, run_id=None: calls.append(run_id))
+    published = datetime.datetime.fromtimestamp(now - age, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.123Z")
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.export_metric_data({"data": ""}, types.SimpleNamespace(event_id="event", timestamp=published))
+    assert calls == runs
@@ -0,0 +1,125 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+import recommendation_record_pb2
+from recommender import LABELS, cast_int64, recommend, recommendation_rows, select
+
+# Workload labels, in the order of recommender.LABELS
+def workload(controller_name, controller_type="Deployment", location="us-central1"):
+    return (location, "proj", "cluster", controller_name, controller_type, "default")
+
+def metrics(count, cpu_requested, cpu_limit, memory_requested, memory_limit, memory_recommendation, cpu_95th, cpu_max):
+    values = {
+        "container_count": count,
+        "cpu_requested_cores": cpu_requested,
+        "cpu_limit_cores": cpu_limit,
+        "memory_requested_bytes": memory_requested,
+        "memory_limit_bytes": memory_limit,
+        "memory_request_recommendations": memory_recommendation,
+        "cpu_request_95th_percentile_recommendations": cpu_95th,
+        "cpu_request_max_recommendations": cpu_max,
+    }
+    # None is a metric without rows, NULL after the PIVOT of the query
+    return {metric_name: value if isinstance(value, set) else {value} for metric_name, value in values.items() if value is not None}
+
+RECORDS = {
+    # Two distinct container counts average to 1.5
+    workload("burstable"): metrics({1, 2}, 500, 1000, 256, 512, 300, 200, 400),
+    workload("guaranteed"): metrics(1, 1000, 1000, 512, 512, 400, 300, 800),
+    workload("unset"): metrics(3, 0, 0, 0, 0, 100, 50, 70),
+    # Excluded by the HPA of the same location, project, cluster and controller
+    workload("scaled"): metrics(1, 100, 200, 100, 200, 50, 20, 40),
+    workload("scaled", "HorizontalPodAutoscaler"): {"hpa_cpu": {80}},
+    # An empty controller name is NULL, so the HPA without one does not exclude the workload
+    workload(""): metrics(2, 100, 100, 100, 100, 100, 100, 100),
+    workload("", "HorizontalPodAutoscaler"): {"hpa_memory": {80}},
+    # NULL priority
+    workload("no-count"): metrics(None, 500, 1000, 256, 512, 300, 200, 400),
+    workload("no-memory-request"): metrics(1, 500, 1000, None, 512, 300, 200, 400),
+    # Filtered out before the QoS
+    workload("no-memory-recommendation"): metrics(1, 500, 1000, 256, 512, None, 200, 400),
+    workload("no-cpu-recommendation"): metrics(1, 500, 1000, 256, 512, 300, None, None),
+}
+
+# Rows of recommendation-template.sql over RECORDS, computed by hand
+EXPECTED = {
+    workload("burstable"): dict(
+        container_count=2, cpu_limit_cores=1000, cpu_requested_cores=500, memory_limit_bytes=512, memory_requested_bytes=256,
+        memory_request_max_recommendations=300, memory_limit_recommendations=300, mem_qos="Burstable", cpu_qos="Burstable",
+        # 95th percentile scaled by limit / request
+        cpu_request_recommendations=200, cpu_limit_recommendations=400, cpu_delta=300, mem_delta=-44,
+        # CAST(1.5 * ((500 - 200) + (256 - 300) / 13.4) AS INT64)
+        priority=445,
+        mem_provision_status="under", mem_provision_risk="reliability", cpu_provision_status="over", cpu_provision_risk="cost",
+    ),
+    workload("guaranteed"): dict(
+        container_count=1, cpu_limit_cores=1000, cpu_requested_cores=1000, memory_limit_bytes=512, memory_requested_bytes=512,
+        memory_request_max_recommendations=400, memory_limit_recommendations=400, mem_qos="Guaranteed", cpu_qos="Guaranteed",
+        # Guaranteed QoS takes the max for the request and the limit
+        cpu_request_recommendations=800, cpu_limit_recommendations=800, cpu_delta=200, mem_delta=112,
+        priority=208,
+        mem_provision_status="over", mem_provision_risk="cost", cpu_provision_status="over", cpu_provision_risk="cost",
+    ),
+    workload("unset"): dict(
+        container_count=3, cpu_limit_cores=0, cpu_requested_cores=0, memory_limit_bytes=0, memory_requested_bytes=0,
+        memory_request_max_recommendations=100, memory_limit_recommendations=100, mem_qos="BestEffort", cpu_qos="BestEffort",
+        # No limit or request, the limit is the max
+        cpu_request_recommendations=50, cpu_limit_recommendations=70, cpu_delta=-50, mem_delta=-100,
+        # CAST(3 * (-50 - 100 / 13.4) AS INT64)
+        priority=-172,
+        mem_provision_status="under", mem_provision_risk="reliability", cpu_provision_status="under", cpu_provision_risk="performance",
+    ),
+    workload(""): dict(
+        container_count=2, cpu_limit_cores=100, cpu_requested_cores=100, memory_limit_bytes=100, memory_requested_bytes=100,
+        memory_request_max_recommendations=100, memory_limit_recommendations=100, mem_qos="Guaranteed", cpu_qos="Guaranteed",
+        cpu_request_recommendations=100, cpu_limit_recommendations=100, cpu_delta=0, mem_delta=0,
+        priority=0,
+        mem_provision_status="ok", mem_provision_risk="ok", cpu_provision_status="ok", cpu_provision_risk="ok",
+    ),
+}
+
+# Labels and fields of serialized RecommendationRecord rows
+def parse(rows):
+    parsed = {}
+    for row in rows:
+        record = recommendation_record_pb2.RecommendationRecord()
+        record.ParseFromString(row)
+        labels = tuple(getattr(record, label) for label in LABELS)
+        parsed[labels] = {field.name: getattr(record, field.name) for field, _ in record.ListFields() if field.name not in LABELS}
+    return parsed
+
+def test_cast_int64_rounds_half_away_from_zero():
+    assert cast_int64(np.array([2.5, -2.5, 0.5, -0.5, 1.49, -1.51, 3.0])).tolist() == [3, -3, 1, -1, 1, -2, 3]
+    assert np.isnan(cast_int64(np.array([np.nan]))[0])
+
+def test_recommendations_match_the_query():
+    labels, result = recommend(RECORDS)
+    assert sorted(labels) == sorted(EXPECTED)
+    tstamp = 1700000000.5
+    rows = parse(recommendation_rows(labels, result, tstamp))
+    for key, expected in EXPECTED.items():
+        assert rows[key] == dict(expected, recommendation_timestamp=1700000001 * 1000000, latest=True), key
+
+def test_empty_labels_are_not_set():
+    labels, result = recommend(RECORDS)
+    rows = recommendation_rows(*select(labels, result, {workload("")}), 0)
+    record = recommendation_record_pb2.RecommendationRecord()
+    record.ParseFromString(next(rows))
+    assert not record.HasField("controller_name")
+    assert record.controller_type == "Deployment"
+
+def test_no_workloads():
+    labels, result = recommend({})
+    assert labels == []
+    assert list(recommendation_rows(labels, result, 0)) == []
@@ -0,0 +1,103 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+from google.cloud import monitoring_v3
+import main
+import metric_record_flat_pb2
+import metric_record_wide_pb2
+from row_encoding import MetricRowEncoder, WideCellEncoder, WideRecordJoiner, WideRowEncoder, WIDE_LABELS, stored_tstamp
+
+LABELS = ("us-central1", "project", "cluster", "frontend", "Deployment", "default")
+FLAT_LABEL_FIELDS = ["location", "project_id", "cluster_name", "controller_name", "controller_type", "namespace_name"]
+
+@pytest.mark.parametrize("labels", [LABELS, ("", "project", "", "frontend", "", ""), ("éu-west", "p", "c", "ñame", "Job", "ns")])
+@pytest.mark.parametrize("points", [0, 1, 127, 128, 300, 2 ** 40, -1, -(2 ** 63)])
+@pytest.mark.parametrize("tstamp", [0, 1700000000.123])
+def test_metric_row_matches_serialize_to_string(labels, points, tstamp):
+    encoder = MetricRowEncoder(tstamp)
+    row = encoder.row("cpu_request_max_recommendations", encoder.labels(*labels), points)
+    record = metric_record_flat_pb2.MetricFlatRecord(
+        metric_name="cpu_request_max_recommendations", points=points, tstamp=tstamp, **dict(zip(FLAT_LABEL_FIELDS, labels)))
+    assert row == record.SerializeToString()
+
+def test_stored_tstamp_rounds_like_the_float_field():
+    tstamp = 1700000000.123
+    record = metric_record_flat_pb2.MetricFlatRecord(tstamp=tstamp)
+    assert stored_tstamp(tstamp) == metric_record_flat_pb2.MetricFlatRecord.FromString(record.SerializeToString()).tstamp
+
+def wide_record(labels, tstamp, values):
+    record = metric_record_wide_pb2.MetricWideRecord(tstamp=tstamp, **{field: label for field, label in zip(WIDE_LABELS, labels) if label})
+    columns = metric_record_wide_pb2.MetricWideRecord.DESCRIPTOR.fields_by_name
+    for metric_name, value in values.items():
+        if "hpa" in metric_name:
+            record.hpa = True
+        elif metric_name in columns:
+            setattr(record, metric_name, value)
+        else:
+            record.other_metrics.add(metric_name=metric_name, points=value)
+    return record
+
+@pytest.mark.parametrize("values", [
+    {},
+    {"container_count": 2.0, "cpu_requested_cores": 0.0, "memory_request_recommendations": 1536.5},
+    {"cpu_request_max_recommendations": 250.0, "hpa_cpu": 1.0, "memory_limit_bytes": 512.0},
+    {"cpu_request_90th_percentile_recommendations": 180.0, "container_count": 1.0, "memory_request_90th_percentile_recommendations": 300.25},
+])
+@pytest.mark.parametrize("labels", [LABELS, ("", "project", "cluster", "", "Deployment", "")])
+def test_wide_row_matches_serialize_to_string(labels, values):
+    assert WideRowEncoder(1700000000.5).row(labels, values) == wide_record(labels, 1700000000.5, values).SerializeToString()
+
+# Time series of a container of a Deployment, as Cloud Monitoring returns it to get_gke_metrics
+def container_series(container_name):
+    series = monitoring_v3.TimeSeries()
+    series.resource.labels.update({"location": "us-central1", "project_id": "project", "cluster_name": "cluster", "namespace_name": "default", "container_name": container_name})
+    pb = monitoring_v3.TimeSeries.pb(series)
+    pb.metadata.system_labels.fields["top_level_controller_name"].string_value = "frontend"
+    pb.metadata.system_labels.fields["top_level_controller_type"].string_value = "Deployment"
+    return series
+
+def test_fetched_cells_are_keyed_on_the_wide_labels(monkeypatch):
+    monkeypatch.setattr(main.config, "RECORD_FORMAT", "wide")
+    encode_row = main.gke_row_encoder("cpu_requested_cores", 0)
+    joiner = WideRecordJoiner()
+    joiner.write([encode_row(container_series("app"), 0.1), encode_row(container_series("sidecar"), 0.3)])
+    # The containers of a workload share its key, one label per WIDE_LABELS field
+    assert list(joiner.records) == [LABELS]
+    record = metric_record_wide_pb2.MetricWideRecord.FromString(next(joiner.rows(WideRowEncoder(0))))
+    assert [getattr(record, label) for label in WIDE_LABELS] == list(LABELS)
+    assert record.cpu_requested_cores == 200
+
+def test_joiner_averages_distinct_values_per_workload():
+    encoder = WideCellEncoder()
+    labels = encoder.labels(*LABELS)
+    other = encoder.labels("us-central1", "project", "cluster", "backend", "Deployment", "default")
+    joiner = WideRecordJoiner()
+    # Two containers with the same value count once, like the DISTINCT of the flat query
+    assert joiner.write([encoder.row("cpu_requested_cores", labels, 100), encoder.row("cpu_requested_cores", labels, 100)]) == 2
+    joiner.write([encoder.row("cpu_requested_cores", labels, 300), encoder.row("container_count", other, 1)])
+    rows = [metric_record_wide_pb2.MetricWideRecord.FromString(row) for row in joiner.rows(WideRowEncoder(0))]
+    by_controller = {row.controller_name: row for row in rows}
+    assert by_controller["frontend"].cpu_requested_cores == 200
+    assert by_controller["backend"].container_count == 1
+    assert not by_controller["backend"].HasField("cpu_requested_cores")
+
+def test_joiner_rows_of_selected_workloads():
+    encoder = WideCellEncoder()
+    labels = encoder.labels(*LABELS)
+    other = encoder.labels("us-central1", "project", "cluster", "backend", "Deployment", "default")
+    joiner = WideRecordJoiner()
+    joiner.write([encoder.row("container_count", labels, 1), encoder.row("container_count", other, 2), encoder.row("cpu_limit_cores", other, 5)])
+    flat = [metric_record_flat_pb2.MetricFlatRecord.FromString(row) for row in joiner.flat_rows(MetricRowEncoder(0), only={other})]
+    assert sorted((row.controller_name, row.metric_name, row.points) for row in flat) == [("backend", "container_count", 2), ("backend", "cpu_limit_cores", 5)]
+    assert len(list(joiner.rows(WideRowEncoder(0)))) == 2
@@ -0,0 +1,79 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import re
+import sqlite3
+import pytest
+from sharding import Shard, plan_shards, run_started_query, shard_done_query, claim_run_query, run_built_query
+
+TABLE_ID = "project.dataset.shards"
+
+# Shard table in SQLite, running the BigQuery statements with their few syntax differences rewritten
+class ShardTable:
+
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:", isolation_level=None)
+        self.connection.execute('CREATE TABLE "project.dataset.shards" (run_id TEXT, shard INTEGER, shard_count INTEGER, finished TEXT, claimed BOOLEAN, claimed_by INTEGER, built BOOLEAN)')
+
+    # Returns the number of rows affected
+    def run(self, sql, **parameters):
+        sql = re.sub(r"^\s*INSERT `", 'INSERT INTO "', sql).replace("`", '"').replace("CURRENT_TIMESTAMP()", "CURRENT_TIMESTAMP")
+        return self.connection.execute(re.sub(r"@(\w+)", r":\1", sql), parameters).rowcount
+
+@pytest.fixture
+def table():
+    return ShardTable()
+
+def test_only_one_worker_claims_the_run(table):
+    table.run(run_started_query(TABLE_ID), run_id="run", shard_count=3)
+    table.run(run_started_query(TABLE_ID), run_id="other", shard_count=1)
+    table.run(shard_done_query(TABLE_ID), run_id="other", shard=0, shard_count=1)
+    claims = []
+    for shard in (0, 1, 1, 2):
+        table.run(shard_done_query(TABLE_ID), run_id="run", shard=shard, shard_count=3)
+        claims.append(table.run(claim_run_query(TABLE_ID), run_id="run", shard=shard, shard_count=3))
+    # A late worker, or a retry of one that did not claim it, finds the run claimed
+    claims.append(table.run(claim_run_query(TABLE_ID), run_id="run", shard=0, shard_count=3))
+    assert claims == [0, 0, 0, 1, 0]
+    assert table.run(claim_run_query(TABLE_ID), run_id="other", shard=0, shard_count=1) == 1
+
+def test_retry_of_the_claiming_shard_builds_a_failed_run_once(table):
+    table.run(run_started_query(TABLE_ID), run_id="run", shard_count=2)
+    for shard in (0, 1):
+        table.run(shard_done_query(TABLE_ID), run_id="run", shard=shard, shard_count=2)
+    builds = []
+    # Shard 1 claims the run and its build fails, then Pub/Sub redelivers it, and shard 0 too
+    for shard, build_fails in ((1, True), (0, False), (1, False), (1, False), (0, False)):
+        table.run(shard_done_query(TABLE_ID), run_id="run", shard=shard, shard_count=2)
+        if table.run(claim_run_query(TABLE_ID), run_id="run", shard=shard, shard_count=2):
+            if build_fails:
+                continue
+            builds.append(shard)
+            table.run(run_built_query(TABLE_ID), run_id="run", shard=shard, shard_count=2)
+    assert builds == [1]
+
+def test_run_without_run_row_is_never_claimed(table):
+    table.run(shard_done_query(TABLE_ID), run_id="run", shard=0, shard_count=1)
+    assert table.run(claim_run_query(TABLE_ID), run_id="run", shard=0, shard_count=1) == 0
+
+def test_plan_shards():
+    shards = plan_shards("run", {"a": {"c3", "c1", "c2"}, "b": ["c1"]}, 2, 1700000000.5)
+    assert [(shard.shard, shard.shard_count, shard.project_id, shard.clusters) for shard in shards] == [(0, 3, "a", ["c1", "c2"]), (1, 3, "a", ["c3"]), (2, 3, "b", ["c1"])]
+
+def test_shard_from_event():
+    shard = plan_shards("run", {"a": ["c1", "c2"]}, 5, 1700000000.5)[0]
+    event = {"data": base64.b64encode(shard.data()), "attributes": shard.attributes()}
+    parsed = Shard.from_event(event)
+    assert vars(parsed) == vars(shard)
+    assert Shard.from_event({"data": base64.b64encode(b"{}")}) is None
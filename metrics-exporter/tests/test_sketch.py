@@ -0,0 +1,69 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import contextlib
+import io
+import numpy as np
+import pytest
+import harness
+import main
+from sketch import QuantileSketch
+
+def test_quantiles_within_relative_accuracy():
+    values = np.random.default_rng(0).gamma(2, 500, 10000).astype(np.int64)
+    sketch = QuantileSketch(0.01)
+    sketch.add(values)
+    ordered = np.sort(values)
+    for q in (0.01, 0.5, 0.9, 0.95, 0.99, 1.0):
+        exact = ordered[int(q * (values.size - 1))]
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+    assert sketch.max == values.max()
+
+def test_zeros_and_empty():
+    sketch = QuantileSketch()
+    assert sketch.quantile(0.5) is None
+    sketch.add([0, 0, 0, 10])
+    assert sketch.quantile(0.5) == 0
+    assert sketch.quantile(1) == pytest.approx(10, rel=0.01)
+
+def test_merge_equals_sketch_of_all_values():
+    values = np.random.default_rng(1).integers(0, 100000, 5000)
+    whole = QuantileSketch(0.01)
+    whole.add(values)
+    merged = QuantileSketch(0.01)
+    for part in np.array_split(values, 7):
+        day = QuantileSketch(0.01)
+        day.add(part)
+        merged.merge(QuantileSketch.from_json(day.to_json()))
+    assert (merged.bins, merged.zero_count, merged.count, merged.max) == (whole.bins, whole.zero_count, whole.count, whole.max)
+
+def test_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+def test_incremental_fetch_reads_window_days_without_deleting(monkeypatch):
+    monkeypatch.setattr(main.config, "VPA_FETCH_MODE", "incremental")
+    monkeypatch.setattr(main.config, "MONITORED_PROJECTS", ["project"])
+    now = 1790000000.0
+    monkeypatch.setattr(main.time, "time", lambda: now)
+    _, _, bigquery_client = harness.install(harness.SyntheticMonitoringClient(1, 2, 24 * 31))
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = list(main.get_vpa_recommenation_metrics_incremental("memory_request_recommendations", "metric", 30 * 86400, now, "project"))
+    assert rows
+    assert not [sql for sql in bigquery_client.queries if sql.lstrip().startswith("DELETE")]
+    select = [sql for sql in bigquery_client.queries if sql.lstrip().startswith("SELECT")]
+    assert len(select) == 1 and "day >= @first_day" in select[0]
+    # Every day of the window is fetched and stored, from the day of now - window to yesterday
+    table_id = f"{main.config.PROJECT_ID}.{main.config.BIGQUERY_DATASET}.{main.config.SKETCH_TABLE}"
+    days = {row["day"] for row in bigquery_client.tables[table_id]}
+    assert days == set(range(int((now - 30 * 86400) // 86400), int(now // 86400)))
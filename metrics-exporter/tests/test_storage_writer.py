@@ -0,0 +1,99 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from concurrent.futures import Future
+import pytest
+from google.api_core import exceptions
+from google.cloud.bigquery_storage_v1 import exceptions as bqstorage_exceptions
+import harness
+import metric_record_flat_pb2
+import storage_writer
+from storage_writer import StorageWriter
+
+# Write client whose stream only accepts the next offset, like a PENDING stream. The append at fail_offset fails
+# once and shuts its connection down: with raise_closed, later sends on it raise StreamClosedError, otherwise they
+# fail like the requests that were in flight on it.
+class OffsetWriteClient(harness.FakeWriteClient):
+
+    def __init__(self, fail_offset, raise_closed=False, failures=1):
+        super().__init__()
+        self.fail_offset = fail_offset
+        self.raise_closed = raise_closed
+        self.failures = failures
+        self.connections = 0
+        self.written = []
+
+    def open_append_rows_stream(self, request_template):
+        self.connections += 1
+        return OffsetAppendRowsStream(self)
+
+class OffsetAppendRowsStream:
+
+    def __init__(self, client):
+        self.client = client
+        self.broken = False
+
+    def send(self, request):
+        client = self.client
+        if self.broken and client.raise_closed:
+            raise bqstorage_exceptions.StreamClosedError("connection closed")
+        future = Future()
+        if self.broken:
+            future.set_exception(exceptions.Aborted("connection reset"))
+        elif request.offset == client.fail_offset and client.failures:
+            client.failures -= 1
+            self.broken = True
+            future.set_exception(exceptions.ServiceUnavailable("backend unavailable"))
+        elif request.offset < len(client.written):
+            future.set_exception(exceptions.AlreadyExists(f"offset {request.offset} already written"))
+        elif request.offset > len(client.written):
+            future.set_exception(exceptions.OutOfRange(f"offset {request.offset} after the end of the stream"))
+        else:
+            client.written.extend(request.proto_rows.rows.serialized_rows)
+            future.set_result(None)
+        return future
+
+    def close(self):
+        self.broken = True
+
+ROWS = [f"row {i}".encode() for i in range(20)]
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(storage_writer.time, "sleep", lambda seconds: None)
+
+# Writer sending one request per row, up to 4 in flight
+def new_writer(client, **kwargs):
+    return StorageWriter(client, "projects/p/datasets/d/tables/t", metric_record_flat_pb2.MetricFlatRecord.DESCRIPTOR, max_request_bytes=1, max_inflight=4, **kwargs)
+
+@pytest.mark.parametrize("raise_closed", [False, True])
+def test_failed_append_resends_every_request_in_flight(raise_closed):
+    client = OffsetWriteClient(fail_offset=5, raise_closed=raise_closed)
+    writer = new_writer(client)
+    for row in ROWS:
+        writer.append([row])
+    assert writer.commit() == len(ROWS)
+    assert client.written == ROWS
+    assert client.connections == 2
+    assert client.committed == [writer.stream_name]
+
+def test_gives_up_after_max_retries():
+    client = OffsetWriteClient(fail_offset=2, failures=10)
+    writer = new_writer(client, max_retries=2)
+    with pytest.raises(RuntimeError):
+        for row in ROWS:
+            writer.append([row])
+    with pytest.raises(RuntimeError):
+        writer.commit()
+    assert client.committed == []
+    assert client.written == ROWS[:2]
@@ -0,0 +1,47 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from google.cloud import bigquery
+from harness import FakeBigQueryClient
+from tables import ensure_table, load_schema, staging_table_spec, recommendation_table_spec, sketch_table_spec
+
+TABLE_ID = "proj.ds.tbl"
+
+# A table created with `bq mk` by an earlier version of the exporter
+def unpartitioned_client(schema_file):
+    client = FakeBigQueryClient()
+    client.create_table(bigquery.Table(TABLE_ID, schema=load_schema(schema_file)))
+    return client
+
+def test_ensure_table_creates_partitioned_table():
+    client = FakeBigQueryClient()
+    table = ensure_table(client, TABLE_ID, **staging_table_spec("bigquery_schema.json", 6))
+    assert table.time_partitioning.type_ == bigquery.TimePartitioningType.HOUR
+    assert table.time_partitioning.expiration_ms == 6 * 3600 * 1000
+
+def test_unpartitioned_staging_table_is_recreated():
+    client = unpartitioned_client("bigquery_schema.json")
+    table = ensure_table(client, TABLE_ID, **staging_table_spec("bigquery_schema.json", 6))
+    assert table.time_partitioning is not None
+    assert client.created[TABLE_ID].time_partitioning is not None
+
+def test_unpartitioned_recommendation_table_is_kept():
+    client = unpartitioned_client("bigquery_recommendation_schema.json")
+    table = ensure_table(client, TABLE_ID, **recommendation_table_spec("bigquery_recommendation_schema.json"))
+    assert table.time_partitioning is None
+    assert client.created[TABLE_ID].time_partitioning is None
+
+def test_sketch_partitions_expire_after_the_window():
+    table = ensure_table(FakeBigQueryClient(), TABLE_ID, **sketch_table_spec("bigquery_sketch_schema.json", 30 * 86400))
+    assert table.time_partitioning.type_ == bigquery.TimePartitioningType.DAY
+    assert table.time_partitioning.expiration_ms == 31 * 86400 * 1000
@@ -0,0 +1,92 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import pytest
+from google.api_core import exceptions
+import instrumentation
+import throttling
+from throttling import ProjectThrottle, ThrottledMonitoringClient
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(throttling.random, "uniform", lambda low, high: high)
+    instrumentation.start_run()
+
+def test_quota_errors_halve_the_limit_and_double_the_backoff():
+    throttle = ProjectThrottle(8, initial_backoff=1, max_backoff=4)
+    pauses = []
+    for _ in range(5):
+        throttle.acquire()
+        pauses.append(throttle.release("quota"))
+        throttle._resume_at = 0
+    assert pauses == [1, 2, 4, 4, 4]
+    assert throttle.limit == 1
+
+def test_successes_grow_the_limit_back_and_reset_the_backoff():
+    throttle = ProjectThrottle(4, initial_backoff=1)
+    throttle.acquire()
+    throttle.release("quota")
+    throttle._resume_at = 0
+    assert throttle.limit == 2
+    for _ in range(20):
+        throttle.acquire()
+        throttle.release()
+    assert throttle.limit == 4
+    assert throttle.backoff == 0
+
+def test_other_errors_leave_the_limit_unchanged():
+    throttle = ProjectThrottle(4)
+    throttle.acquire()
+    assert throttle.release("error") == 0
+    assert throttle.limit == 4
+
+def test_acquire_waits_for_the_backoff():
+    throttle = ProjectThrottle(2, initial_backoff=0.2)
+    throttle.acquire()
+    throttle.release("quota")
+    start = time.monotonic()
+    throttle.acquire()
+    assert time.monotonic() - start >= 0.15
+
+class Page:
+
+    def __init__(self, token=""):
+        self.next_page_token = token
+        self.time_series = [token or "last"]
+
+class FlakyClient:
+
+    def __init__(self, quota_errors):
+        self.quota_errors = quota_errors
+        self.requests = []
+
+    def list_time_series(self, request):
+        self.requests.append(dict(request))
+        if self.quota_errors:
+            self.quota_errors -= 1
+            raise exceptions.ResourceExhausted("quota")
+        return type("Pager", (), {"pages": [Page("" if request.get("page_token") else "2")]})()
+
+def test_client_retries_quota_errors_and_follows_pages(capsys):
+    client = FlakyClient(quota_errors=2)
+    throttled = ThrottledMonitoringClient(client, 2, max_retries=3, initial_backoff=0.01)
+    assert list(throttled.list_time_series({"name": "projects/p"})) == ["2", "last"]
+    assert len(client.requests) == 4
+    assert client.requests[-1]["page_token"] == "2"
+    assert instrumentation.current_run().counters["monitoring_quota_errors"] == 2
+
+def test_client_gives_up_after_max_retries(capsys):
+    throttled = ThrottledMonitoringClient(FlakyClient(quota_errors=10), 2, max_retries=1, initial_backoff=0.01)
+    with pytest.raises(exceptions.ResourceExhausted):
+        list(throttled.list_time_series({"name": "projects/p"}))
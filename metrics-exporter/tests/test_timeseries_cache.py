@@ -0,0 +1,93 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from google.cloud import monitoring_v3
+from timeseries_cache import SeriesStore, TimeSeriesCache, SERIES_LABELS, what_if
+
+MIB = 1024 * 1024
+A = {"location": "us-central1", "project_id": "proj", "cluster_name": "cluster", "namespace_name": "default", "controller_name": "web", "controller_kind": "Deployment", "container_name": "app"}
+B = dict(A, controller_name="api")
+
+# VPA memory recommendation series of a container with [(timestamp, MiB), ...] points, newest first like the raw fetch
+def time_series(labels, points):
+    series = monitoring_v3.TimeSeries()
+    series.resource.type = "k8s_scale"
+    series.resource.labels.update(labels)
+    pb = monitoring_v3.TimeSeries.pb(series)
+    for timestamp, value in sorted(points, reverse=True):
+        point = pb.points.add()
+        point.interval.end_time.seconds = timestamp
+        point.value.int64_value = value * MIB
+    return series
+
+# Store of a fetched page of [(labels, [(timestamp, MiB), ...]), ...]
+def store(series, start=None, end=None):
+    return SeriesStore.from_time_series([time_series(labels, points) for labels, points in series], start, end)
+
+# Key of the series of labels in a store
+def key(labels):
+    return store([(labels, [])]).labels[0]
+
+# {key: [(timestamp, MiB), ...]} of a store, sorted by time
+def points(store):
+    return {
+        labels: sorted(zip(store.timestamps[store.offsets[i]:store.offsets[i + 1]].tolist(), store.values[store.offsets[i]:store.offsets[i + 1]].tolist()))
+        for i, labels in enumerate(store.labels)
+    }
+
+def test_combine_takes_the_last_store_for_duplicate_points():
+    cached = store([(A, [(10, 1), (20, 2)]), (B, [(10, 5)])], 0, 20)
+    fetched = store([(B, [(20, 6)]), (A, [(20, 3), (30, 4)])], 15, 30)
+    combined = SeriesStore.combine([cached, fetched], 0)
+    assert points(combined) == {key(A): [(10, 1), (20, 3), (30, 4)], key(B): [(10, 5), (20, 6)]}
+    assert (combined.start, combined.end) == (0, 30)
+
+def test_combine_evicts_points_out_of_the_window():
+    cached = store([(A, [(10, 1), (20, 2)]), (B, [(10, 5)])], 0, 20)
+    fetched = store([(A, [(30, 4)])], 20, 30)
+    combined = SeriesStore.combine([cached, fetched], 10)
+    # B has no point left after 10 and is dropped
+    assert points(combined) == {key(A): [(20, 2), (30, 4)]}
+    assert combined.start == 10
+
+def test_combine_empty():
+    combined = SeriesStore.combine([SeriesStore.empty(), SeriesStore.empty()], 0)
+    assert combined.labels == []
+    assert combined.offsets.tolist() == [0]
+
+def test_window():
+    values, offsets = store([(A, [(10, 1), (20, 2), (30, 3)]), (B, [(30, 7)])]).window(10, 30)
+    # Points stay in the order of the fetch, newest first
+    assert values.tolist() == [3, 2, 7]
+    assert offsets.tolist() == [0, 2, 3]
+
+def test_save_and_load(tmp_path):
+    cache = TimeSeriesCache(str(tmp_path))
+    assert cache.load("proj", "cpu").labels == []
+    saved = store([(A, [(10, 1), (20, 2)]), (B, [(20, 6)])], 0, 20)
+    cache.save(saved, "proj", "cpu")
+    cache.save(saved, "proj", "cpu", clusters=["cluster"])
+    loaded = cache.load("proj", "cpu")
+    assert points(loaded) == points(saved)
+    assert (loaded.start, loaded.end) == (0, 20)
+    assert cache.path("proj", "cpu") != cache.path("proj", "cpu", ["cluster"])
+    # A store whose labels.json is missing was not saved completely
+    (tmp_path / "proj" / "cpu" / "labels.json").unlink()
+    assert cache.load("proj", "cpu").labels == []
+
+def test_what_if(tmp_path):
+    cache = TimeSeriesCache(str(tmp_path))
+    cache.save(store([(A, [(10, 100), (20, 200), (30, 300)]), (B, [(5, 1)])], 0, 30), "proj", "cpu")
+    results = list(what_if(cache, "proj", "cpu", 25, [50]))
+    assert results == [(A, {50: 200}, 300)]
+    assert key(A) == tuple(A[label] for label in SERIES_LABELS)
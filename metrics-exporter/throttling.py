@@ -0,0 +1,128 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import random
+import threading
+import time
+from google.api_core import exceptions
+import instrumentation
+
+# Cloud Monitoring read quotas are enforced per project. ProjectThrottle limits the requests in flight for one
+# project and adapts the limit to the quota errors it sees: a ResourceExhausted error halves the limit, down to one,
+# and pauses the project for an exponentially growing backoff; every successful request grows the limit back by
+# 1/limit, up to max_concurrency.
+class ProjectThrottle:
+
+    def __init__(self, max_concurrency, initial_backoff=1.0, max_backoff=32.0):
+        self.max_concurrency = max_concurrency
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.limit = float(max_concurrency)
+        self.inflight = 0
+        self.backoff = 0.0
+        self._resume_at = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait = self._resume_at - time.monotonic()
+                if wait <= 0 and self.inflight < int(self.limit):
+                    break
+                self._condition.wait(timeout=wait if wait > 0 else None)
+            self.inflight += 1
+
+    # outcome is "ok" for a successful request, "quota" for a quota error and anything else for other errors, which
+    # leave the limit unchanged. Returns the seconds the project is paused for.
+    def release(self, outcome="ok"):
+        pause = 0.0
+        with self._condition:
+            self.inflight -= 1
+            if outcome == "quota":
+                self.limit = max(1.0, self.limit / 2)
+                self.backoff = min(self.max_backoff, self.backoff * 2 or self.initial_backoff)
+                # Jitter so the requests paused together do not all come back at once
+                pause = self.backoff * random.uniform(0.5, 1.0)
+                self._resume_at = max(self._resume_at, time.monotonic() + pause)
+            elif outcome == "ok":
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+                self.backoff = 0.0
+            self._condition.notify_all()
+        return pause
+
+# Wraps the Cloud Monitoring clients so every request, including each page of a paged response, goes through the
+# throttle of the project it reads. A request failing with a quota error is retried up to max_retries times.
+class ThrottledMonitoringClient:
+
+    def __init__(self, client, max_concurrency, max_retries=5, initial_backoff=1.0, max_backoff=32.0):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._throttles = {}
+        self._lock = threading.Lock()
+
+    def throttle(self, project_name):
+        with self._lock:
+            if project_name not in self._throttles:
+                self._throttles[project_name] = ProjectThrottle(self.max_concurrency, self.initial_backoff, self.max_backoff)
+            return self._throttles[project_name]
+
+    def list_time_series(self, request):
+        return ThrottledPager(self, "list_time_series", request)
+
+    def query_time_series(self, request):
+        return ThrottledPager(self, "query_time_series", request)
+
+    # Send one request and return its first page only, the pager follows next_page_token itself
+    def call(self, method, request):
+        throttle = self.throttle(request["name"])
+        for attempt in range(self.max_retries + 1):
+            throttle.acquire()
+            try:
+                page = next(iter(getattr(self.client, method)(request=request).pages))
+            except exceptions.ResourceExhausted:
+                pause = throttle.release("quota")
+                instrumentation.current_run().add(monitoring_quota_errors=1)
+                if attempt == self.max_retries:
+                    raise
+                instrumentation.log(f"Cloud Monitoring quota exceeded for {request['name']}, retrying in {pause:.2f}s", severity="WARNING", project=request["name"], concurrency=int(throttle.limit))
+                continue
+            except Exception:
+                throttle.release("error")
+                raise
+            throttle.release()
+            return page
+
+# Pager over the pages of a throttled request, with the .pages and item iteration of the API pagers
+class ThrottledPager:
+
+    def __init__(self, throttled_client, method, request):
+        self.throttled_client = throttled_client
+        self.method = method
+        self.request = dict(request)
+
+    @property
+    def pages(self):
+        request = dict(self.request)
+        while True:
+            page = self.throttled_client.call(self.method, request)
+            yield page
+            if not page.next_page_token:
+                return
+            request["page_token"] = page.next_page_token
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from (page.time_series if self.method == "list_time_series" else page.time_series_data)
@@ -0,0 +1,168 @@
+# Copyright 2022 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+from google.cloud import monitoring_v3
+from percentiles import ragged_from_time_series, batch_percentiles, batch_max
+
+# Local columnar cache of the raw points of the VPA time series, so a run only downloads the points newer than the
+# cache and recommendations can be computed again with other parameters without Cloud Monitoring. Points are kept
+# in the flat buffer layout of percentiles.py, series i being values[offsets[i]:offsets[i + 1]] sorted by time,
+# with one .npy file per column:
+#
+#   values.npy     - int64 points, scaled to millicores or MiB like the raw fetch
+#   timestamps.npy - int64 end time of every point, in seconds
+#   offsets.npy    - int64 start of every series in values and timestamps, plus the number of points
+#   series.npy     - int32 labels of every series, as indexes into the strings of labels.json
+#   labels.json    - the label dictionary, every distinct label value stored once, and the time range cached
+#
+# Files are memory-mapped when loaded, so opening a store reads no points. A run still copies them: combine() merges
+# the points of the cached and fetched stores still in the window into new arrays, and window() copies the points it
+# selects. There is one directory per scope and metric, and per set of clusters for a shard.
+
+SERIES_LABELS = ['location', 'project_id', 'cluster_name', 'namespace_name', 'controller_name', 'controller_kind', 'container_name']
+COLUMNS = ["values", "timestamps", "offsets", "series"]
+
+# Points of a set of time series covering (start, end]
+class SeriesStore:
+
+    def __init__(self, labels, values, timestamps, offsets, start=None, end=None):
+        # One tuple of SERIES_LABELS per series
+        self.labels = labels
+        self.values = values
+        self.timestamps = timestamps
+        self.offsets = offsets
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def empty(cls):
+        return cls([], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64))
+
+    # Store of a page of monitoring_v3.TimeSeries fetched over (start, end]
+    @classmethod
+    def from_time_series(cls, time_series, start, end):
+        values, offsets = ragged_from_time_series(time_series)
+        # Read the underlying protobuf messages, the proto-plus wrappers are slow to access point by point
+        results = [monitoring_v3.TimeSeries.pb(result) for result in time_series]
+        timestamps = np.fromiter((point.interval.end_time.seconds for result in results for point in result.points), dtype=np.int64, count=int(offsets[-1]))
+        labels = [tuple(result.resource.labels[label] for label in SERIES_LABELS) for result in results]
+        return cls(labels, values, timestamps, offsets, start, end)
+
+    # Store of the points of all stores after start, over the time range of the last one. Series are matched by
+    # their labels; a point of the same series and time in several stores is taken from the last of them, and
+    # series without points left are dropped.
+    @classmethod
+    def combine(cls, stores, start):
+        index = {}
+        for store in stores:
+            for labels in store.labels:
+                index.setdefault(labels, len(index))
+        series_ids, timestamps, values, ranks = [], [], [], []
+        for rank, store in enumerate(stores):
+            keep = store.timestamps > start
+            series_map = np.fromiter((index[labels] for labels in store.labels), dtype=np.int64, count=len(store.labels))
+            series_ids.append(series_map[store.segment_ids()][keep])
+            timestamps.append(np.asarray(store.timestamps)[keep])
+            values.append(np.asarray(store.values)[keep])
+            ranks.append(np.full(int(keep.sum()), rank, dtype=np.int64))
+        series_ids, timestamps, values, ranks = (np.concatenate(column) if column else np.zeros(0, dtype=np.int64) for column in (series_ids, timestamps, values, ranks))
+        order = np.lexsort((ranks, timestamps, series_ids))
+        series_ids, timestamps, values = series_ids[order], timestamps[order], values[order]
+        last = np.ones(series_ids.size, dtype=bool)
+        last[:-1] = (series_ids[1:] != series_ids[:-1]) | (timestamps[1:] != timestamps[:-1])
+        series_ids, timestamps, values = series_ids[last], timestamps[last], values[last]
+        counts = np.bincount(series_ids, minlength=len(index))
+        present = counts > 0
+        labels = [labels for labels, kept in zip(index, present) if kept]
+        offsets = np.concatenate(([0], np.cumsum(counts[present]))).astype(np.int64)
+        return cls(labels, values, timestamps, offsets, start, stores[-1].end if stores else None)
+
+    # Series number of every point
+    def segment_ids(self):
+        return np.repeat(np.arange(len(self.labels)), np.diff(self.offsets))
+
+    # Points with start < timestamp <= end as a flat buffer and offsets for percentiles.py
+    def window(self, start, end):
+        keep = (self.timestamps > start) & (self.timestamps <= end)
+        counts = np.bincount(self.segment_ids()[keep], minlength=len(self.labels))
+        return np.asarray(self.values)[keep], np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+class TimeSeriesCache:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, scope, metric_name, clusters=None):
+        name = metric_name
+        if clusters:
+            name += "-" + hashlib.sha1(",".join(sorted(clusters)).encode()).hexdigest()[:12]
+        return os.path.join(self.directory, scope, name)
+
+    # Memory-mapped store of a scope and metric, empty if nothing is cached
+    def load(self, scope, metric_name, clusters=None):
+        path = self.path(scope, metric_name, clusters)
+        # labels.json is written last, a store without it was not saved completely
+        try:
+            with open(os.path.join(path, "labels.json")) as file:
+                meta = json.load(file)
+        except FileNotFoundError:
+            return SeriesStore.empty()
+        columns = {column: np.load(os.path.join(path, f"{column}.npy"), mmap_mode="r") for column in COLUMNS}
+        strings = meta["strings"]
+        labels = [tuple(strings[i] for i in row) for row in columns["series"].tolist()]
+        return SeriesStore(labels, columns["values"], columns["timestamps"], columns["offsets"], meta["start"], meta["end"])
+
+    def save(self, store, scope, metric_name, clusters=None):
+        path = self.path(scope, metric_name, clusters)
+        os.makedirs(path, exist_ok=True)
+        strings = {}
+        series = np.array([[strings.setdefault(value, len(strings)) for value in labels] for labels in store.labels], dtype=np.int32).reshape(len(store.labels), len(SERIES_LABELS))
+        columns = {"values": store.values, "timestamps": store.timestamps, "offsets": store.offsets, "series": series}
+        meta_path = os.path.join(path, "labels.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        for column, array in columns.items():
+            np.save(os.path.join(path, f"{column}.tmp.npy"), array)
+            os.replace(os.path.join(path, f"{column}.tmp.npy"), os.path.join(path, f"{column}.npy"))
+        with open(meta_path + ".tmp", "w") as file:
+            json.dump({"strings": list(strings), "start": store.start, "end": store.end}, file)
+        os.replace(meta_path + ".tmp", meta_path)
+
+# Percentiles and max of every cached series of a metric over the window ending at end, or at the end of the cache
+def what_if(cache, scope, metric_name, window, percentiles, end=None, clusters=None):
+    store = cache.load(scope, metric_name, clusters)
+    end = end or store.end or 0
+    values, offsets = store.window(end - window, end)
+    non_empty = np.diff(offsets) > 0
+    percentile_values = batch_percentiles(values, offsets, percentiles)
+    max_values = batch_max(values, offsets)
+    for i in np.flatnonzero(non_empty):
+        yield dict(zip(SERIES_LABELS, store.labels[i])), {percentile: int(percentile_values[j, i]) for j, percentile in enumerate(percentiles)}, int(max_values[i])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute VPA percentiles again from the local time series cache, without Cloud Monitoring")
+    parser.add_argument("directory", help="TIMESERIES_CACHE_DIR of the runs that filled the cache")
+    parser.add_argument("scope", help="project the metric was fetched from")
+    parser.add_argument("metric_name", help="MQL_QUERY name of the VPA metric, e.g. cpu_request_recommendations")
+    parser.add_argument("--window", type=int, default=2592000, help="seconds of points to use")
+    parser.add_argument("--percentiles", default="95", help="comma separated percentiles")
+    parser.add_argument("--end", type=int, help="end of the window in seconds since the epoch, the end of the cache by default")
+    args = parser.parse_args()
+    percentiles = [int(percentile) for percentile in args.percentiles.split(",")]
+    for labels, percentile_values, max_value in what_if(TimeSeriesCache(args.directory), args.scope, args.metric_name, args.window, percentiles, args.end):
+        print(json.dumps(dict(labels, max=max_value, **{f"p{percentile}": value for percentile, value in percentile_values.items()})))